@@ -0,0 +1,178 @@
+import argparse
+import csv
+import os
+import threading
+import time
+
+from attendance_store import EXPORT_FIELDS, AttendanceStore, session_of
+
+
+def filter_records(records, start_date=None, end_date=None, names=None, sessions=None):
+    # Dates are YYYY-MM-DD strings; the store is sorted by date, so reading
+    # stops at the first record after end_date
+    for record in records:
+        if start_date and record['Date'] < start_date:
+            continue
+        if end_date and record['Date'] > end_date:
+            break
+        if names is not None and record['Name'] not in names:
+            continue
+        if sessions is not None and session_of(record) not in sessions:
+            continue
+        yield record
+
+
+class ExcelWriter:
+    # openpyxl write-only mode streams rows to disk instead of keeping cells
+    def __init__(self, path):
+        from openpyxl import Workbook
+
+        self.path = path
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet("Attendance")
+        self.sheet.append(EXPORT_FIELDS)
+
+    def write(self, rows):
+        for row in rows:
+            self.sheet.append(row)
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+class CsvWriter:
+    def __init__(self, path):
+        self.file = open(path, "w", newline='', encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(EXPORT_FIELDS)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+def open_writer(path):
+    if path.lower().endswith(".csv"):
+        return CsvWriter(path)
+    return ExcelWriter(path)
+
+
+class AttendanceExport:
+    # Streams the consolidated attendance store into an .xlsx or .csv file on
+    # a background thread, one chunk of rows at a time, so memory stays flat
+    # however long the history is. The file only replaces path once it is
+    # complete; a cancelled or failed export leaves path untouched.
+    def __init__(self, store, path, start_date=None, end_date=None, names=None, sessions=None,
+                 chunk_rows=5000, compact=True, on_finished=None):
+        self.store = store
+        self.path = path
+        self.start_date = start_date
+        self.end_date = end_date
+        self.names = set(names) if names is not None else None
+        self.sessions = set(sessions) if sessions is not None else None
+        self.chunk_rows = chunk_rows
+        self.compact = compact
+        self.on_finished = on_finished
+
+        self.cancel_event = threading.Event()
+        self.thread = None
+        self.status = 'pending'  # 'running', 'done', 'cancelled' or 'failed'
+        self.error = None
+        self.rows_written = 0
+        self.bytes_read = 0
+        self.total_bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def progress(self):
+        # Fraction of the store read so far
+        if self.status == 'done':
+            return 1.0
+        return self.bytes_read / self.total_bytes if self.total_bytes else 0.0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def wait(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+        return self.status
+
+    def run(self):
+        start = time.perf_counter()
+        self.status = 'running'
+        tmp_file = self.path + ".tmp" + os.path.splitext(self.path)[1]
+        try:
+            if self.compact:
+                self.store.compact(export=False)
+            writer = open_writer(tmp_file)
+            try:
+                self.write_chunks(writer)
+            finally:
+                writer.close()
+            if self.cancel_event.is_set():
+                self.status = 'cancelled'
+            else:
+                os.replace(tmp_file, self.path)
+                self.status = 'done'
+        except Exception as e:
+            print(f"Error exporting attendance: {e}")
+            self.error = e
+            self.status = 'failed'
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            self.seconds = time.perf_counter() - start
+            if self.on_finished is not None:
+                self.on_finished(self)
+
+    def write_chunks(self, writer):
+        for records, self.bytes_read, self.total_bytes in self.store.read_store_chunks(self.chunk_rows):
+            if self.cancel_event.is_set():
+                return
+            rows = [[record.get(field) or '' for field in EXPORT_FIELDS]
+                    for record in filter_records(records, self.start_date, self.end_date, self.names, self.sessions)]
+            writer.write(rows)
+            self.rows_written += len(rows)
+            if self.end_date and records and records[-1]['Date'] > self.end_date:
+                return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export attendance to Excel or CSV")
+    parser.add_argument('output', help="Output file (.xlsx or .csv)")
+    parser.add_argument('--dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "attendance_data"),
+                        help="Attendance directory (the --sync-dir of the kiosks)")
+    parser.add_argument('--from', dest='start_date', metavar='YYYY-MM-DD')
+    parser.add_argument('--to', dest='end_date', metavar='YYYY-MM-DD')
+    parser.add_argument('--names', help="Comma-separated students to include")
+    parser.add_argument('--sessions', help="Comma-separated sessions (see rosters.json) to include")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.names.split(',')] if args.names else None
+    sessions = [session.strip() for session in args.sessions.split(',')] if args.sessions else None
+    export = AttendanceExport(AttendanceStore(args.dir, node_id="export"), args.output,
+                              args.start_date, args.end_date, names, sessions).start()
+    try:
+        while export.thread.is_alive():
+            export.thread.join(0.5)
+            print(f"\r{export.progress:6.1%} {export.rows_written} rows", end='', flush=True)
+    except KeyboardInterrupt:
+        export.cancel()
+        export.wait()
+    print()
+    if export.status == 'done':
+        print(f"Exported {export.rows_written} rows to {args.output} in {export.seconds:.1f}s")
+    else:
+        print(f"Export {export.status}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+import argparse
+import csv
+import glob
+import heapq
+import io
+import json
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+
+# Segment records (one CSV line each): timestamp, op, name, date, time,
+# node, session. op is 'mark' for attendance and 'remove' for a removed
+# student (tombstone). Records written before sessions existed have none.
+SEGMENT_FIELDS = ['Timestamp', 'Op', 'Name', 'Date', 'Time', 'Node', 'Session']
+
+# The consolidated store holds one row per (Date, Name, Session), sorted by that key
+STORE_FIELDS = ['Timestamp', 'Name', 'Date', 'Time', 'Node', 'Session']
+EXPORT_FIELDS = ['Name', 'Date', 'Time', 'Session']
+
+
+def session_of(record):
+    return record.get('Session') or ''
+
+
+def sort_key(record):
+    return (record['Date'], record['Name'], session_of(record), float(record['Timestamp']))
+
+
+class AttendanceStore:
+    # Attendance shared by several kiosks through a common directory (local,
+    # NFS or SMB). Every node appends to its own segment files, so writers
+    # never contend for a file. compact() merges new segment data into the
+    # consolidated store with a sorted merge, keeping the earliest mark per
+    # (name, date) across all nodes, and refreshes the Excel export.
+    def __init__(self, root_dir, node_id=None, excel_file=None, stale_lock_seconds=600):
+        self.root_dir = root_dir
+        # One segment writer per process: the GUI, the daemon and tools on one
+        # host would otherwise append to the same segment file
+        self.node_id = node_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.excel_file = excel_file
+        self.stale_lock_seconds = stale_lock_seconds
+        self.segment_dir = os.path.join(root_dir, "segments", self.node_id)
+        self.store_file = os.path.join(root_dir, "attendance_store.csv")
+        self.manifest_file = os.path.join(root_dir, "compaction.json")
+        self.lock_file = os.path.join(root_dir, "compaction.lock")
+        os.makedirs(self.segment_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.today = None
+        self.marked_today = set()  # (name, session) marked today by any node, as far as this node knows
+
+    # Writing
+
+    def segment_path(self, date):
+        return os.path.join(self.segment_dir, f"{date}.seg")
+
+    def append(self, records):
+        # One O_APPEND write per call; only this node writes its segments
+        if not records:
+            return
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, SEGMENT_FIELDS, lineterminator='\n')
+        writer.writerows(records)
+        path = self.segment_path(datetime.now().strftime("%Y-%m-%d"))
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, buffer.getvalue().encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def mark(self, name, when=None, session=''):
+        # Returns True if this is the first mark for the name in this session today
+        return bool(self.mark_many([name], when, session))
+
+    def mark_many(self, names, when=None, session=''):
+        # Marks several names with one segment write; returns the names that
+        # were not marked in this session today yet
+        when = when or datetime.now()
+        today = when.strftime("%Y-%m-%d")
+        marked = []
+        with self.lock:
+            if self.today != today:
+                self.load_today(today)
+            for name in names:
+                if (name, session) not in self.marked_today:
+                    self.marked_today.add((name, session))
+                    marked.append(name)
+            self.append([{'Timestamp': f"{when.timestamp():.6f}", 'Op': 'mark', 'Name': name, 'Date': today,
+                          'Time': when.strftime("%H:%M:%S"), 'Node': self.node_id, 'Session': session}
+                         for name in marked])
+        return marked
+
+    def remove(self, name):
+        now = datetime.now()
+        with self.lock:
+            self.marked_today = set(key for key in self.marked_today if key[0] != name)
+            self.append([{'Timestamp': f"{now.timestamp():.6f}", 'Op': 'remove', 'Name': name, 'Date': '',
+                          'Time': '', 'Node': self.node_id, 'Session': ''}])
+
+    def load_today(self, today):
+        # Names already marked today: consolidated rows plus every node's segment for today
+        self.today = today
+        self.marked_today = set()
+        removed = {}
+        for record in self.read_store():
+            if record['Date'] == today:
+                self.marked_today.add((record['Name'], session_of(record)))
+        for path in glob.glob(os.path.join(self.root_dir, "segments", "*", f"{today}.seg")):
+            for record in self.read_segment(path)[0]:
+                if record['Op'] == 'remove':
+                    removed[record['Name']] = float(record['Timestamp'])
+                elif record['Date'] == today:
+                    self.marked_today.add((record['Name'], session_of(record)))
+        self.marked_today = set(key for key in self.marked_today if key[0] not in removed)
+
+    # Reading
+
+    def read_store(self):
+        if not os.path.exists(self.store_file):
+            return
+        with open(self.store_file, "r", newline='', encoding="utf-8") as f:
+            yield from csv.DictReader(f)
+
+    def read_store_chunks(self, chunk_rows=5000):
+        # Yields (records, bytes read, file size) for chunk_rows records at a time
+        if not os.path.exists(self.store_file):
+            return
+        total = os.path.getsize(self.store_file)
+        with open(self.store_file, "rb") as f:
+            fields = next(csv.reader([f.readline().decode('utf-8')]), None)
+            while True:
+                lines = [line.decode('utf-8') for line in (f.readline() for _ in range(chunk_rows)) if line]
+                if not lines:
+                    break
+                yield list(csv.DictReader(lines, fields)), f.tell(), total
+
+    def read_segment(self, path, offset=0):
+        # Complete lines after offset, and the offset after the last complete line
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            return [], offset
+        lines = data[:end].decode('utf-8').splitlines()
+        return list(csv.DictReader(lines, SEGMENT_FIELDS)), offset + end
+
+    # Compaction
+
+    def acquire_compaction_lock(self):
+        try:
+            fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(self.lock_file) > self.stale_lock_seconds:
+                    os.remove(self.lock_file)  # Left behind by a crashed compaction
+                    return self.acquire_compaction_lock()
+            except FileNotFoundError:
+                return self.acquire_compaction_lock()
+            return False
+        os.write(fd, f"{self.node_id} {os.getpid()}".encode('utf-8'))
+        os.close(fd)
+        return True
+
+    def compact(self, export=True):
+        # Returns merge statistics, or None if another node is compacting
+        if not self.acquire_compaction_lock():
+            return None
+        try:
+            return self.merge(export)
+        finally:
+            os.remove(self.lock_file)
+
+    def merge(self, export):
+        start = time.perf_counter()
+        manifest = {'offsets': {}, 'tombstones': {}}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        offsets = manifest['offsets']
+        tombstones = manifest['tombstones']
+
+        # Only data appended since the last compaction is read
+        delta = []
+        removed = 0
+        for path in sorted(glob.glob(os.path.join(self.root_dir, "segments", "*", "*.seg"))):
+            key = os.path.relpath(path, self.root_dir)
+            records, offsets[key] = self.read_segment(path, offsets.get(key, 0))
+            for record in records:
+                if record['Op'] == 'remove':
+                    tombstones[record['Name']] = max(float(record['Timestamp']), tombstones.get(record['Name'], 0.0))
+                    removed += 1
+                else:
+                    delta.append(record)
+        delta.sort(key=sort_key)
+        if not delta and not removed and os.path.exists(self.store_file):
+            # Nothing new: the store is up to date, the export too unless a
+            # merge without export (the attendance view) came first
+            if export and self.excel_file and manifest.get('export_pending'):
+                self.export_excel(self.excel_file)
+                manifest['export_pending'] = False
+                self.write_manifest(manifest)
+            return {'records': None, 'new_records': 0, 'duplicates': 0, 'seconds': time.perf_counter() - start}
+
+        def live(records):
+            for record in records:
+                if float(record['Timestamp']) > tombstones.get(record['Name'], -1.0):
+                    yield record
+
+        # Sorted merge of the consolidated store with the delta: the first
+        # record of each (date, name, session) run is the earliest mark
+        kept = 0
+        duplicates = 0
+        last = None
+        tmp_file = self.store_file + f".{self.node_id}.tmp"
+        with open(tmp_file, "w", newline='', encoding="utf-8") as f:
+            writer = csv.DictWriter(f, STORE_FIELDS, restval='', extrasaction='ignore')
+            writer.writeheader()
+            for record in heapq.merge(live(self.read_store()), live(delta), key=sort_key):
+                key = (record['Date'], record['Name'], session_of(record))
+                if key == last:
+                    duplicates += 1
+                    continue
+                last = key
+                writer.writerow(record)
+                kept += 1
+        os.replace(tmp_file, self.store_file)
+
+        export = export and self.excel_file
+        manifest['export_pending'] = not export
+        self.write_manifest(manifest)
+        if export:
+            self.export_excel(self.excel_file)
+        return {'records': kept, 'new_records': len(delta), 'duplicates': duplicates,
+                'seconds': time.perf_counter() - start}
+
+    def write_manifest(self, manifest):
+        tmp_manifest = self.manifest_file + f".{self.node_id}.tmp"
+        with open(tmp_manifest, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_manifest, self.manifest_file)
+
+    def export_excel(self, path):
+        # Synchronous full export; callers already hold the compaction lock
+        from attendance_export import AttendanceExport
+
+        AttendanceExport(self, path, compact=False).run()
+
+    def import_excel(self, path):
+        # One-time migration of an existing attendance.xlsx into this node's segment
+        import pandas as pd
+
+        df = pd.read_excel(path)
+        records = []
+        for _, row in df.iterrows():
+            when = datetime.strptime(f"{row['Date']} {row['Time']}", "%Y-%m-%d %H:%M:%S")
+            records.append({'Timestamp': f"{when.timestamp():.6f}", 'Op': 'mark', 'Name': str(row['Name']),
+                            'Date': str(row['Date']), 'Time': str(row['Time']), 'Node': self.node_id,
+                            'Session': '' if pd.isna(row.get('Session')) else str(row.get('Session'))})
+        self.append(records)
+        return len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge attendance segments from all kiosks")
+    parser.add_argument('--dir', required=True, help="Shared attendance directory")
+    parser.add_argument('--excel', help="Excel export path (default: attendance.xlsx in --dir)")
+    parser.add_argument('--watch', type=float, metavar='SECONDS', help="Keep compacting at this interval")
+    args = parser.parse_args()
+
+    store = AttendanceStore(args.dir, node_id="compactor",
+                            excel_file=args.excel or os.path.join(args.dir, "attendance.xlsx"))
+    while True:
+        stats = store.compact()
+        if stats is None:
+            print("Another node is compacting; skipped")
+        elif stats['records'] is None:
+            print("No new attendance records")
+        else:
+            print(f"Compacted {stats['new_records']} new records ({stats['duplicates']} duplicates) "
+                  f"into {stats['records']} rows in {stats['seconds']:.2f}s")
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,26 +2,35 @@ print("Program started")  # At the very top of the file
 
 import sys
 import os
+import argparse
+import tempfile
+import threading
 import cv2
 import numpy as np
-import pandas as pd
 from datetime import datetime
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QPushButton, QLabel, QMessageBox, 
                             QInputDialog, QProgressBar, QListWidget, QCheckBox,
                             QFrame, QGroupBox, QSplitter, QComboBox, QStyleFactory,
-                            QStatusBar, QTableWidget, QTableWidgetItem, QHeaderView)
-from PyQt5.QtCore import QTimer, Qt, QSize
+                            QStatusBar, QTableWidget, QTableWidgetItem, QHeaderView,
+                            QFileDialog, QDateEdit, QProgressDialog, QAbstractItemView)
+from PyQt5.QtCore import QTimer, Qt, QSize, QDate
 from PyQt5.QtGui import QImage, QPixmap, QFont, QIcon, QColor, QPalette
-from cryptography.fernet import Fernet
-import pickle
 import warnings
-import time
+from recognition_engine import RecognitionEngine
+from frame_source import CameraSource, RecordingSource, ReplaySource, read_recording
+from frame_scheduler import ScheduledRecognizer
+from frame_profiler import FrameProfiler
+from frame_bus import FrameBus, camera_planes
+from enrollment import EnrollmentLane
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 class AttendanceSystem(QMainWindow):
-    def __init__(self):
+    def __init__(self, frame_source=None, gallery_budget_mb=None, profile_seconds=None,
+                 sync_dir=None, node_id=None, frame_bus_name=None, session=None, tile_size=None,
+                 detect_workers=None, gallery_poll=2.0, crowd_mode=False, memory_watch=None, memory_limits=None,
+                 replay_start=None):
         super().__init__()
         self.setWindowTitle("Digital Attendance System")
         self.setGeometry(100, 100, 1200, 800)
@@ -46,44 +55,51 @@ class AttendanceSystem(QMainWindow):
         palette.setColor(QPalette.HighlightedText, Qt.black)
         QApplication.setPalette(palette)
         
-        # Initialize variables
-        self.known_faces = {}  # Dictionary to store face data
-        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-        self.attendance_file = os.path.join(BASE_DIR, "attendance.xlsx")
-        self.face_data_file = os.path.join(BASE_DIR, "face_data.enc")
-        self.key_file = os.path.join(BASE_DIR, "encryption.key")
-        self.encryption_key = self.load_or_create_key()
-        self.fernet = Fernet(self.encryption_key)
-        
-        # Smart learning variables
-        self.smart_learning_enabled = True
-        self.learning_threshold = 0.9  # Higher threshold to trigger more learning
-        self.recognition_threshold = 0.65  # Lower threshold for better recognition
-        self.max_samples_per_person = float('inf')  # Unlimited face samples per person
-        self.last_learning_time = {}  # To prevent too frequent updates for the same person
-        
-        # Enhanced face recognition variables
-        self.min_recognition_matches = 2  # Minimum number of face samples that must match for recognition
-        self.match_confidence_threshold = 0.60  # Minimum confidence for a single face match
-        
-        # Attendance confirmation variables
-        self.pending_attendance = None  # Person waiting for attendance confirmation
-        self.confirmation_start_time = None  # When confirmation countdown started
-        self.confirmation_duration = 0  # No waiting time for attendance confirmation
-        
-        # Face capture variables
-        self.capture_mode = False
-        self.face_samples = []
-        self.sample_count = 0
+        # Detection, matching and attendance logic (loads existing face data
+        # and creates the attendance file if it doesn't exist)
+        if replay_start is not None:
+            # A replay runs like frame_source.run_replay: attendance goes to a
+            # scratch store, nothing is published and learned samples are not
+            # saved, so every replay of a recording starts from the same state
+            scratch_dir = tempfile.mkdtemp(prefix="attendance_replay_")
+            self.engine = RecognitionEngine(attendance_file=os.path.join(scratch_dir, "attendance.xlsx"),
+                                            gallery_budget_mb=gallery_budget_mb, attendance_dir=scratch_dir,
+                                            event_log=False, event_bus=False)
+            self.engine.persist_face_data = False
+        else:
+            self.engine = RecognitionEngine(gallery_budget_mb=gallery_budget_mb, attendance_dir=sync_dir, node_id=node_id)
+        if tile_size:
+            self.engine.enable_tiled_detection(tile_size, detect_workers)
+        # Crowded entrances: all faces of a frame matched as one batch, each person given to one face
+        self.engine.crowd_mode = crowd_mode
+        if gallery_poll:
+            # Students enrolled or removed on another machine appear without a restart
+            self.engine.watch_gallery(gallery_poll)
+        
+        # Keeps each frame within the 30 ms timer interval by degrading quality under load
+        self.recognizer = ScheduledRecognizer(self.engine, budget_ms=30)
+        
+        # On-demand profiling of the frame loop (button, SIGUSR1 or --profile)
+        self.profile_seconds = profile_seconds or 10
+        self.profiler = FrameProfiler(os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"),
+                                      on_finished=self.profile_finished)
+        self.profiler.install_signal(self.profile_seconds)
+        
+        # Optional memory trend tracking and limits for kiosks that run for weeks (see memory_watch.py)
+        self.memory_watch = None
+        if memory_watch:
+            from memory_watch import MemoryWatch, type_counts
+            self.memory_watch = MemoryWatch(
+                self.engine, os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory"), memory_watch,
+                memory_limits, lambda: dict(type_counts(('QPixmap', 'QImage')), tracks=len(self.recognizer.tracker.tracks)))
+        
+        # Enrollment of a new student runs alongside recognition (see enrollment.py)
+        self.enrollment = None
         self.required_samples = 8  # Increased number of angles to capture
-        self.current_capture_name = None
         
         # Background analysis flag
         self.process_background = False  # Flag to control background analysis
         
-        # Load face detection classifier
-        self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-        
         # Create main widget and layout
         main_widget = QWidget()
         self.setCentralWidget(main_widget)
@@ -115,6 +131,7 @@ class AttendanceSystem(QMainWindow):
         self.camera_label.setMinimumSize(640, 480)
         self.camera_label.setAlignment(Qt.AlignCenter)
         self.camera_label.setStyleSheet("border: none;")
+        self.camera_label.mousePressEvent = self.select_enrollment_face
         camera_layout.addWidget(self.camera_label)
         
         left_layout.addWidget(camera_frame)
@@ -270,6 +287,28 @@ class AttendanceSystem(QMainWindow):
         self.view_attendance_button.clicked.connect(self.view_attendance)
         attendance_layout.addWidget(self.view_attendance_button)
         
+        # Export attendance button
+        self.export_attendance_button = QPushButton("Export Attendance")
+        self.export_attendance_button.setIcon(QIcon.fromTheme("document-save"))
+        self.export_attendance_button.setMinimumHeight(40)
+        self.export_attendance_button.setStyleSheet("""
+            QPushButton {
+                background-color: #3498db;
+                color: white;
+                border-radius: 5px;
+                font-weight: bold;
+                padding: 8px;
+            }
+            QPushButton:hover {
+                background-color: #2980b9;
+            }
+            QPushButton:pressed {
+                background-color: #1f618d;
+            }
+        """)
+        self.export_attendance_button.clicked.connect(self.show_export_dialog)
+        attendance_layout.addWidget(self.export_attendance_button)
+        
         right_layout.addWidget(attendance_group)
         
         # Settings Group
@@ -292,7 +331,7 @@ class AttendanceSystem(QMainWindow):
         
         # Smart Learning toggle
         self.smart_learning_checkbox = QCheckBox("Enable Smart Learning")
-        self.smart_learning_checkbox.setChecked(self.smart_learning_enabled)
+        self.smart_learning_checkbox.setChecked(self.engine.smart_learning_enabled)
         self.smart_learning_checkbox.setStyleSheet("""
             QCheckBox {
                 spacing: 5px;
@@ -338,6 +377,28 @@ class AttendanceSystem(QMainWindow):
         self.about_button.clicked.connect(self.show_about)
         settings_layout.addWidget(self.about_button)
         
+        # Profile button
+        self.profile_button = QPushButton(f"Profile Frame Loop ({self.profile_seconds:.0f} s)")
+        self.profile_button.setIcon(QIcon.fromTheme("utilities-system-monitor"))
+        self.profile_button.setMinimumHeight(40)
+        self.profile_button.setStyleSheet("""
+            QPushButton {
+                background-color: #7f8c8d;
+                color: white;
+                border-radius: 5px;
+                font-weight: bold;
+                padding: 8px;
+            }
+            QPushButton:hover {
+                background-color: #95a5a6;
+            }
+            QPushButton:pressed {
+                background-color: #616a6b;
+            }
+        """)
+        self.profile_button.clicked.connect(self.start_profiling)
+        settings_layout.addWidget(self.profile_button)
+        
         right_layout.addWidget(settings_group)
         
         # Add stretch to push everything to the top
@@ -357,6 +418,29 @@ class AttendanceSystem(QMainWindow):
         self.statusBar.showMessage("System Ready | Smart Learning: Enabled")
         self.statusBar.setStyleSheet("background-color: #2c3e50; color: white;")
         
+        # Frame scheduler quality level and budget overruns
+        self.scheduler_label = QLabel()
+        self.scheduler_label.setStyleSheet("color: #bdc3c7; padding-right: 5px;")
+        self.statusBar.addPermanentWidget(self.scheduler_label)
+        
+        # Gallery memory tiers (only with a gallery budget)
+        self.gallery_label = QLabel()
+        self.gallery_label.setStyleSheet("color: #bdc3c7; padding-right: 5px;")
+        self.gallery_label.setVisible(self.engine.gallery is not None)
+        self.statusBar.addPermanentWidget(self.gallery_label)
+        
+        # Active class session and how often its roster was enough (only with rosters.json)
+        self.session_label = QLabel()
+        self.session_label.setStyleSheet("color: #bdc3c7; padding-right: 5px;")
+        self.session_label.setVisible(bool(self.engine.rosters.sessions))
+        self.statusBar.addPermanentWidget(self.session_label)
+        if session:
+            self.engine.set_session(session)
+        elif replay_start is not None:
+            # The session running when the recording started, not the one running now
+            self.engine.session_fixed = True
+            self.engine.switch_session(self.engine.rosters.active(datetime.fromtimestamp(replay_start)))
+        
         # Set window stylesheet
         self.setStyleSheet("""
             QMainWindow {
@@ -371,57 +455,26 @@ class AttendanceSystem(QMainWindow):
             }
         """)
         
-        # Initialize camera
-        self.camera = cv2.VideoCapture(0)
+        # Initialize camera (or a recording/replay source)
+        self.camera = frame_source if frame_source is not None else CameraSource(0)
+        self.frame_bus = None  # Created with the first frame, once its size is known
+        self.frame_bus_name = frame_bus_name
         self.timer = QTimer()
-        self.timer.timeout.connect(self.update_frame)
+        self.timer.timeout.connect(self.profiler.wrap(self.update_frame))
         self.timer.start(30)  # Start camera immediately
-        
-        # Load existing face data
-        self.load_face_data()
-        
-        # Create attendance file if it doesn't exist
-        if not os.path.exists(self.attendance_file):
-            df = pd.DataFrame(columns=['Name', 'Date', 'Time'])
-            df.to_excel(self.attendance_file, index=False)
-
-    def load_or_create_key(self):
-        if os.path.exists(self.key_file):
-            with open(self.key_file, "rb") as f:
-                return f.read()
-        else:
-            key = Fernet.generate_key()
-            with open(self.key_file, "wb") as f:
-                f.write(key)
-            return key
-
-    def load_face_data(self):
-        if os.path.exists(self.face_data_file):
-            try:
-                with open(self.face_data_file, "rb") as f:
-                    encrypted_data = f.read()
-                    decrypted_data = self.fernet.decrypt(encrypted_data)
-                    self.known_faces = pickle.loads(decrypted_data)
-            except Exception as e:
-                print(f"Error loading face data: {e}")
-                self.known_faces = {}
-
-    def save_face_data(self):
-        try:
-            serialized_data = pickle.dumps(self.known_faces)
-            encrypted_data = self.fernet.encrypt(serialized_data)
-            with open(self.face_data_file, "wb") as f:
-                f.write(encrypted_data)
-        except Exception as e:
-            print(f"Error saving face data: {e}")
+        if profile_seconds:
+            self.profiler.start(profile_seconds)
+        
+        # Merge attendance segments from all kiosks and refresh attendance.xlsx every minute
+        self.compaction_thread = None
+        self.compaction_timer = QTimer()
+        self.compaction_timer.timeout.connect(self.compact_attendance_in_background)
+        self.compaction_timer.start(60000)
 
     def start_face_capture(self):
         name, ok = QInputDialog.getText(self, 'Add Student', 'Enter student name:')
         if ok and name:
-            self.capture_mode = True
-            self.face_samples = []
-            self.sample_count = 0
-            self.current_capture_name = name
+            self.enrollment = EnrollmentLane(self.engine, name, self.required_samples)
             self.progress_bar.setValue(0)
             self.progress_bar.setVisible(True)
             
@@ -438,17 +491,41 @@ class AttendanceSystem(QMainWindow):
                 "6. Slightly tilt your head up and to the left\n"
                 "7. Slightly tilt your head up and to the right\n"
                 "8. Normal expression with different lighting if possible\n\n"
-                "Keep your face within the green rectangle for each capture.")
+                "Keep your face within the green rectangle for each capture. Everyone else keeps being "
+                "recognized meanwhile; if the wrong face is outlined, click the right one in the camera feed.")
 
-    def update_frame(self):
-        ret, frame = self.camera.read()
-        if not ret:
+    def select_enrollment_face(self, event):
+        # Click on the camera feed: the pixmap is shown unscaled and centred in the label
+        if self.enrollment is None or self.camera_label.pixmap() is None:
             return
-        color_frame = frame.copy()  # Keep the color frame for display
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        
-        # Prioritize face detection before any background analysis
-        faces = self.face_cascade.detectMultiScale(gray, 1.3, 5)
+        pixmap = self.camera_label.pixmap()
+        x = event.pos().x() - (self.camera_label.width() - pixmap.width()) // 2
+        y = event.pos().y() - (self.camera_label.height() - pixmap.height()) // 2
+        self.enrollment.click(x, y)
+
+    def update_frame(self):
+        # Each frame is written once into a frame bus slot (the camera decodes
+        # straight into it) together with its gray version; recognition and
+        # any other consumer read views of the slot
+        if self.frame_bus is None:
+            ret, frame = self.camera.read()
+            if not ret:
+                return
+            self.frame_bus = FrameBus(camera_planes(frame.shape), name=self.frame_bus_name)
+            bus_frame = self.frame_bus.write(color=frame, gray=cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+        else:
+            bus_frame = self.frame_bus.capture(self.camera)
+            if bus_frame is None:
+                return
+        color_frame = bus_frame['color'].copy()  # Overlays are drawn on a private copy for display
+        gray = bus_frame['gray']
+        
+        # Prioritize face detection before any background analysis. The frame
+        # scheduler decides how much detection and matching to run; a face
+        # being enrolled is held back from matching while all others are recognized.
+        enrollment = self.enrollment
+        outcomes = self.recognizer.process(gray, enrollment.choose if enrollment is not None else None)
+        faces = [outcome['box'] for outcome in outcomes if outcome['box'] is not None]
         
         # Draw a border around the camera feed
         cv2.rectangle(color_frame, (0, 0), (color_frame.shape[1]-1, color_frame.shape[0]-1), (52, 152, 219), 2)
@@ -459,17 +536,25 @@ class AttendanceSystem(QMainWindow):
         title_bar[:] = (41, 128, 185)  # Blue color
         
         # Only process background if flag is set and we're not in capture mode
-        self.process_background = len(faces) > 0 and not self.capture_mode
+        self.process_background = len(faces) > 0 and enrollment is None
+        
+        # Add timestamp to the frame
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cv2.putText(color_frame, current_time, (color_frame.shape[1]-200, color_frame.shape[0]-20), 
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
         
-        if self.capture_mode:
+        # Other faces are drawn during capture as well; the capture status below takes precedence
+        for outcome in outcomes:
+            self.show_outcome(color_frame, outcome)
+        
+        if enrollment is not None:
             cv2.putText(title_bar, "CAPTURE MODE", (10, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-            self.status_label.setText(f"Capturing: {self.sample_count}/{self.required_samples} samples")
+            self.status_label.setText(f"Capturing: {enrollment.sample_count}/{self.required_samples} samples")
             self.status_label.setStyleSheet("color: #f39c12; font-weight: bold; font-size: 14px; padding: 5px;")
-            self.statusBar.showMessage(f"Capturing face samples for {self.current_capture_name} | {self.sample_count}/{self.required_samples}")
+            self.statusBar.showMessage(f"Capturing face samples for {enrollment.name} | {enrollment.sample_count}/{self.required_samples}")
             
-            if len(faces) > 0:
-                x, y, w, h = faces[0]
-                face_roi = gray[y:y+h, x:x+w]
+            if enrollment.track is not None:
+                x, y, w, h = enrollment.track.box
                 
                 # Draw a more attractive rectangle with rounded corners effect
                 cv2.rectangle(color_frame, (x-2, y-2), (x+w+2, y+h+2), (41, 128, 185), 3)  # Outer blue rectangle
@@ -478,223 +563,121 @@ class AttendanceSystem(QMainWindow):
                 # Add a label above the face
                 label_bg = np.zeros((30, w+10, 3), dtype=np.uint8)
                 label_bg[:] = (46, 204, 113)  # Green background
-                cv2.putText(label_bg, f"Sample {self.sample_count + 1}/{self.required_samples}", (5, 20), 
+                cv2.putText(label_bg, f"Sample {min(enrollment.sample_count + 1, self.required_samples)}/{self.required_samples}", (5, 20), 
                             cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
                 
                 # Overlay the label on the frame
-                if y > 40:
+                if y > 40 and x >= 5 and x+w+5 <= color_frame.shape[1]:
                     color_frame[y-30:y, x-5:x+w+5] = label_bg
                 
-                if self.sample_count < self.required_samples:
-                    self.face_samples.append(face_roi)
-                    self.sample_count += 1
-                    self.progress_bar.setValue(self.sample_count)
-                    if self.sample_count == self.required_samples:
-                        self.known_faces[self.current_capture_name] = self.face_samples.copy()
-                        self.save_face_data()
-                        self.capture_mode = False
+                if enrollment.add_sample(gray):
+                    self.progress_bar.setValue(enrollment.sample_count)
+                    if enrollment.complete:
+                        # Appended to the match index: recognizable from the next frame
+                        enrollment.finish()
+                        self.enrollment = None
                         self.progress_bar.setVisible(False)
                         self.status_label.setText("Student added successfully")
                         self.status_label.setStyleSheet("color: #2ecc71; font-weight: bold; font-size: 14px; padding: 5px;")
                         self.statusBar.showMessage("System Ready | Smart Learning: Enabled")
                         QMessageBox.information(self, "Success",
-                            f"Student {self.current_capture_name} added successfully with {self.required_samples} face samples!")
+                            f"Student {enrollment.name} added successfully with {self.required_samples} face samples!")
         else:
             cv2.putText(title_bar, "RECOGNITION MODE", (10, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-            
-            # Add timestamp to the frame
-            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            cv2.putText(color_frame, current_time, (color_frame.shape[1]-200, color_frame.shape[0]-20), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
-            
-            # Reset pending attendance if no faces are detected
-            if len(faces) == 0 and self.pending_attendance is not None:
-                current_time = time.time()
-                # Only reset if it's been at least 1 second since confirmation started
-                # This prevents flickering when face detection temporarily fails
-                if self.confirmation_start_time is not None and (current_time - self.confirmation_start_time) > 1.0:
-                    self.pending_attendance = None
-                    self.confirmation_start_time = None
-                    self.status_label.setText("No face detected - confirmation reset")
-                    self.status_label.setStyleSheet("color: #e74c3c; font-weight: bold; font-size: 14px; padding: 5px;")
-                    self.statusBar.showMessage("Attendance confirmation reset - person disappeared from frame")
-            
-            for (x, y, w, h) in faces:
-                face_roi = gray[y:y+h, x:x+w]
-                name = "Unknown"
-                best_score = 0
-                best_name = "Unknown"
-                
-                # Enhanced recognition using multiple face data points
-                match_counts = {}  # Count how many samples match for each person
-                match_scores = {}  # Track the average score for each person
-                
-                for known_name, known_faces in self.known_faces.items():
-                    match_counts[known_name] = 0
-                    match_scores[known_name] = 0
-                    match_score_sum = 0
-                    match_count = 0
-                    
-                    for known_face in known_faces:
-                        try:
-                            result = cv2.matchTemplate(face_roi, known_face, cv2.TM_CCOEFF_NORMED)
-                            score = cv2.minMaxLoc(result)[1]
-                            
-                            # Count matches above the match confidence threshold
-                            if score > self.match_confidence_threshold:
-                                match_counts[known_name] += 1
-                                match_score_sum += score
-                                match_count += 1
-                                
-                            # Still track the best overall score for display
-                            if score > best_score:
-                                best_score = score
-                                best_name = known_name
-                        except Exception as e:
-                            continue
-                    
-                    # Calculate average score for this person if there were matches
-                    if match_count > 0:
-                        match_scores[known_name] = match_score_sum / match_count
-                
-                # Find the person with the most matches above threshold
-                most_matches = 0
-                most_matches_name = "Unknown"
-                most_matches_score = 0
-                
-                for person, count in match_counts.items():
-                    if count > most_matches:
-                        most_matches = count
-                        most_matches_name = person
-                        most_matches_score = match_scores[person]
-                
-                # Set a threshold for recognition based on minimum matches
-                if most_matches >= self.min_recognition_matches and most_matches_score > self.recognition_threshold:
-                    name = most_matches_name
-                    # Use the average score for this person
-                    best_score = most_matches_score
-                    current_time = time.time()
-                    
-                    # Handle attendance confirmation process
-                    if self.pending_attendance is None:
-                        # Mark attendance immediately without countdown
-                        self.mark_attendance(name)
-                        self.pending_attendance = name
-                        
-                        # Update status
-                        self.status_label.setText(f"Confirmed & Marked: {name} (Score: {best_score:.2f})")
-                        self.status_label.setStyleSheet("color: #2ecc71; font-weight: bold; font-size: 14px; padding: 5px;")
-                        self.statusBar.showMessage(f"Attendance confirmed and marked for {name} | Score: {best_score:.2f}")
-                    elif self.pending_attendance == name:
-                        # Already marked for this person, just update status
-                        self.status_label.setText(f"Already Marked: {name} (Score: {best_score:.2f})")
-                        self.statusBar.showMessage(f"Attendance already marked for {name} | Score: {best_score:.2f}")
-                    else:
-                        # Different person detected, mark their attendance
-                        self.mark_attendance(name)
-                        self.pending_attendance = name
-                        
-                        # Update status
-                        self.status_label.setText(f"Confirmed & Marked: {name} (Score: {best_score:.2f})")
-                        self.status_label.setStyleSheet("color: #2ecc71; font-weight: bold; font-size: 14px; padding: 5px;")
-                        self.statusBar.showMessage(f"Attendance confirmed and marked for {name} | Score: {best_score:.2f}")
-                    
-                    # Smart learning - update face data if recognition is successful but score is not very high
-                    if self.smart_learning_enabled and best_score < self.learning_threshold:
-                        # Check if we haven't updated this person's data recently (at least 2 seconds ago)
-                        if name not in self.last_learning_time or (current_time - self.last_learning_time[name]) > 2:
-                            self.update_face_data(name, face_roi)
-                            self.last_learning_time[name] = current_time
-                else:
-                    # Update status for unknown face
-                    self.status_label.setText(f"Unknown Face (Best match: {best_name}, Score: {best_score:.2f})")
-                    self.status_label.setStyleSheet("color: #e74c3c; font-weight: bold; font-size: 14px; padding: 5px;")
-                    
-                    # If we were in the middle of confirming attendance, reset it
-                    if self.pending_attendance is not None:
-                        self.pending_attendance = None
-                        self.statusBar.showMessage(f"Attendance confirmation reset - recognition lost (score: {best_score:.2f})")
-                        # We don't update status_label here as it's already set to "Unknown Face" above
-                
-                # Draw a more attractive rectangle with color based on recognition status
-                if name != "Unknown":
-                    if self.pending_attendance == name:
-                        # Confirming attendance - yellow/orange
-                        rect_color = (41, 128, 185)  # Blue
-                        text_color = (41, 128, 185)  # Blue
-                        
-                        # Calculate remaining time for confirmation
-                        current_time = time.time()
-                        # Ensure confirmation_start_time is not None before subtraction
-                        if self.confirmation_start_time is not None:
-                            elapsed_time = current_time - self.confirmation_start_time
-                            remaining_time = max(0, self.confirmation_duration - elapsed_time)
-                        else:
-                            # If confirmation_start_time is None, set remaining_time to 0
-                            remaining_time = 0
-                        
-                        # If confirmation is complete, change to green
-                        if remaining_time <= 0:
-                            rect_color = (46, 204, 113)  # Green
-                            text_color = (46, 204, 113)  # Green
-                    else:
-                        # Recognized but not confirming - green
-                        rect_color = (46, 204, 113)  # Green
-                        text_color = (46, 204, 113)  # Green
-                else:
-                    # Unknown - red
-                    rect_color = (231, 76, 60)  # Red
-                    text_color = (231, 76, 60)  # Red
-                
-                # Draw rectangle with thickness based on confidence
-                thickness = max(1, min(3, int(best_score * 5))) if best_score > 0.5 else 1
-                cv2.rectangle(color_frame, (x, y), (x+w, y+h), rect_color, thickness)
-                
-                # Create a background for the name text
-                display_name = name
-                if self.pending_attendance == name:
-                    # Add confirmation indicator to the name
-                    display_name = f"{name} ✓"
-                
-                text_size = cv2.getTextSize(display_name, cv2.FONT_HERSHEY_SIMPLEX, 0.75, 2)[0]
-                cv2.rectangle(color_frame, (x, y-30), (x+text_size[0]+10, y), rect_color, -1)
-                cv2.putText(color_frame, display_name, (x+5, y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255, 255, 255), 2)
-                
-                # Add confidence score
-                score_text = f"Score: {best_score:.2f}"
-                cv2.putText(color_frame, score_text, (x, y+h+20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, text_color, 2)
-        
-        # Combine title bar and frame
-        display_frame = np.vstack((title_bar, color_frame))
-        
-        # Convert BGR to RGB for display
-        rgb_frame = cv2.cvtColor(display_frame, cv2.COLOR_BGR2RGB)
-        h, w, ch = rgb_frame.shape
-        # Convert BGR to RGB for display
-        rgb_frame = cv2.cvtColor(color_frame, cv2.COLOR_BGR2RGB)
-        h, w, ch = rgb_frame.shape
+        
+        # Qt reads the BGR frame directly, without an RGB copy
+        h, w, ch = color_frame.shape
         bytes_per_line = ch * w
-        qt_image = QImage(rgb_frame.data, w, h, bytes_per_line, QImage.Format_RGB888)
+        qt_image = QImage(color_frame.data, w, h, bytes_per_line, QImage.Format_BGR888)
         self.camera_label.setPixmap(QPixmap.fromImage(qt_image))
+        
+        if self.memory_watch is not None:
+            self.memory_watch.enforce()
+        
+        self.recognizer.finish()
+        stats = self.recognizer.stats()
+        self.scheduler_label.setText(f"Quality: {stats['quality']} | {stats['average_ms']:.1f}/{stats['budget_ms']:.0f} ms | Overruns: {stats['overruns']}")
+        if self.engine.gallery is not None and stats['frames'] % 30 == 0:
+            self.gallery_label.setText(self.engine.gallery.summary())
+        if self.engine.rosters.sessions and stats['frames'] % 30 == 0:
+            roster = self.engine.roster_stats()
+            self.session_label.setText(f"Session: {roster['session'] or 'none'} | "
+                                       f"Roster fallbacks: {roster['fallback_rate']:.0%}")
 
-    def mark_attendance(self, name):
+    def show_outcome(self, color_frame, outcome):
+        # Update the status display and draw one recognition outcome from the engine
+        name = outcome['name']
+        best_score = outcome['score']
+        status = outcome['status']
+        
+        if status == 'tracked':
+            # Face followed between matches; keep its last identity without touching the status
+            pass
+        elif status == 'reset':
+            self.status_label.setText("No face detected - confirmation reset")
+            self.status_label.setStyleSheet("color: #e74c3c; font-weight: bold; font-size: 14px; padding: 5px;")
+            self.statusBar.showMessage("Attendance confirmation reset - person disappeared from frame")
+            return
+        elif status == 'marked':
+            self.status_label.setText(f"Confirmed & Marked: {name} (Score: {best_score:.2f})")
+            self.status_label.setStyleSheet("color: #2ecc71; font-weight: bold; font-size: 14px; padding: 5px;")
+            self.statusBar.showMessage(f"Attendance confirmed and marked for {name} | Score: {best_score:.2f}")
+        elif status == 'already_marked':
+            self.status_label.setText(f"Already Marked: {name} (Score: {best_score:.2f})")
+            self.statusBar.showMessage(f"Attendance already marked for {name} | Score: {best_score:.2f}")
+        else:
+            # Update status for unknown face
+            self.status_label.setText(f"Unknown Face (Best match: {outcome['best_name']}, Score: {best_score:.2f})")
+            self.status_label.setStyleSheet("color: #e74c3c; font-weight: bold; font-size: 14px; padding: 5px;")
+            if outcome.get('confirmation_lost'):
+                self.statusBar.showMessage(f"Attendance confirmation reset - recognition lost (score: {best_score:.2f})")
+        
+        if outcome['learning'] == 'added':
+            self.statusBar.showMessage(f"Smart learning: Added new unique face sample for {name} | Total samples: {len(self.engine.known_faces[name])}")
+        elif outcome['learning'] == 'created':
+            self.statusBar.showMessage(f"Smart learning: Created new face profile for {name}")
+        
+        # Draw a more attractive rectangle with color based on recognition status
         if name != "Unknown":
-            df = pd.read_excel(self.attendance_file)
-            current_time = datetime.now()
-            today = current_time.strftime("%Y-%m-%d")
-            if not ((df['Name'] == name) & (df['Date'] == today)).any():
-                new_row = {
-                    'Name': name,
-                    'Date': today,
-                    'Time': current_time.strftime("%H:%M:%S")
-                }
-                df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-                df.to_excel(self.attendance_file, index=False)
+            # If confirmation is complete, green; otherwise blue while confirming
+            if self.engine.pending_attendance == name and self.engine.confirmation_remaining() > 0:
+                rect_color = (41, 128, 185)  # Blue
+                text_color = (41, 128, 185)  # Blue
+            else:
+                rect_color = (46, 204, 113)  # Green
+                text_color = (46, 204, 113)  # Green
+        else:
+            # Unknown - red
+            rect_color = (231, 76, 60)  # Red
+            text_color = (231, 76, 60)  # Red
+        
+        # Draw rectangle with thickness based on confidence
+        x, y, w, h = outcome['box']
+        thickness = max(1, min(3, int(best_score * 5))) if best_score > 0.5 else 1
+        cv2.rectangle(color_frame, (x, y), (x+w, y+h), rect_color, thickness)
+        
+        # Create a background for the name text
+        display_name = name
+        if self.engine.pending_attendance == name:
+            # Add confirmation indicator to the name
+            display_name = f"{name} ✓"
+        
+        text_size = cv2.getTextSize(display_name, cv2.FONT_HERSHEY_SIMPLEX, 0.75, 2)[0]
+        cv2.rectangle(color_frame, (x, y-30), (x+text_size[0]+10, y), rect_color, -1)
+        cv2.putText(color_frame, display_name, (x+5, y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255, 255, 255), 2)
+        
+        # Add confidence score
+        score_text = f"Score: {best_score:.2f}"
+        cv2.putText(color_frame, score_text, (x, y+h+20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, text_color, 2)
 
+    def compact_attendance_in_background(self):
+        if self.compaction_thread is None or not self.compaction_thread.is_alive():
+            self.compaction_thread = threading.Thread(target=self.engine.compact_attendance, daemon=True)
+            self.compaction_thread.start()
+    
     def view_attendance(self):
-        if os.path.exists(self.attendance_file):
-            df = pd.read_excel(self.attendance_file)
-            
+        df = self.engine.load_attendance()
+        if not df.empty:
             # Create a dialog to display attendance
             dialog = QWidget(self, Qt.Window)
             dialog.setWindowTitle("Attendance Records")
@@ -777,46 +760,143 @@ class AttendanceSystem(QMainWindow):
         else:
             QMessageBox.warning(self, "Error", "No attendance records found!")
 
+    def show_export_dialog(self):
+        dialog = QWidget(self, Qt.Window)
+        dialog.setWindowTitle("Export Attendance")
+        dialog.setGeometry(200, 200, 400, 500)
+        dialog.setStyleSheet("""
+            QWidget {
+                background-color: #34495e;
+                color: white;
+            }
+            QListWidget, QDateEdit {
+                background-color: #2c3e50;
+                color: white;
+                border: 1px solid #3498db;
+                border-radius: 5px;
+                padding: 5px;
+            }
+            QListWidget::item:selected {
+                background-color: #3498db;
+                color: white;
+            }
+        """)
+        layout = QVBoxLayout(dialog)
+        
+        title = QLabel("Export Attendance")
+        title.setAlignment(Qt.AlignCenter)
+        title.setFont(QFont("Arial", 16, QFont.Bold))
+        layout.addWidget(title)
+        
+        # Date range (inclusive), ignored unless checked
+        date_checkbox = QCheckBox("Only dates in this range:")
+        layout.addWidget(date_checkbox)
+        date_layout = QHBoxLayout()
+        start_edit = QDateEdit(QDate.currentDate().addMonths(-1))
+        end_edit = QDateEdit(QDate.currentDate())
+        for edit in (start_edit, end_edit):
+            edit.setCalendarPopup(True)
+            edit.setDisplayFormat("yyyy-MM-dd")
+            date_layout.addWidget(edit)
+        layout.addLayout(date_layout)
+        
+        # Students to include; no selection exports everybody
+        layout.addWidget(QLabel("Students (none selected = all):"))
+        list_widget = QListWidget()
+        list_widget.setSelectionMode(QAbstractItemView.MultiSelection)
+        list_widget.addItems(sorted(self.engine.known_faces.keys()))
+        layout.addWidget(list_widget)
+        
+        # Sessions to include (only with rosters.json); no selection exports all
+        session_names = [session['name'] for session in self.engine.rosters.sessions]
+        session_list = QListWidget()
+        session_list.setSelectionMode(QAbstractItemView.MultiSelection)
+        session_list.addItems(session_names + ["(no session)"])
+        if session_names:
+            layout.addWidget(QLabel("Sessions (none selected = all):"))
+            layout.addWidget(session_list)
+        
+        export_button = QPushButton("Export...")
+        export_button.setStyleSheet("""
+            QPushButton {
+                background-color: #3498db;
+                color: white;
+                border-radius: 5px;
+                font-weight: bold;
+                padding: 8px;
+                min-height: 30px;
+            }
+            QPushButton:hover {
+                background-color: #2980b9;
+            }
+        """)
+        def export():
+            names = [item.text() for item in list_widget.selectedItems()] or None
+            # Marks taken outside any session are stored with an empty session
+            sessions = [item.text() if item.text() in session_names else ''
+                        for item in session_list.selectedItems()] or None
+            dates = (None, None)
+            if date_checkbox.isChecked():
+                dates = (start_edit.date().toString("yyyy-MM-dd"), end_edit.date().toString("yyyy-MM-dd"))
+            if self.start_export(*dates, names, sessions):
+                dialog.close()
+        export_button.clicked.connect(export)
+        layout.addWidget(export_button)
+        
+        dialog.show()
+    
+    def start_export(self, start_date=None, end_date=None, names=None, sessions=None):
+        path, _ = QFileDialog.getSaveFileName(self, "Export Attendance", "attendance_export.xlsx",
+                                              "Excel (*.xlsx);;CSV (*.csv)")
+        if not path:
+            return False
+        
+        # The export runs on a background thread; its progress is polled from the UI thread
+        self.export = self.engine.export_attendance(path, start_date, end_date, names, sessions)
+        self.export_attendance_button.setEnabled(False)
+        self.export_progress = QProgressDialog("Exporting attendance...", "Cancel", 0, 100, self)
+        self.export_progress.setWindowTitle("Export Attendance")
+        self.export_progress.canceled.connect(self.export.cancel)
+        self.export_progress.show()
+        self.export_timer = QTimer()
+        self.export_timer.timeout.connect(self.poll_export)
+        self.export_timer.start(200)
+        return True
+    
+    def poll_export(self):
+        export = self.export
+        if export.thread.is_alive():
+            self.export_progress.setValue(int(export.progress * 100))
+            self.export_progress.setLabelText(f"Exporting attendance... {export.rows_written} rows")
+            return
+        self.export_timer.stop()
+        self.export_progress.reset()
+        self.export_attendance_button.setEnabled(True)
+        if export.status == 'done':
+            self.statusBar.showMessage(f"Exported {export.rows_written} rows to {export.path}")
+        elif export.status == 'cancelled':
+            self.statusBar.showMessage("Export cancelled")
+        else:
+            QMessageBox.warning(self, "Error", f"Export failed: {export.error}")
+    
+    def start_profiling(self):
+        if self.profiler.start(self.profile_seconds):
+            self.profile_button.setEnabled(False)
+            self.statusBar.showMessage(f"Profiling frame loop for {self.profile_seconds:.0f} seconds...")
+    
+    def profile_finished(self, path, summary):
+        self.profile_button.setEnabled(True)
+        self.statusBar.showMessage(f"Profile saved to {path}")
+        print(summary)
+    
     def toggle_smart_learning(self, state):
-        self.smart_learning_enabled = (state == Qt.Checked)
-        status = "enabled" if self.smart_learning_enabled else "disabled"
+        self.engine.smart_learning_enabled = (state == Qt.Checked)
+        status = "enabled" if self.engine.smart_learning_enabled else "disabled"
         self.status_label.setText(f"Smart Learning: {status.capitalize()}")
-        self.status_label.setStyleSheet(f"color: {'#2ecc71' if self.smart_learning_enabled else '#e74c3c'}; font-weight: bold; font-size: 14px; padding: 5px;")
+        self.status_label.setStyleSheet(f"color: {'#2ecc71' if self.engine.smart_learning_enabled else '#e74c3c'}; font-weight: bold; font-size: 14px; padding: 5px;")
         self.statusBar.showMessage(f"System Ready | Smart Learning: {status.capitalize()}")
         QMessageBox.information(self, "Smart Learning", f"Smart learning has been {status}.")
     
-    def update_face_data(self, name, new_face_sample):
-        if name in self.known_faces:
-            # Check if this sample is sufficiently different from existing samples
-            is_unique = True
-            for existing_sample in self.known_faces[name]:
-                try:
-                    # Compare the new sample with existing ones
-                    result = cv2.matchTemplate(new_face_sample, existing_sample, cv2.TM_CCOEFF_NORMED)
-                    similarity = cv2.minMaxLoc(result)[1]
-                    
-                    # If too similar to an existing sample, don't add it
-                    if similarity > 0.85:  # Slightly lower similarity threshold to capture more variations
-                        is_unique = False
-                        break
-                except Exception as e:
-                    continue
-            
-            # Add the new face sample if it's unique
-            if is_unique:
-                self.known_faces[name].append(new_face_sample)
-                self.save_face_data()
-                print(f"Smart learning: Added new unique face sample for {name}")
-                self.statusBar.showMessage(f"Smart learning: Added new unique face sample for {name} | Total samples: {len(self.known_faces[name])}")
-            else:
-                print(f"Smart learning: Skipped similar face sample for {name}")
-        else:
-            # If this is a new person, initialize with this sample
-            self.known_faces[name] = [new_face_sample]
-            self.save_face_data()
-            print(f"Smart learning: Created new face profile for {name}")
-            self.statusBar.showMessage(f"Smart learning: Created new face profile for {name}")
-    
     def show_about(self):
         # Create a custom about dialog
         dialog = QWidget(self, Qt.Window)
@@ -882,7 +962,7 @@ class AttendanceSystem(QMainWindow):
         feature_layout.addWidget(enhanced_title)
         
         enhanced_features = QLabel(
-            f"• Uses multiple face data points (minimum {self.min_recognition_matches} matches required)\n"
+            f"• Uses multiple face data points (minimum {self.engine.min_recognition_matches} matches required)\n"
             "• Prioritizes face capture before background analysis\n"
             "• Captures 8 different face angles for better recognition\n"
             "• Ensures unique face samples for diverse recognition capability"
@@ -950,7 +1030,7 @@ class AttendanceSystem(QMainWindow):
         dialog.show()
 
     def show_remove_student_dialog(self):
-        if not self.known_faces:
+        if not self.engine.known_faces:
             QMessageBox.warning(self, "Warning", "No students registered in the system!")
             return
 
@@ -1004,7 +1084,7 @@ class AttendanceSystem(QMainWindow):
         
         # Create list widget
         list_widget = QListWidget()
-        list_widget.addItems(self.known_faces.keys())
+        list_widget.addItems(self.engine.known_faces.keys())
         layout.addWidget(list_widget)
         
         # Add instruction
@@ -1072,17 +1152,8 @@ class AttendanceSystem(QMainWindow):
                                    QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
         
         if reply == QMessageBox.Yes:
-            # Remove from known faces
-            if name in self.known_faces:
-                del self.known_faces[name]
-                self.save_face_data()
-                
-                # Remove from attendance records
-                if os.path.exists(self.attendance_file):
-                    df = pd.read_excel(self.attendance_file)
-                    df = df[df['Name'] != name]
-                    df.to_excel(self.attendance_file, index=False)
-                
+            # Remove from known faces and attendance records
+            if self.engine.remove_person(name):
                 QMessageBox.information(self, "Success", f"Student {name} has been removed successfully!")
                 if dialog:
                     dialog.close()
@@ -1092,13 +1163,56 @@ class AttendanceSystem(QMainWindow):
     def closeEvent(self, event):
         if self.camera is not None:
             self.camera.release()
+        if self.frame_bus is not None:
+            self.frame_bus.close()
+        if self.memory_watch is not None:
+            self.memory_watch.close()
+        self.engine.close()
         event.accept()
 
 if __name__ == '__main__':
     print("Launching GUI...")
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--record', metavar='FILE', help="Record camera frames to FILE while running")
+    parser.add_argument('--replay', metavar='FILE', help="Use a recording instead of the camera")
+    parser.add_argument('--fast', action='store_true', help="Replay as fast as possible instead of in real time")
+    parser.add_argument('--profile', type=float, metavar='SECONDS', help="Profile the frame loop for SECONDS after start")
+    parser.add_argument('--sync-dir', help="Shared attendance directory for multiple kiosks")
+    parser.add_argument('--node-id', help="Name of this kiosk in the shared directory (default: host name and process id)")
+    parser.add_argument('--gallery-budget-mb', type=float, help="RAM budget for face data; the rest moves to a cold tier on disk")
+    parser.add_argument('--frame-bus', metavar='NAME', help="Publish camera frames in shared memory for other processes")
+    parser.add_argument('--session', help="Pin a session from rosters.json instead of following the schedule")
+    parser.add_argument('--tile-size', type=int, help="Detect high-resolution frames in tiles of this size (e.g. 640)")
+    parser.add_argument('--detect-workers', type=int, help="Threads for tiled detection (default: CPU count)")
+    parser.add_argument('--gallery-poll', type=float, default=2.0, metavar='SECONDS',
+                        help="How often to check face_data.enc for changes from other processes (0 disables)")
+    parser.add_argument('--crowd', action='store_true',
+                        help="Crowd mode: match all faces of a frame together and give each person to one face only")
+    parser.add_argument('--memory-watch', type=float, metavar='SECONDS',
+                        help="Sample memory use every SECONDS into memory/memory_trend.jsonl")
+    parser.add_argument('--max-rss-mb', type=float, help="With --memory-watch: cap smart learning while RSS is above this")
+    parser.add_argument('--max-samples-per-person', type=int,
+                        help="With --memory-watch: cap on stored face samples per person")
+    args, qt_args = parser.parse_known_args()
+    if args.max_samples_per_person is not None and args.max_samples_per_person < 1:
+        parser.error("--max-samples-per-person must be at least 1")
     try:
-        app = QApplication(sys.argv)
-        window = AttendanceSystem()
+        replay_start = None
+        if args.replay:
+            frame_source = ReplaySource(args.replay, realtime=not args.fast)
+            frames = read_recording(args.replay)
+            replay_start = next(frames)[0]
+            frames.close()
+        elif args.record:
+            frame_source = RecordingSource(CameraSource(0), args.record)
+        else:
+            frame_source = None
+        app = QApplication(sys.argv[:1] + qt_args)
+        window = AttendanceSystem(frame_source, args.gallery_budget_mb, args.profile, args.sync_dir, args.node_id,
+                                  args.frame_bus, args.session, args.tile_size, args.detect_workers,
+                                  args.gallery_poll, args.crowd, args.memory_watch,
+                                  {'rss_mb': args.max_rss_mb, 'samples_per_person': args.max_samples_per_person},
+                                  replay_start)
         window.show()
         sys.exit(app.exec_())
     except Exception as e:
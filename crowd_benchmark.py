@@ -0,0 +1,108 @@
+import argparse
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from attendance_store import AttendanceStore
+from recognition_engine import RecognitionEngine
+
+
+def crowd_frames(known_faces, frames=50, min_faces=5, max_faces=15, repeat_fraction=0.1, seed=0):
+    # Face crops of enrolled persons, min_faces to max_faces per frame, with
+    # random size and brightness. A repeat_fraction of the faces are a second
+    # sample of a person already in the frame (look-alikes, a photo held up),
+    # which a one-to-one assignment must not give the same identity twice.
+    rng = np.random.default_rng(seed)
+    names = sorted(name for name, samples in known_faces.items() if len(samples))
+    if not names:
+        raise ValueError("The crowd benchmark needs enrolled faces")
+    crowds = []
+    for _ in range(frames):
+        count = int(rng.integers(min_faces, max_faces + 1))
+        people = list(rng.choice(names, size=min(count, len(names)), replace=False))
+        repeats = int(round(count * repeat_fraction))
+        people += list(rng.choice(people, size=repeats))
+        crowd = []
+        for name in people:
+            samples = known_faces[name]
+            face = samples[int(rng.integers(len(samples)))]
+            size = int(rng.integers(60, 160))
+            face = cv2.resize(face, (size, size))
+            crowd.append(np.clip(face.astype(np.int16) + int(rng.integers(-20, 21)), 0, 255).astype(np.uint8))
+        crowds.append(crowd)
+    return crowds
+
+
+def duplicates(names):
+    known = [name for name in names if name != "Unknown"]
+    return len(known) - len(set(known))
+
+
+def run_serial(engine, crowds):
+    # The per-face path: one match and one store write per face
+    start = time.perf_counter()
+    writes = 0
+    shared = 0
+    for crowd in crowds:
+        names = []
+        for face in crowd:
+            name = engine.match_faces([face])[0].name
+            names.append(name)
+            writes += engine.mark_attendance(name)
+        shared += duplicates(names)
+    return time.perf_counter() - start, writes, shared
+
+
+def run_batched(engine, crowds):
+    # Crowd mode: one score matrix and one assignment per frame, one store write
+    start = time.perf_counter()
+    writes = 0
+    shared = 0
+    for crowd in crowds:
+        names = [result.name for result in engine.match_faces(crowd, one_to_one=True)]
+        writes += bool(engine.mark_attendance_batch(names))
+        shared += duplicates(names)
+    return time.perf_counter() - start, writes, shared
+
+
+def benchmark(engine, crowds):
+    # Each path marks into its own scratch store so both start from an empty day
+    faces = sum(len(crowd) for crowd in crowds)
+    report = {'frames': len(crowds), 'faces': faces, 'gallery_samples': len(engine.index.matrix)}
+    for label, run in (('serial', run_serial), ('batched', run_batched)):
+        engine.attendance_store = AttendanceStore(tempfile.mkdtemp(prefix="crowd_bench_"), node_id="bench")
+        elapsed, writes, shared = run(engine, crowds)
+        report[f'{label}_faces_per_s'] = round(faces / elapsed, 1)
+        report[f'{label}_ms_per_frame'] = round(elapsed / len(crowds) * 1000, 2)
+        report[f'{label}_store_writes'] = writes
+        report[f'{label}_shared_identities'] = shared
+    report['speedup'] = round(report['batched_faces_per_s'] / report['serial_faces_per_s'], 2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare crowd-mode batched matching with per-face matching")
+    parser.add_argument('--frames', type=int, default=50)
+    parser.add_argument('--min-faces', type=int, default=5)
+    parser.add_argument('--max-faces', type=int, default=15)
+    args = parser.parse_args()
+
+    scratch_dir = tempfile.mkdtemp(prefix="crowd_bench_")
+    engine = RecognitionEngine(attendance_file=os.path.join(scratch_dir, "attendance.xlsx"),
+                               attendance_dir=scratch_dir, event_log=False, event_bus=False)
+    engine.persist_face_data = False
+    engine.smart_learning_enabled = False
+    try:
+        crowds = crowd_frames(engine.known_faces, args.frames, args.min_faces, args.max_faces)
+        report = benchmark(engine, crowds)
+    finally:
+        engine.close()
+    for key, value in report.items():
+        print(f"{key:>26}: {value}")
+
+
+if __name__ == '__main__':
+    main()
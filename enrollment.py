@@ -0,0 +1,83 @@
+from frame_scheduler import box_iou
+
+
+def box_area(box):
+    return box[2] * box[3]
+
+
+def box_contains(box, point):
+    x, y, w, h = box
+    return x <= point[0] < x + w and y <= point[1] < y + h
+
+
+class EnrollmentLane:
+    # Collects the face samples of one new student while every other face in
+    # the frame keeps being recognized. The enrollee is the face the operator
+    # clicked, or else the largest face; once chosen it is followed through
+    # the recognizer's face tracks and held back from matching, so the
+    # samples never mix with other people walking past. The finished samples
+    # are appended to the engine's match index (no rebuild) and are
+    # matchable from the next frame on.
+    def __init__(self, engine, name, required_samples=8):
+        self.engine = engine
+        self.name = name
+        self.required_samples = required_samples
+        self.samples = []
+        self.track_id = None
+        self.last_box = None
+        self.point = None  # Clicked frame position waiting for a face
+        self.track = None  # Enrollee's track in the current frame, None while not in view
+
+    @property
+    def sample_count(self):
+        return len(self.samples)
+
+    @property
+    def complete(self):
+        return len(self.samples) >= self.required_samples
+
+    def click(self, x, y):
+        # Switches the lane to the face at this frame position
+        self.point = (x, y)
+        self.track_id = None
+
+    def choose(self, tracks):
+        # Called by ScheduledRecognizer.process with the current face tracks;
+        # returns the enrollee's track (held back from matching) or None
+        track = None
+        if self.track_id is not None:
+            track = next((t for t in tracks if t.track_id == self.track_id), None)
+        if track is None:
+            track = self.acquire(tracks)
+        if track is not None:
+            self.track_id = track.track_id
+            self.last_box = track.box
+        self.track = track
+        return track
+
+    def acquire(self, tracks):
+        if self.point is not None:
+            clicked = [t for t in tracks if box_contains(t.box, self.point)]
+            if not clicked:
+                return None  # Wait for a face at the clicked position
+            self.point = None
+            return max(clicked, key=lambda t: box_area(t.box))
+        if not tracks:
+            return None
+        if self.last_box is not None:
+            # Enrollee lost for a few detections: the face where they were last seen
+            overlap = max(tracks, key=lambda t: box_iou(t.box, self.last_box))
+            if box_iou(overlap.box, self.last_box) > 0:
+                return overlap
+        return max(tracks, key=lambda t: box_area(t.box))
+
+    def add_sample(self, gray):
+        # Only freshly detected boxes give aligned crops; followed boxes are skipped
+        if self.complete or self.track is None or not self.track.detected:
+            return False
+        x, y, w, h = self.track.box
+        self.samples.append(gray[y:y+h, x:x+w].copy())
+        return True
+
+    def finish(self):
+        self.engine.add_person(self.name, self.samples)
@@ -0,0 +1,307 @@
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+
+EVENT_TYPES = ('attendance', 'smart_learning', 'unknown_face')
+
+
+class Subscriber:
+    # Receives events in batches from its own bounded queue. A full queue
+    # never blocks the publisher: the drop policy decides which event is lost.
+    def __init__(self, name, event_types=None, max_queue=1000, batch_size=50, batch_interval=0.5,
+                 max_retries=5, backoff=0.5, max_backoff=30.0, drop_policy=DROP_OLDEST):
+        self.name = name
+        self.event_types = set(event_types) if event_types else None
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.drop_policy = drop_policy
+        self.queue = None
+
+        self.delivered = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retries = 0
+
+    def attach(self):
+        # Called on the bus loop so the queue belongs to that loop
+        self.queue = asyncio.Queue(self.max_queue)
+
+    def offer(self, event):
+        if self.queue is None:
+            return
+        if self.event_types is not None and event['type'] not in self.event_types:
+            return
+        if self.queue.full():
+            self.dropped += 1
+            if self.drop_policy == DROP_NEWEST:
+                return
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.batch_interval
+        while len(batch) < self.batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        while True:
+            batch = await self.next_batch()
+            await self.deliver_with_retry(batch)
+
+    async def deliver_with_retry(self, batch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.deliver(batch)
+                self.delivered += len(batch)
+                return True
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt == self.max_retries:
+                    self.failed += len(batch)
+                    print(f"Event bus: {self.name} gave up on {len(batch)} events: {e}")
+                    return False
+                self.retries += 1
+                await asyncio.sleep(min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    async def drain(self):
+        # Deliver whatever is still queued, used when the bus stops
+        while self.queue is not None and not self.queue.empty():
+            batch = []
+            while not self.queue.empty() and len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+            await self.deliver_with_retry(batch)
+
+    async def deliver(self, batch):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'queued': self.queue.qsize() if self.queue is not None else 0,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'retries': self.retries,
+        }
+
+
+class FileSink(Subscriber):
+    # Appends one JSON line per event
+    def __init__(self, path, **kwargs):
+        super().__init__(kwargs.pop('name', f"file:{os.path.basename(path)}"), **kwargs)
+        self.path = path
+
+    async def deliver(self, batch):
+        lines = ''.join(json.dumps(event) + '\n' for event in batch)
+        await asyncio.get_running_loop().run_in_executor(None, self.write, lines)
+
+    def write(self, lines):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+
+class WebhookSink(Subscriber):
+    # POSTs each batch as a JSON array
+    def __init__(self, url, timeout=5.0, **kwargs):
+        super().__init__(kwargs.pop('name', f"webhook:{url}"), **kwargs)
+        self.url = url
+        self.timeout = timeout
+
+    async def deliver(self, batch):
+        await asyncio.get_running_loop().run_in_executor(None, self.post, json.dumps(batch).encode('utf-8'))
+
+    def post(self, body):
+        request = urllib.request.Request(self.url, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if response.status >= 300:
+                raise IOError(f"Webhook returned HTTP {response.status}")
+
+
+class SocketSink(Subscriber):
+    # Streams newline-delimited JSON to a TCP listener, reconnecting on failure
+    def __init__(self, host, port, **kwargs):
+        super().__init__(kwargs.pop('name', f"socket:{host}:{port}"), **kwargs)
+        self.host = host
+        self.port = port
+        self.writer = None
+
+    async def deliver(self, batch):
+        if self.writer is None:
+            _, self.writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            self.writer.write(''.join(json.dumps(event) + '\n' for event in batch).encode('utf-8'))
+            await self.writer.drain()
+        except Exception:
+            self.writer.close()
+            self.writer = None
+            raise
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class EventBus:
+    # Runs its own asyncio loop on a background thread. publish() only
+    # schedules a callback on that loop, so the recognition loop never waits
+    # on a subscriber.
+    def __init__(self):
+        self.subscribers = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+        self.tasks = []
+        self.published = 0
+
+    def subscribe(self, subscriber):
+        self.subscribers.append(subscriber)
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.start_subscriber, subscriber)
+        return subscriber
+
+    def start(self):
+        if self.thread is not None:
+            return
+        started = threading.Event()
+        self.thread = threading.Thread(target=self.run_loop, args=(started,), name="event-bus", daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def run_loop(self, started):
+        asyncio.set_event_loop(self.loop)
+        for subscriber in self.subscribers:
+            self.start_subscriber(subscriber)
+        self.loop.call_soon(started.set)
+        self.loop.run_forever()
+
+    def start_subscriber(self, subscriber):
+        subscriber.attach()
+        self.tasks.append(self.loop.create_task(subscriber.run()))
+
+    def publish(self, event_type, **data):
+        if self.thread is None:
+            return
+        event = {'type': event_type, 'timestamp': time.time()}
+        event.update(data)
+        self.published += 1
+        self.loop.call_soon_threadsafe(self.dispatch, event)
+
+    def dispatch(self, event):
+        for subscriber in self.subscribers:
+            subscriber.offer(event)
+
+    def stop(self, timeout=5.0):
+        if self.thread is None:
+            return
+
+        async def shutdown():
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            for subscriber in self.subscribers:
+                await subscriber.drain()
+                await subscriber.close()
+
+        future = asyncio.run_coroutine_threadsafe(shutdown(), self.loop)
+        try:
+            future.result(timeout)
+        except Exception as e:
+            print(f"Event bus: shutdown incomplete: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+        self.thread = None
+
+    def stats(self):
+        return {'published': self.published, 'subscribers': [s.stats() for s in self.subscribers]}
+
+
+SINK_TYPES = {'file': FileSink, 'webhook': WebhookSink, 'socket': SocketSink}
+
+
+def load_event_bus(config_file):
+    # Builds and starts a bus from a JSON config such as
+    # {"subscribers": [{"type": "file", "path": "events.jsonl"},
+    #                  {"type": "webhook", "url": "http://127.0.0.1:8090/events", "batch_size": 20}]}
+    # Returns None when the config file does not exist.
+    if not os.path.exists(config_file):
+        return None
+    try:
+        with open(config_file, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        bus = EventBus()
+        for options in config.get('subscribers', []):
+            options = dict(options)
+            sink = SINK_TYPES[options.pop('type')]
+            if sink is FileSink and not os.path.isabs(options['path']):
+                options['path'] = os.path.join(os.path.dirname(config_file), options['path'])
+            bus.subscribe(sink(**options))
+        bus.start()
+        return bus
+    except Exception as e:
+        print(f"Error loading event bus config: {e}")
+        return None
+
+
+class StandInWebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        events = json.loads(body)
+        types = {}
+        for event in events:
+            types[event['type']] = types.get(event['type'], 0) + 1
+        print(f"Webhook stand-in: received {len(events)} events {types}")
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_webhook_standin(port=8090, delay=0.0):
+    # Local stand-in for the LMS / door display endpoint. A delay simulates
+    # a slow consumer.
+    server = HTTPServer(('127.0.0.1', port), StandInWebhookHandler)
+    server.delay = delay
+    print(f"Webhook stand-in listening on http://127.0.0.1:{port}/events")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Attendance event bus tools")
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--delay', type=float, default=0.0, help="Seconds to stall each request")
+    args = parser.parse_args()
+    serve_webhook_standin(args.port, args.delay)
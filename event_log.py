@@ -0,0 +1,313 @@
+import argparse
+import glob
+import gzip
+import json
+import os
+import struct
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+# One fixed-size record per recognition event. Strings (camera, candidate)
+# are stored as ids into a table that is written along with the records.
+RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('kind', 'u1'),
+    ('camera', '<u2'),
+    ('track', '<i4'),
+    ('candidate', '<u4'),
+    ('score', '<f4'),
+    ('latency_ms', '<f4'),
+])
+
+KINDS = ['marked', 'already_marked', 'recognized', 'unknown', 'confirmation_reset', 'confirmation_lost',
+         'learning_added', 'learning_skipped', 'learning_created']
+KIND_CODES = {kind: code for code, kind in enumerate(KINDS)}
+
+# File format: gzip stream of blocks, each a BLOCK_HEADER (JSON length,
+# record count), a JSON header with the string ids first used in this file
+# ({"strings": [[id, text], ...]}), then the raw records
+BLOCK_HEADER = struct.Struct('<II')
+
+
+class EventLog:
+    # Structured log of recognition decisions. record() writes one row of a
+    # preallocated numpy ring buffer in place (no per-event objects are
+    # kept); a background thread flushes new rows every flush_interval
+    # seconds to gzip files that rotate at max_file_bytes, keeping the last
+    # max_files per camera. If the flusher falls more than a ring behind,
+    # the oldest unflushed events are overwritten and counted as dropped.
+    def __init__(self, log_dir, camera="camera", capacity=65536, flush_interval=1.0,
+                 max_file_bytes=4 * 2**20, max_files=50):
+        self.log_dir = log_dir
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self.buffer = np.zeros(capacity, RECORD_DTYPE)
+        self.lock = threading.Lock()
+        self.head = 0  # Events recorded so far; the next one goes to head % capacity
+        self.flushed = 0  # Events handed to the flusher so far
+        self.dropped = 0
+
+        self.strings = []  # Id -> text
+        self.string_ids = {}
+        self.written_strings = 0  # Strings already in the current file's headers
+        self.camera = camera
+        self.camera_id = self.intern(camera)
+
+        self.file = None
+        self.path = None
+        self.files_written = 0
+        self.bytes_written = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="event-log", daemon=True)
+        self.thread.start()
+
+    def intern(self, text):
+        string_id = self.string_ids.get(text)
+        if string_id is None:
+            with self.lock:
+                string_id = self.string_ids.setdefault(text, len(self.strings))
+                if string_id == len(self.strings):
+                    self.strings.append(text)
+        return string_id
+
+    def record(self, kind, candidate, score=float('nan'), track=-1, latency_ms=float('nan')):
+        code = KIND_CODES[kind]
+        candidate_id = self.string_ids.get(candidate)
+        if candidate_id is None:
+            candidate_id = self.intern(candidate)
+        with self.lock:
+            self.buffer[self.head % self.capacity] = (time.time(), code, self.camera_id, track,
+                                                      candidate_id, score, latency_ms)
+            self.head += 1
+
+    def take(self):
+        # Copies the rows recorded since the last call, oldest first
+        with self.lock:
+            head = self.head
+            if head - self.flushed > self.capacity:
+                self.dropped += head - self.flushed - self.capacity
+                self.flushed = head - self.capacity
+            start, end = self.flushed % self.capacity, head % self.capacity
+            if head == self.flushed:
+                rows = self.buffer[:0].copy()
+            elif start < end:
+                rows = self.buffer[start:end].copy()
+            else:
+                rows = np.concatenate((self.buffer[start:], self.buffer[:end]))
+            self.flushed = head
+            strings = list(self.strings)
+        return rows, strings
+
+    def recent(self, count=20):
+        # The last events still in memory, newest last, as dicts
+        with self.lock:
+            count = min(count, self.head, self.capacity)
+            rows = self.buffer[(self.head - count + np.arange(count)) % self.capacity].copy()
+            strings = list(self.strings)
+        return [row_dict(row, strings) for row in rows]
+
+    def run(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        rows, strings = self.take()
+        if len(rows) == 0:
+            return
+        try:
+            if self.file is None:
+                self.open_file()
+            header = json.dumps({'strings': [[i, strings[i]] for i in range(self.written_strings, len(strings))]})
+            header = header.encode('utf-8')
+            self.file.write(BLOCK_HEADER.pack(len(header), len(rows)) + header + rows.tobytes())
+            self.file.flush()  # Sync flush: the query tool can read the file while it grows
+            self.written_strings = len(strings)
+            if os.path.getsize(self.path) >= self.max_file_bytes:
+                self.close_file()
+        except Exception as e:
+            print(f"Event log: could not write {len(rows)} events: {e}")
+
+    def open_file(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        self.path = os.path.join(self.log_dir, f"events-{self.camera}-{stamp}-{os.getpid()}.log.gz")
+        self.file = gzip.open(self.path, "wb", compresslevel=6)
+        self.written_strings = 0
+        self.files_written += 1
+        self.remove_old_files()
+
+    def close_file(self):
+        self.file.close()
+        self.bytes_written += os.path.getsize(self.path)
+        self.file = None
+
+    def remove_old_files(self):
+        files = sorted(glob.glob(os.path.join(self.log_dir, f"events-{self.camera}-*.log.gz")), key=os.path.getmtime)
+        for path in files[:max(len(files) - self.max_files, 0)]:
+            os.remove(path)
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        if self.file is not None:
+            self.close_file()
+
+    def stats(self):
+        return {
+            'recorded': self.head,
+            'flushed': self.flushed,
+            'dropped': self.dropped,
+            'capacity': self.capacity,
+            'files_written': self.files_written,
+        }
+
+
+def row_dict(row, strings):
+    return {
+        'timestamp': float(row['timestamp']),
+        'kind': KINDS[row['kind']],
+        'camera': strings[row['camera']],
+        'track': int(row['track']),
+        'candidate': strings[row['candidate']],
+        'score': float(row['score']),
+        'latency_ms': float(row['latency_ms']),
+    }
+
+
+def read_log_file(path):
+    # Yields (rows, strings) per block; stops quietly at the end of a file
+    # that is still being written
+    strings = {}
+    with gzip.open(path, "rb") as f:
+        while True:
+            try:
+                head = f.read(BLOCK_HEADER.size)
+                if len(head) < BLOCK_HEADER.size:
+                    return
+                header_size, count = BLOCK_HEADER.unpack(head)
+                header = json.loads(f.read(header_size).decode('utf-8'))
+                data = f.read(count * RECORD_DTYPE.itemsize)
+            except EOFError:
+                return
+            if len(data) < count * RECORD_DTYPE.itemsize:
+                return
+            strings.update((i, text) for i, text in header['strings'])
+            yield np.frombuffer(data, RECORD_DTYPE), strings
+
+
+def query(log_dir, since=None, until=None, kinds=None, candidates=None, cameras=None, track=None,
+          min_score=None, limit=None):
+    # Matching events from all log files, oldest first, as dicts
+    events = []
+    kind_codes = [KIND_CODES[kind] for kind in kinds] if kinds else None
+    for path in sorted(glob.glob(os.path.join(log_dir, "events-*.log.gz"))):
+        if since is not None and os.path.getmtime(path) < since:
+            continue  # Nothing in a file is newer than its last write
+        for rows, strings in read_log_file(path):
+            mask = np.ones(len(rows), dtype=bool)
+            if since is not None:
+                mask &= rows['timestamp'] >= since
+            if until is not None:
+                mask &= rows['timestamp'] < until
+            if kind_codes is not None:
+                mask &= np.isin(rows['kind'], kind_codes)
+            if track is not None:
+                mask &= rows['track'] == track
+            if min_score is not None:
+                mask &= rows['score'] >= min_score
+            for row in rows[mask]:
+                event = row_dict(row, strings)
+                if candidates is not None and event['candidate'] not in candidates:
+                    continue
+                if cameras is not None and event['camera'] not in cameras:
+                    continue
+                events.append(event)
+    events.sort(key=lambda event: event['timestamp'])
+    return events[-limit:] if limit else events
+
+
+def summarize(events):
+    kinds = {}
+    for event in events:
+        kinds[event['kind']] = kinds.get(event['kind'], 0) + 1
+    latency = np.array([event['latency_ms'] for event in events if not np.isnan(event['latency_ms'])])
+    summary = {'events': len(events), 'kinds': kinds}
+    if len(latency):
+        summary['latency_p50_ms'] = round(float(np.percentile(latency, 50)), 2)
+        summary['latency_p95_ms'] = round(float(np.percentile(latency, 95)), 2)
+    return summary
+
+
+def benchmark(events=200000, log_dir=None):
+    # Cost of record() on the calling thread, with the flusher running
+    import tempfile
+
+    log_dir = log_dir or tempfile.mkdtemp(prefix="event_log_bench_")
+    log = EventLog(log_dir, camera="bench", capacity=max(events, 65536))  # A burst, not a frame rate
+    names = [f"student{i:03d}" for i in range(200)]
+    start = time.perf_counter()
+    for i in range(events):
+        log.record('recognized', names[i % 200], 0.8, i % 16, 4.2)
+    elapsed = time.perf_counter() - start
+    log.close()
+    stats = log.stats()
+    print(f"{events} events in {elapsed:.2f}s: {elapsed / events * 1e6:.2f} us/event on the recording thread")
+    print(f"Flushed {stats['flushed']}, dropped {stats['dropped']}, {log.bytes_written / 2**10:.0f} KiB on disk "
+          f"({log.bytes_written / max(stats['flushed'], 1):.1f} bytes/event) in {log_dir}")
+
+
+def split_list(text):
+    return [item.strip() for item in text.split(',')] if text else None
+
+
+def parse_time(text):
+    return datetime.strptime(text, "%Y-%m-%d %H:%M:%S" if ':' in text else "%Y-%m-%d").timestamp()
+
+
+def main():
+    default_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "event_logs")
+    parser = argparse.ArgumentParser(description="Recognition event log tools")
+    sub = parser.add_subparsers(dest='command', required=True)
+    find = sub.add_parser('query', help="Print logged events")
+    find.add_argument('--dir', default=default_dir)
+    find.add_argument('--since', help="YYYY-MM-DD or YYYY-MM-DD HH:MM:SS")
+    find.add_argument('--until', help="YYYY-MM-DD or YYYY-MM-DD HH:MM:SS")
+    find.add_argument('--kind', help=f"Comma-separated kinds: {', '.join(KINDS)}")
+    find.add_argument('--name', help="Comma-separated candidates")
+    find.add_argument('--camera', help="Comma-separated cameras (kiosk node ids)")
+    find.add_argument('--track', type=int)
+    find.add_argument('--min-score', type=float)
+    find.add_argument('--limit', type=int, help="Only the last N events")
+    find.add_argument('--summary', action='store_true', help="Counts per kind and latency percentiles")
+    find.add_argument('--json', action='store_true', help="One JSON object per line")
+    bench = sub.add_parser('bench', help="Measure the recording overhead")
+    bench.add_argument('--events', type=int, default=200000)
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        benchmark(args.events)
+        return
+
+    events = query(args.dir, parse_time(args.since) if args.since else None,
+                   parse_time(args.until) if args.until else None, split_list(args.kind), split_list(args.name),
+                   split_list(args.camera), args.track, args.min_score, args.limit)
+    if args.summary:
+        print(json.dumps(summarize(events), indent=2))
+        return
+    for event in events:
+        if args.json:
+            print(json.dumps(event))
+        else:
+            when = datetime.fromtimestamp(event['timestamp']).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+            print(f"{when} {event['camera']:<12} {event['kind']:<18} track {event['track']:>4} "
+                  f"{event['candidate']:<20} score {event['score']:.2f} {event['latency_ms']:6.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+import argparse
+import json
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import cv2
+import numpy as np
+
+# Shared-memory layout: a JSON description of the planes (padded to
+# LAYOUT_SIZE bytes) so other processes can attach by name, then the header
+# (last committed sequence number, per-slot sequence numbers, per-slot
+# timestamps), then the slots of each plane.
+LAYOUT_SIZE = 1024
+LAYOUT_HEADER = struct.Struct('<I')
+
+POLICY_LATEST = 'latest'  # Always the newest frame; everything in between is dropped
+POLICY_SEQUENTIAL = 'sequential'  # Every frame in order while the reader keeps up
+
+
+def open_shared(name):
+    # Attaches to an existing segment. Before Python 3.13 the resource
+    # tracker of an attaching process unlinks the segment when that process
+    # exits, which would pull the bus from under the kiosk.
+    shm = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def camera_planes(shape):
+    # Planes for a BGR camera frame and its grayscale version
+    return {'color': (shape, 'uint8'), 'gray': (shape[:2], 'uint8')}
+
+
+class Frame:
+    # Read-only views of one committed slot. The views stay valid until the
+    # writer comes round to the slot again; valid() tells whether it has.
+    def __init__(self, bus, seq, timestamp, planes):
+        self.bus = bus
+        self.seq = seq
+        self.timestamp = timestamp
+        self.planes = planes
+
+    def __getitem__(self, key):
+        return self.planes[key]
+
+    def valid(self):
+        return int(self.bus.slot_seqs[self.seq % self.bus.slots]) == self.seq
+
+
+class FrameBus:
+    # Ring buffer of preallocated frame slots with named planes (e.g. color
+    # and gray). A single writer fills a slot in place and commits it;
+    # readers get read-only views, so a frame is written once however many
+    # consumers there are. With a name the slots live in
+    # multiprocessing.shared_memory and other processes can attach().
+    def __init__(self, planes, slots=4, name=None, create=True):
+        self.planes = {key: (tuple(shape), np.dtype(dtype).str) for key, (shape, dtype) in planes.items()}
+        self.slots = slots
+        self.name = name
+        self.owner = create
+
+        header_size = 8 * (1 + 2 * slots)
+        plane_sizes = {key: int(np.prod(shape)) * np.dtype(dtype).itemsize for key, (shape, dtype) in self.planes.items()}
+        size = LAYOUT_SIZE + header_size + slots * sum(plane_sizes.values())
+        if name is None:
+            self.shm = None
+            buffer = memoryview(bytearray(size))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size) if create else open_shared(name)
+            buffer = self.shm.buf
+        if create:
+            layout = json.dumps({'slots': slots, 'planes': self.planes}).encode('utf-8')
+            buffer[:LAYOUT_HEADER.size + len(layout)] = LAYOUT_HEADER.pack(len(layout)) + layout
+
+        self.header = np.ndarray((1 + slots,), np.int64, buffer, LAYOUT_SIZE)
+        self.latest = self.header[:1]
+        self.slot_seqs = self.header[1:]
+        self.timestamps = np.ndarray((slots,), np.float64, buffer, LAYOUT_SIZE + 8 * (1 + slots))
+        self.arrays = {}
+        self.views = {}
+        offset = LAYOUT_SIZE + header_size
+        for key, (shape, dtype) in self.planes.items():
+            self.arrays[key] = np.ndarray((slots,) + shape, dtype, buffer, offset)
+            self.views[key] = self.arrays[key].view()
+            self.views[key].flags.writeable = False
+            offset += slots * plane_sizes[key]
+        if create:
+            self.header[:] = -1
+
+        self.writing = None
+        self.frames_written = 0
+        self.bytes_copied = 0  # Bytes copied into slots by write(); zero when sources fill slots in place
+
+    @classmethod
+    def attach(cls, name):
+        shm = open_shared(name)
+        try:
+            size = LAYOUT_HEADER.unpack_from(shm.buf)[0]
+            layout = json.loads(bytes(shm.buf[LAYOUT_HEADER.size:LAYOUT_HEADER.size + size]).decode('utf-8'))
+        finally:
+            shm.close()
+        return cls(layout['planes'], layout['slots'], name, create=False)
+
+    # Writer
+
+    def claim(self):
+        # Writable views of the next slot; readers see the slot as invalid until commit()
+        seq = int(self.latest[0]) + 1
+        self.slot_seqs[seq % self.slots] = -1
+        self.writing = seq
+        return {key: array[seq % self.slots] for key, array in self.arrays.items()}
+
+    def commit(self, timestamp=None):
+        seq = self.writing
+        self.writing = None
+        self.timestamps[seq % self.slots] = time.time() if timestamp is None else timestamp
+        self.slot_seqs[seq % self.slots] = seq
+        self.latest[0] = seq
+        self.frames_written += 1
+        return self.frame(seq)
+
+    def write(self, timestamp=None, **planes):
+        slot = self.claim()
+        for key, value in planes.items():
+            np.copyto(slot[key], value)
+            self.bytes_copied += value.nbytes
+        return self.commit(timestamp)
+
+    def capture(self, source):
+        # Reads the next camera frame straight into a slot when the source
+        # supports read_into(), otherwise copies it in, then fills the gray
+        # plane. Returns the committed Frame, or None when the source has no
+        # frame or its frame size no longer matches the bus.
+        slot = self.claim()
+        color = slot['color']
+        if hasattr(source, 'read_into'):
+            ret, frame = source.read_into(color)
+        else:
+            ret, frame = source.read()
+        if not ret or frame.shape != color.shape:
+            self.writing = None
+            return None
+        if not np.may_share_memory(frame, color):
+            np.copyto(color, frame)
+            self.bytes_copied += frame.nbytes
+        cv2.cvtColor(color, cv2.COLOR_BGR2GRAY, dst=slot['gray'])
+        return self.commit()
+
+    # Readers
+
+    def frame(self, seq):
+        i = seq % self.slots
+        return Frame(self, seq, float(self.timestamps[i]), {key: view[i] for key, view in self.views.items()})
+
+    def reader(self, policy=POLICY_LATEST):
+        return FrameReader(self, policy)
+
+    def stats(self):
+        return {
+            'slots': self.slots,
+            'frames_written': self.frames_written,
+            'bytes_copied': self.bytes_copied,
+            'bytes_copied_per_frame': self.bytes_copied / max(self.frames_written, 1),
+            'slot_bytes': sum(array[0].nbytes for array in self.arrays.values()),
+        }
+
+    def close(self):
+        # Frames handed out earlier must not be used after this
+        self.arrays = self.views = None
+        self.header = self.latest = self.slot_seqs = self.timestamps = None
+        if self.shm is not None:
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+            self.shm = None
+
+
+class FrameReader:
+    # One consumer's position in the bus. The writer never waits: a
+    # sequential reader that falls more than a ring behind skips to the
+    # oldest slot that is still safe and counts the frames it missed.
+    def __init__(self, bus, policy=POLICY_LATEST):
+        if policy not in (POLICY_LATEST, POLICY_SEQUENTIAL):
+            raise ValueError(f"Unknown frame bus policy: {policy}")
+        self.bus = bus
+        self.policy = policy
+        self.next_seq = max(int(bus.latest[0]), 0)
+        self.frames_read = 0
+        self.dropped = 0
+
+    def read(self):
+        # The next frame under the reader's policy, or None if there is no new frame
+        latest = int(self.bus.latest[0])
+        if latest < self.next_seq:
+            return None
+        if self.policy == POLICY_LATEST:
+            seq = latest
+        else:
+            # The writer's next claim overwrites slot latest + 1 - slots
+            seq = max(self.next_seq, latest - self.bus.slots + 2)
+        if int(self.bus.slot_seqs[seq % self.bus.slots]) != seq:
+            seq = int(self.bus.latest[0])  # Lapped while reading the header
+        self.dropped += seq - self.next_seq
+        self.next_seq = seq + 1
+        self.frames_read += 1
+        return self.bus.frame(seq)
+
+    def stats(self):
+        return {'policy': self.policy, 'frames_read': self.frames_read, 'dropped': self.dropped}
+
+
+def watch(name, policy, seconds):
+    # Attaches to a running kiosk's bus and reports what a consumer receives
+    bus = FrameBus.attach(name)
+    reader = bus.reader(policy)
+    start = time.perf_counter()
+    report = start + 1.0
+    latency = []
+    frame = None
+    try:
+        while time.perf_counter() - start < seconds:
+            frame = reader.read()
+            if frame is None:
+                time.sleep(0.002)
+                continue
+            latency.append(time.time() - frame.timestamp)
+            if time.perf_counter() >= report:
+                stats = reader.stats()
+                print(f"frames {stats['frames_read']} dropped {stats['dropped']} "
+                      f"latency {np.mean(latency) * 1000:.1f} ms shape {frame['color'].shape}")
+                latency = []
+                report += 1.0
+    finally:
+        frame = None
+        bus.close()
+
+
+def benchmark(frames=300, shape=(480, 640, 3), readers=3):
+    # Bytes copied per frame to hand one camera frame to several consumers:
+    # a private copy each (what update_frame did per consumer) versus one
+    # bus slot with read-only views
+    source = np.random.default_rng(0).integers(0, 256, shape, dtype=np.uint8)
+    start = time.perf_counter()
+    copied = 0
+    for _ in range(frames):
+        for _ in range(readers):
+            copied += source.copy().nbytes
+        copied += cv2.cvtColor(source, cv2.COLOR_BGR2GRAY).nbytes * readers
+    copy_time = time.perf_counter() - start
+
+    bus = FrameBus(camera_planes(shape))
+    consumers = [bus.reader(POLICY_SEQUENTIAL) for _ in range(readers)]
+    start = time.perf_counter()
+    for _ in range(frames):
+        slot = bus.claim()
+        np.copyto(slot['color'], source)  # Stands in for the camera filling the slot
+        cv2.cvtColor(slot['color'], cv2.COLOR_BGR2GRAY, dst=slot['gray'])
+        bus.commit()
+        for consumer in consumers:
+            consumer.read()
+    bus_time = time.perf_counter() - start
+    print(f"Private copies: {copied / frames / 1024:.0f} KiB copied per frame, {copy_time / frames * 1000:.2f} ms/frame")
+    print(f"Frame bus:      {bus.stats()['bytes_copied_per_frame'] / 1024:.0f} KiB copied per frame, "
+          f"{bus_time / frames * 1000:.2f} ms/frame ({readers} readers, dropped {sum(c.dropped for c in consumers)})")
+    bus.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame bus tools")
+    sub = parser.add_subparsers(dest='command', required=True)
+    run = sub.add_parser('watch', help="Attach to a kiosk started with --frame-bus NAME")
+    run.add_argument('name')
+    run.add_argument('--policy', choices=[POLICY_LATEST, POLICY_SEQUENTIAL], default=POLICY_SEQUENTIAL)
+    run.add_argument('--seconds', type=float, default=10.0)
+    bench = sub.add_parser('bench', help="Compare per-consumer copies with the bus")
+    bench.add_argument('--frames', type=int, default=300)
+    bench.add_argument('--readers', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == 'watch':
+        watch(args.name, args.policy, args.seconds)
+    else:
+        benchmark(args.frames, readers=args.readers)
+
+
+if __name__ == '__main__':
+    main()
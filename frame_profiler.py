@@ -0,0 +1,84 @@
+import cProfile
+import io
+import os
+import pstats
+import signal
+import time
+from datetime import datetime
+
+
+class FrameProfiler:
+    # Profiles the wrapped frame callback (and everything it calls) for a
+    # fixed window, then writes a pstats file and a short text summary.
+    # While no capture is running the wrapper costs one attribute check.
+    def __init__(self, output_dir, top=20, on_finished=None):
+        self.output_dir = output_dir
+        self.top = top
+        self.on_finished = on_finished
+        self.active = False
+        self.requested = None  # Window length asked for from a signal handler
+        self.profile = None
+        self.end_time = None
+        self.frames = 0
+
+    def wrap(self, callback):
+        def profiled():
+            if not self.active and self.requested is None:
+                return callback()
+            return self.run(callback)
+        return profiled
+
+    def start(self, seconds=10.0):
+        if self.active:
+            return False
+        self.profile = cProfile.Profile()
+        self.end_time = time.perf_counter() + seconds
+        self.frames = 0
+        self.active = True
+        print(f"Profiling the frame loop for {seconds:g} s")
+        return True
+
+    def request(self, seconds=10.0):
+        # Safe to call from a signal handler: the capture starts with the next frame
+        self.requested = seconds
+
+    def install_signal(self, seconds=10.0, signum=None):
+        # SIGUSR1 starts a capture (POSIX only)
+        signum = signum if signum is not None else getattr(signal, 'SIGUSR1', None)
+        if signum is None:
+            return False
+        signal.signal(signum, lambda *_: self.request(seconds))
+        return True
+
+    def run(self, callback):
+        if self.requested is not None:
+            self.start(self.requested)
+            self.requested = None
+        self.profile.enable()
+        try:
+            return callback()
+        finally:
+            self.profile.disable()
+            self.frames += 1
+            if time.perf_counter() >= self.end_time:
+                self.finish()
+
+    def finish(self):
+        self.active = False
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, datetime.now().strftime("profile_%Y%m%d_%H%M%S"))
+        self.profile.dump_stats(base + ".pstats")
+
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stream.write(f"{self.frames} frames profiled\n")
+        stats.sort_stats('cumulative').print_stats(self.top)
+        summary = stream.getvalue()
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write(summary)
+        self.profile = None
+
+        print(f"Profile written to {base}.pstats ({self.frames} frames)")
+        if self.on_finished is not None:
+            self.on_finished(base + ".pstats", summary)
+        return base + ".pstats"
@@ -0,0 +1,232 @@
+import time
+
+import cv2
+
+# Quality levels from best to cheapest. detect_every / match_every: run
+# detection / matching on every n-th tick (other ticks only follow the
+# tracked faces). detect_scale: frame scale for the cascade. max_matches:
+# faces matched per tick, unidentified faces first.
+QUALITY_LEVELS = [
+    {'name': 'full', 'detect_every': 1, 'match_every': 1, 'detect_scale': 1.0, 'max_matches': None},
+    {'name': 'reduced', 'detect_every': 1, 'match_every': 1, 'detect_scale': 0.75, 'max_matches': 6},
+    {'name': 'low', 'detect_every': 2, 'match_every': 1, 'detect_scale': 0.5, 'max_matches': 3},
+    {'name': 'minimal', 'detect_every': 4, 'match_every': 2, 'detect_scale': 0.5, 'max_matches': 1},
+]
+
+
+def box_iou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    iw = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    ih = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = iw * ih
+    union = aw * ah + bw * bh - inter
+    return inter / union if union > 0 else 0.0
+
+
+class Track:
+    def __init__(self, track_id, box, gray):
+        self.track_id = track_id
+        self.box = box
+        self.template = gray[box[1]:box[1]+box[3], box[0]:box[0]+box[2]].copy()
+        self.name = None  # Identity from the last match, None while unidentified
+        self.score = 0.0
+        self.best_name = "Unknown"
+        self.last_matched = -1  # Tick of the last match
+        self.missed = 0  # Detections in a row that did not see this face
+        self.detected = True  # Box comes from this tick's detection (not followed)
+
+
+class FaceTracker:
+    # Keeps face boxes and identities between detections. Detected boxes are
+    # associated by overlap; between detections each face is followed by
+    # template matching in a window around its last position.
+    def __init__(self, iou_threshold=0.3, max_missed=2, search_margin=0.5, min_follow_score=0.5):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.search_margin = search_margin
+        self.min_follow_score = min_follow_score
+        self.tracks = []
+        self.next_id = 0
+
+    def update(self, gray, faces):
+        unmatched = list(range(len(self.tracks)))
+        tracks = []
+        for face in faces:
+            box = tuple(int(v) for v in face)
+            best, best_iou = None, self.iou_threshold
+            for i in unmatched:
+                iou = box_iou(self.tracks[i].box, box)
+                if iou >= best_iou:
+                    best, best_iou = i, iou
+            if best is None:
+                track = Track(self.next_id, box, gray)
+                self.next_id += 1
+            else:
+                unmatched.remove(best)
+                track = self.tracks[best]
+                track.box = box
+                track.template = gray[box[1]:box[1]+box[3], box[0]:box[0]+box[2]].copy()
+                track.missed = 0
+                track.detected = True
+            tracks.append(track)
+        for i in unmatched:
+            track = self.tracks[i]
+            track.missed += 1
+            track.detected = False
+            if track.missed <= self.max_missed:
+                tracks.append(track)
+        self.tracks = tracks
+
+    def follow(self, gray):
+        frame_h, frame_w = gray.shape[:2]
+        tracks = []
+        for track in self.tracks:
+            x, y, w, h = track.box
+            mx, my = int(w * self.search_margin), int(h * self.search_margin)
+            x0, y0 = max(0, x - mx), max(0, y - my)
+            x1, y1 = min(frame_w, x + w + mx), min(frame_h, y + h + my)
+            window = gray[y0:y1, x0:x1]
+            if window.shape[0] < h or window.shape[1] < w:
+                continue
+            result = cv2.matchTemplate(window, track.template, cv2.TM_CCOEFF_NORMED)
+            _, score, _, (dx, dy) = cv2.minMaxLoc(result)
+            if score < self.min_follow_score:
+                continue  # Face left or changed too much; the next detection picks it up
+            track.box = (x0 + dx, y0 + dy, w, h)
+            track.detected = False
+            tracks.append(track)
+        self.tracks = tracks
+
+    def match_order(self):
+        # Unidentified faces first, then identified faces matched longest ago
+        return sorted(self.tracks, key=lambda t: (t.name is not None, t.last_matched))
+
+
+class FrameScheduler:
+    # Per-frame time budget. Steps down a quality level after consecutive
+    # budget overruns and back up once frames stay well under budget.
+    def __init__(self, budget_ms=30.0, overrun_limit=3, recovery_frames=30, recovery_ratio=0.6):
+        self.budget = budget_ms / 1000.0
+        self.overrun_limit = overrun_limit
+        self.recovery_frames = recovery_frames
+        self.recovery_ratio = recovery_ratio
+        self.level = 0
+        self.tick = 0
+        self.frame_start = None
+        self.average = 0.0  # Exponential moving average of frame time
+
+        self.overruns = 0
+        self.consecutive_overruns = 0
+        self.calm_frames = 0
+        self.last_frame_time = 0.0
+
+    @property
+    def quality(self):
+        return QUALITY_LEVELS[self.level]
+
+    def plan(self):
+        self.frame_start = time.perf_counter()
+        quality = self.quality
+        return {
+            'detect': self.tick % quality['detect_every'] == 0,
+            'match': self.tick % quality['match_every'] == 0,
+            'detect_scale': quality['detect_scale'],
+            'max_matches': quality['max_matches'],
+        }
+
+    def finish(self):
+        elapsed = time.perf_counter() - self.frame_start
+        self.tick += 1
+        self.last_frame_time = elapsed
+        self.average = elapsed if self.tick == 1 else 0.8 * self.average + 0.2 * elapsed
+
+        if elapsed > self.budget:
+            self.overruns += 1
+            self.consecutive_overruns += 1
+            self.calm_frames = 0
+            if self.consecutive_overruns >= self.overrun_limit and self.level < len(QUALITY_LEVELS) - 1:
+                self.set_level(self.level + 1)
+        else:
+            self.consecutive_overruns = 0
+            if self.average < self.budget * self.recovery_ratio:
+                self.calm_frames += 1
+                if self.calm_frames >= self.recovery_frames and self.level > 0:
+                    self.set_level(self.level - 1)
+            else:
+                self.calm_frames = 0
+        return elapsed
+
+    def set_level(self, level):
+        direction = "down" if level > self.level else "up"
+        self.level = level
+        self.consecutive_overruns = 0
+        self.calm_frames = 0
+        print(f"Frame scheduler: stepping {direction} to '{self.quality['name']}' "
+              f"(average {self.average * 1000:.1f} ms, budget {self.budget * 1000:.0f} ms)")
+
+    def stats(self):
+        return {
+            'quality': self.quality['name'],
+            'level': self.level,
+            'frames': self.tick,
+            'overruns': self.overruns,
+            'average_ms': self.average * 1000,
+            'last_ms': self.last_frame_time * 1000,
+            'budget_ms': self.budget * 1000,
+        }
+
+
+class ScheduledRecognizer:
+    # Runs the engine under a FrameScheduler: each tick does full detection
+    # or only follows tracked faces, then matches as many faces as the
+    # quality level allows. Faces not matched this tick keep the identity of
+    # their track. Tracks the last detection missed are kept only to pick
+    # the face up again; they are neither matched nor drawn (their box may
+    # hold background by now). hold(tracks) may pick one track to leave out
+    # of matching and of the outcomes (the face being enrolled).
+    def __init__(self, engine, budget_ms=30.0):
+        self.engine = engine
+        self.scheduler = FrameScheduler(budget_ms)
+        self.tracker = FaceTracker()
+
+    def process(self, gray, hold=None):
+        plan = self.scheduler.plan()
+        if plan['detect']:
+            faces = self.engine.detect_faces(gray, plan['detect_scale'])
+            self.tracker.update(gray, faces)
+            if len(faces) == 0 and all(t.missed for t in self.tracker.tracks):
+                if hold is not None:
+                    hold([])
+                # Lets the engine reset a pending confirmation
+                return self.engine.recognize_faces(gray, [])
+        else:
+            self.tracker.follow(gray)
+
+        held = hold(self.tracker.tracks) if hold is not None else None
+        to_match = []
+        if plan['match']:
+            to_match = [t for t in self.tracker.match_order() if t is not held and not t.missed][:plan['max_matches']]
+        outcomes = self.engine.recognize_faces(gray, [t.box for t in to_match], [t.track_id for t in to_match],
+                                               self.scheduler.frame_start) if to_match else []
+
+        for track, outcome in zip(to_match, outcomes):
+            track.name = outcome['name'] if outcome['name'] != "Unknown" else None
+            track.score = outcome['score']
+            track.best_name = outcome['best_name']
+            track.last_matched = self.scheduler.tick
+        matched = set(id(t) for t in to_match)
+        matched.add(id(held))
+        for track in self.tracker.tracks:
+            if id(track) not in matched and not track.missed:
+                outcomes.append({'status': 'tracked', 'box': track.box, 'name': track.name or "Unknown",
+                                 'score': track.score, 'best_name': track.best_name, 'learning': None})
+        return outcomes
+
+    def finish(self):
+        return self.scheduler.finish()
+
+    def stats(self):
+        stats = self.scheduler.stats()
+        stats['tracks'] = len(self.tracker.tracks)
+        return stats
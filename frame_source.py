@@ -0,0 +1,286 @@
+import argparse
+import json
+import os
+import struct
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+# Recording format: file header (magic, version, codec), then one record per
+# frame: capture timestamp (float64 seconds), encoded size, encoded image.
+RECORDING_MAGIC = b'ATRC'
+RECORDING_VERSION = 1
+FILE_HEADER = struct.Struct('<4sB4s')
+RECORD_HEADER = struct.Struct('<dI')
+
+
+class CameraSource:
+    # Live camera, same read()/release() interface as cv2.VideoCapture
+    def __init__(self, index=0):
+        self.capture = cv2.VideoCapture(index)
+
+    def read(self):
+        return self.capture.read()
+
+    def read_into(self, frame):
+        # Decodes straight into frame when its size and type match the camera's
+        return self.capture.read(frame)
+
+    def release(self):
+        self.capture.release()
+
+
+class FrameRecorder:
+    # Writes frames with their capture timestamps to a compact recording.
+    # JPEG keeps files small; PNG is lossless.
+    def __init__(self, path, codec='.jpg', quality=90):
+        self.path = path
+        self.codec = codec
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality] if codec == '.jpg' else []
+        self.file = open(path, "wb")
+        self.file.write(FILE_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION, codec.encode('ascii').ljust(4)))
+        self.frames = 0
+
+    def write(self, frame, timestamp=None):
+        ok, encoded = cv2.imencode(self.codec, frame, self.params)
+        if not ok:
+            return False
+        data = encoded.tobytes()
+        self.file.write(RECORD_HEADER.pack(time.time() if timestamp is None else timestamp, len(data)))
+        self.file.write(data)
+        self.frames += 1
+        return True
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+class RecordingSource:
+    # Wraps another source and records every frame it delivers
+    def __init__(self, source, path, **recorder_options):
+        self.source = source
+        self.recorder = FrameRecorder(path, **recorder_options)
+
+    def read(self):
+        ret, frame = self.source.read()
+        if ret:
+            self.recorder.write(frame)
+        return ret, frame
+
+    def release(self):
+        self.recorder.close()
+        self.source.release()
+
+
+def read_recording(path):
+    # Yields (timestamp, frame) for every frame in a recording
+    with open(path, "rb") as f:
+        magic, version, _ = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        if magic != RECORDING_MAGIC or version != RECORDING_VERSION:
+            raise ValueError(f"{path} is not a version {RECORDING_VERSION} recording")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, size = RECORD_HEADER.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                return
+            yield timestamp, cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+class ReplaySource:
+    # Feeds a recording into the pipeline. With realtime=True frames are
+    # released at their recorded pace, otherwise as fast as they are read.
+    def __init__(self, path, realtime=True):
+        self.path = path
+        self.realtime = realtime
+        self.frames = read_recording(path)
+        self.first_timestamp = None
+        self.start_time = None
+        self.timestamp = None
+
+    def read(self):
+        try:
+            timestamp, frame = next(self.frames)
+        except StopIteration:
+            return False, None
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+            self.start_time = time.perf_counter()
+        elif self.realtime:
+            delay = (timestamp - self.first_timestamp) - (time.perf_counter() - self.start_time)
+            if delay > 0:
+                time.sleep(delay)
+        self.timestamp = timestamp
+        return True, frame
+
+    def release(self):
+        self.frames.close()
+
+
+def summarize(values):
+    if not values:
+        return {'mean_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'max_ms': 0.0}
+    values = np.array(values) * 1000
+    return {
+        'mean_ms': round(float(values.mean()), 3),
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p95_ms': round(float(np.percentile(values, 95)), 3),
+        'max_ms': round(float(values.max()), 3),
+    }
+
+
+def run_replay(path, realtime=False, engine=None, smart_learning=False, budget_ms=None):
+    # Runs a recording through detection and recognition and returns a
+    # report. Attendance goes to a scratch file and learned samples are not
+    # saved, so every run starts from the same state. With budget_ms the
+    # frame scheduler decides how much work each frame gets, as in the GUI.
+    from recognition_engine import RecognitionEngine
+    from frame_scheduler import ScheduledRecognizer
+
+    if engine is None:
+        scratch_dir = tempfile.mkdtemp(prefix="attendance_replay_")
+        engine = RecognitionEngine(attendance_file=os.path.join(scratch_dir, "attendance.xlsx"),
+                                   attendance_dir=scratch_dir, event_log=False, event_bus=False)
+    engine.persist_face_data = False
+    engine.smart_learning_enabled = smart_learning
+
+    recognizer = ScheduledRecognizer(engine, budget_ms) if budget_ms else None
+    source = ReplaySource(path, realtime)
+    stages = {'read': [], 'gray': [], 'detect': [], 'recognize': [], 'frame': []}
+    recognized = {}
+    frames = 0
+    faces = 0
+    start = time.perf_counter()
+    while True:
+        t0 = time.perf_counter()
+        ret, frame = source.read()
+        if not ret:
+            break
+        t1 = time.perf_counter()
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        t2 = time.perf_counter()
+        if recognizer is None:
+            detected = engine.detect_faces(gray)
+            t3 = time.perf_counter()
+            outcomes = engine.recognize_faces(gray, detected)
+        else:
+            # Detection and matching are interleaved by the scheduler
+            t3 = t2
+            outcomes = recognizer.process(gray)
+            recognizer.finish()
+            detected = [outcome for outcome in outcomes if outcome['box'] is not None]
+        t4 = time.perf_counter()
+
+        stages['read'].append(t1 - t0)
+        stages['gray'].append(t2 - t1)
+        stages['detect'].append(t3 - t2)
+        stages['recognize'].append(t4 - t3)
+        stages['frame'].append(t4 - t1)
+        frames += 1
+        faces += len(detected)
+        for outcome in outcomes:
+            if outcome['status'] in ('marked', 'already_marked'):
+                recognized[outcome['name']] = recognized.get(outcome['name'], 0) + 1
+    elapsed = time.perf_counter() - start
+    source.release()
+
+    marks = engine.load_attendance()
+    engine.close()
+    report = {
+        'recording': os.path.abspath(path),
+        'mode': 'realtime' if realtime else 'fast',
+        'frames': frames,
+        'faces': faces,
+        'elapsed_s': round(elapsed, 3),
+        'fps': round(frames / elapsed, 2) if elapsed > 0 else 0.0,
+        'stages': {stage: summarize(values) for stage, values in stages.items()},
+        'recognized': dict(sorted(recognized.items())),
+        'attendance': [] if marks is None else sorted(marks['Name'].astype(str).tolist()),
+    }
+    if recognizer is not None:
+        report['scheduler'] = recognizer.stats()
+    return report
+
+
+def print_report(report):
+    print(f"Replay of {report['recording']} ({report['mode']})")
+    print(f"  {report['frames']} frames, {report['faces']} faces, {report['elapsed_s']}s, {report['fps']} FPS")
+    for stage, stats in report['stages'].items():
+        print(f"  {stage:<10} mean {stats['mean_ms']:8.3f} ms  p95 {stats['p95_ms']:8.3f} ms  max {stats['max_ms']:8.3f} ms")
+    print(f"  Recognized: {report['recognized']}")
+    print(f"  Attendance marks: {report['attendance']}")
+    if 'scheduler' in report:
+        scheduler = report['scheduler']
+        print(f"  Scheduler: quality '{scheduler['quality']}', {scheduler['overruns']} budget overruns "
+              f"in {scheduler['frames']} frames")
+
+
+def compare_reports(baseline, candidate):
+    # Side by side comparison of two builds on the same footage
+    print(f"{'':<12}{'baseline':>12}{'candidate':>12}")
+    print(f"{'fps':<12}{baseline['fps']:>12}{candidate['fps']:>12}")
+    for stage in baseline['stages']:
+        print(f"{stage + ' ms':<12}{baseline['stages'][stage]['mean_ms']:>12}{candidate['stages'][stage]['mean_ms']:>12}")
+    if baseline['attendance'] != candidate['attendance']:
+        print(f"Attendance differs: {baseline['attendance']} vs {candidate['attendance']}")
+    if baseline['recognized'] != candidate['recognized']:
+        print(f"Recognized names differ: {baseline['recognized']} vs {candidate['recognized']}")
+
+
+def record(path, seconds, camera=0, codec='.jpg'):
+    source = RecordingSource(CameraSource(camera), path, codec=codec)
+    end = time.time() + seconds
+    try:
+        while time.time() < end:
+            source.read()
+    finally:
+        source.release()
+    print(f"Recorded {source.recorder.frames} frames to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record camera footage and replay it through the recognition pipeline")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    rec = sub.add_parser('record')
+    rec.add_argument('output')
+    rec.add_argument('--seconds', type=float, default=30.0)
+    rec.add_argument('--camera', type=int, default=0)
+    rec.add_argument('--lossless', action='store_true', help="Store PNG instead of JPEG frames")
+
+    replay = sub.add_parser('replay')
+    replay.add_argument('recording')
+    replay.add_argument('--realtime', action='store_true', help="Pace frames as they were recorded")
+    replay.add_argument('--smart-learning', action='store_true')
+    replay.add_argument('--budget-ms', type=float, help="Run under the frame-budget scheduler")
+    replay.add_argument('--report', help="Write the report as JSON")
+
+    compare = sub.add_parser('compare')
+    compare.add_argument('baseline')
+    compare.add_argument('candidate')
+
+    args = parser.parse_args()
+    if args.command == 'record':
+        record(args.output, args.seconds, args.camera, '.png' if args.lossless else '.jpg')
+    elif args.command == 'replay':
+        report = run_replay(args.recording, args.realtime, smart_learning=args.smart_learning,
+                            budget_ms=args.budget_ms)
+        print_report(report)
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+    else:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        with open(args.candidate, "r", encoding="utf-8") as f:
+            candidate = json.load(f)
+        compare_reports(baseline, candidate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from recognition_engine import FACE_SIZE, normalize_faces
+
+VECTOR_SIZE = FACE_SIZE[0] * FACE_SIZE[1]
+
+
+class ColdSamples:
+    # Stands in for a cold person's list of face crops: the crops stay in the
+    # cold tier on disk until somebody iterates them (e.g. when face data is
+    # saved). Samples appended while cold are kept in memory until demotion.
+    def __init__(self, gallery, name, count):
+        self.gallery = gallery
+        self.name = name
+        self.count = count
+        self.extra = []
+
+    def __len__(self):
+        return self.count + len(self.extra)
+
+    def __iter__(self):
+        yield from self.gallery.load_crops(self.name)
+        yield from self.extra
+
+    def __getitem__(self, i):
+        return list(self)[i]
+
+    def append(self, sample):
+        self.extra.append(sample)
+
+    def nbytes(self):
+        return sum(sample.nbytes for sample in self.extra)
+
+
+def quantize(rows):
+    # int8 with one float32 scale per row
+    scales = np.abs(rows).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    return np.round(rows / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+def dequantize(quantized, scales):
+    rows = quantized.astype(np.float32) * scales[:, None]
+    norms = np.linalg.norm(rows, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return rows / norms
+
+
+class TieredGallery:
+    # Keeps the engine's gallery within a RAM budget. Hot persons stay in the
+    # match index as normalized float32 rows (plus their face crops); the
+    # least recently matched persons are demoted to an encrypted, compressed
+    # int8 cold tier on disk. A resident centroid per person lets an
+    # unrecognized face pull its likely candidates back into the hot tier.
+    # Cold files are encoded, encrypted and written by a background writer;
+    # until then the demoted person's data is held in pending.
+    def __init__(self, engine, budget_bytes, cold_dir, promotion_candidates=3, promotion_threshold=None):
+        self.engine = engine
+        self.budget_bytes = budget_bytes
+        self.cold_dir = cold_dir
+        self.promotion_candidates = promotion_candidates
+        self.promotion_threshold = promotion_threshold
+        os.makedirs(cold_dir, exist_ok=True)
+
+        self.lock = threading.RLock()
+        self.hot = OrderedDict()  # name -> resident bytes, least recently matched first
+        self.cold = {}  # name -> bytes on disk
+        self.pending = {}  # name -> demoted data not yet written to its cold file
+        self.writer = None
+
+        # Centroid rows for every person; the cold mask selects who can be promoted
+        self.slots = {}
+        self.centroids = np.zeros((0, VECTOR_SIZE), dtype=np.float32)
+        self.cold_mask = np.zeros(0, dtype=bool)
+        self.free_slots = []
+
+        self.promotions = 0
+        self.demotions = 0
+        self.promotion_times = []
+
+    # Layout helpers
+
+    def cold_path(self, name):
+        return os.path.join(self.cold_dir, hashlib.sha1(name.encode('utf-8')).hexdigest() + ".cold")
+
+    def set_centroid(self, name, rows):
+        centroid = rows.mean(axis=0)
+        norm = np.linalg.norm(centroid)
+        if norm > 0:
+            centroid /= norm
+        if name not in self.slots:
+            if self.free_slots:
+                self.slots[name] = self.free_slots.pop()
+            else:
+                self.slots[name] = len(self.centroids)
+                grow = max(16, len(self.centroids))
+                self.centroids = np.vstack((self.centroids, np.zeros((grow, VECTOR_SIZE), dtype=np.float32)))
+                self.cold_mask = np.concatenate((self.cold_mask, np.zeros(grow, dtype=bool)))
+                self.free_slots = list(range(len(self.centroids) - 1, self.slots[name], -1))
+        self.centroids[self.slots[name]] = centroid
+
+    def resident_bytes(self, name):
+        samples = self.engine.known_faces.get(name, [])
+        crops = samples.nbytes() if isinstance(samples, ColdSamples) else sum(s.nbytes for s in samples)
+        return self.engine.index.sample_count(name) * VECTOR_SIZE * 4 + crops
+
+    # Tier moves
+
+    def apply(self):
+        # Called after the engine loaded its gallery: the first persons that fit
+        # the budget stay hot, the rest are demoted
+        with self.lock:
+            for name in list(self.engine.index.names):
+                self.set_centroid(name, self.engine.index.person_rows(name))
+                self.hot[name] = self.resident_bytes(name)
+            self.enforce_budget()
+
+    def enforce_budget(self, keep=()):
+        with self.lock:
+            while sum(self.hot.values()) > self.budget_bytes and len(self.hot) > len(keep):
+                name = next(n for n in self.hot if n not in keep)
+                self.demote(name)
+
+    def demote(self, name):
+        # Runs on the camera thread: only the quantization, the PNG encoding
+        # and encryption are left to the writer
+        samples = self.engine.known_faces[name]
+        rows = self.engine.index.person_rows(name)
+        written = name in self.pending or os.path.exists(self.cold_path(name))
+        if not (isinstance(samples, ColdSamples) and not samples.extra and written):
+            quantized, scales = quantize(rows)
+            data = {'quantized': quantized, 'scales': scales, 'crops': list(samples)}
+            self.pending[name] = data
+            if self.writer is None:
+                self.writer = ThreadPoolExecutor(1, thread_name_prefix="gallery-cold")
+            self.writer.submit(self.write_cold, name, data)
+            samples = ColdSamples(self, name, len(data['crops']))
+            self.engine.known_faces[name] = samples
+        self.engine.index = self.engine.index.without(name)
+        del self.hot[name]
+        self.cold[name] = 0 if name in self.pending else os.path.getsize(self.cold_path(name))
+        self.cold_mask[self.slots[name]] = True
+        self.demotions += 1
+
+    def write_cold(self, name, data):
+        # Runs on the writer thread. The file is only put in place if the
+        # person was not re-demoted or forgotten meanwhile.
+        tmp_path = self.cold_path(name) + ".tmp"
+        try:
+            crops = [cv2.imencode('.png', crop)[1].tobytes() for crop in data['crops']]
+            blob = zlib.compress(pickle.dumps({'quantized': data['quantized'], 'scales': data['scales'], 'crops': crops}))
+            with open(tmp_path, "wb") as f:
+                f.write(self.engine.fernet.encrypt(blob))
+            with self.lock:
+                if self.pending.get(name) is not data:
+                    os.remove(tmp_path)
+                    return
+                os.replace(tmp_path, self.cold_path(name))
+                del self.pending[name]
+                if name in self.cold:
+                    self.cold[name] = os.path.getsize(self.cold_path(name))
+        except Exception as e:
+            # Stays pending (in memory) and is read from there
+            print(f"Gallery: could not write the cold tier of {name}: {e}")
+
+    def read_cold(self, name):
+        with self.lock:
+            data = self.pending.get(name)
+        if data is not None:
+            return data
+        with open(self.cold_path(name), "rb") as f:
+            return pickle.loads(zlib.decompress(self.engine.fernet.decrypt(f.read())))
+
+    def load_crops(self, name):
+        with self.lock:
+            data = self.pending.get(name)
+        if data is not None:
+            return [np.array(crop) for crop in data['crops']]
+        return [cv2.imdecode(np.frombuffer(crop, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+                for crop in self.read_cold(name)['crops']]
+
+    def promote(self, name):
+        start = time.perf_counter()
+        data = self.read_cold(name)
+        rows = dequantize(data['quantized'], data['scales'])
+        samples = self.engine.known_faces[name]
+        if isinstance(samples, ColdSamples) and samples.extra:
+            rows = np.vstack((rows, normalize_faces(samples.extra)))
+        self.engine.index = self.engine.index.with_samples(name, rows)
+        del self.cold[name]
+        self.cold_mask[self.slots[name]] = False
+        self.hot[name] = self.resident_bytes(name)
+        self.promotions += 1
+        self.promotion_times.append(time.perf_counter() - start)
+        del self.promotion_times[:-1000]
+
+    # Engine hooks
+
+    def touch(self, name):
+        with self.lock:
+            if name in self.hot:
+                self.hot.move_to_end(name)
+
+    def changed(self, name):
+        # A person was enrolled or gained samples (always hot at that point)
+        with self.lock:
+            if name in self.cold:
+                del self.cold[name]
+                self.cold_mask[self.slots[name]] = False
+            self.set_centroid(name, self.engine.index.person_rows(name))
+            self.hot[name] = self.resident_bytes(name)
+            self.hot.move_to_end(name)
+            self.enforce_budget(keep=(name,))
+
+    def ensure_hot(self, name):
+        with self.lock:
+            if name in self.cold:
+                self.promote(name)
+                self.enforce_budget(keep=(name,))
+
+    def forget(self, name):
+        with self.lock:
+            self.hot.pop(name, None)
+            self.cold.pop(name, None)
+            self.pending.pop(name, None)
+            if name in self.slots:
+                slot = self.slots.pop(name)
+                self.cold_mask[slot] = False
+                self.free_slots.append(slot)
+            if os.path.exists(self.cold_path(name)):
+                os.remove(self.cold_path(name))
+
+    def promote_candidates(self, vectors):
+        # Promotes the cold persons whose centroids are closest to faces the
+        # hot tier did not recognize. Returns True if anybody was promoted.
+        with self.lock:
+            if not self.cold:
+                return False
+            threshold = self.promotion_threshold
+            if threshold is None:
+                threshold = self.engine.match_confidence_threshold * 0.75
+            scores = vectors @ self.centroids.T
+            scores[:, ~self.cold_mask] = -1.0
+            count = min(self.promotion_candidates, len(self.cold))
+            candidates = np.argpartition(-scores, count - 1, axis=1)[:, :count]
+            picked = candidates[scores[np.arange(len(scores))[:, None], candidates] > threshold]
+            picked_slots = set(int(slot) for slot in picked)
+            names = [name for name, slot in self.slots.items() if slot in picked_slots]
+            for name in names:
+                self.promote(name)
+            if names:
+                self.enforce_budget(keep=names)
+            return bool(names)
+
+    def close(self):
+        # Waits for the cold files still being written
+        if self.writer is not None:
+            self.writer.shutdown()
+            self.writer = None
+
+    def stats(self):
+        with self.lock:
+            times = np.array(self.promotion_times) * 1000 if self.promotion_times else np.zeros(1)
+            return {
+                'budget_bytes': self.budget_bytes,
+                'hot_persons': len(self.hot),
+                'hot_bytes': int(sum(self.hot.values())),
+                'cold_persons': len(self.cold),
+                'cold_bytes': int(sum(self.cold.values())),
+                'centroid_bytes': int(self.centroids.nbytes),
+                'promotions': self.promotions,
+                'demotions': self.demotions,
+                'promotion_ms_mean': float(times.mean()),
+                'promotion_ms_p95': float(np.percentile(times, 95)),
+            }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"Gallery: hot {stats['hot_persons']} ({stats['hot_bytes'] / 2**20:.1f} MB) / "
+                f"cold {stats['cold_persons']} ({stats['cold_bytes'] / 2**20:.1f} MB) | "
+                f"promotions {stats['promotions']} ({stats['promotion_ms_mean']:.1f} ms avg)")
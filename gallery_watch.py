@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+from collections import Counter
+
+from recognition_engine import face_data_version, file_hash, normalize_faces, read_face_file, read_face_records, \
+    read_face_samples
+
+
+def face_data_delta(base_version, faces, unchanged=()):
+    # Changes another process made to face_data.enc since base_version (what
+    # this process last read or wrote). faces holds the decrypted persons,
+    # unchanged the names whose record in the file is the same as before.
+    # Returns (removed names, {name: all samples} for added or replaced
+    # persons, {name: new samples} for persons that only gained samples).
+    # Samples are compared by checksum, not position: two kiosks learning
+    # for the same person between polls write their samples in different
+    # orders.
+    version = {name: base_version[name] for name in unchanged}
+    version.update(face_data_version(faces))
+    removed = [name for name in base_version if name not in version]
+    replaced = {}
+    appended = {}
+    for name in faces:
+        checksums = version[name]
+        base = base_version.get(name)
+        if base is None:
+            replaced[name] = faces[name]
+            continue
+        remaining = Counter(base)
+        new = []
+        for sample, checksum in zip(faces[name], checksums):
+            if remaining[checksum] > 0:
+                remaining[checksum] -= 1
+            else:
+                new.append(sample)
+        if any(remaining.values()):
+            replaced[name] = faces[name]  # Samples were dropped: re-enrolled or trimmed
+        elif new:
+            appended[name] = new
+    return removed, replaced, appended, version
+
+
+class GalleryWatcher:
+    # Polls face_data.enc for changes written by other processes (an admin
+    # workstation enrolling or removing students) and applies only the delta.
+    # The file is decrypted and the new samples normalized on this thread,
+    # and the next match index is built from the current one in one copy.
+    # The camera thread then swaps it in between frames (see
+    # RecognitionEngine.apply_gallery_reload). That happens only if the index
+    # is still the one the delta was built on; otherwise the next poll
+    # builds it again. Only persons whose record in the file changed are
+    # decrypted.
+    def __init__(self, engine, interval=2.0):
+        self.engine = engine
+        self.interval = interval
+        self.lock = engine.face_data_lock  # Also held by the engine's saver while it replaces the file
+        self.stat = self.file_stat()
+        self.reloads = 0
+        self.retries = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="gallery-watch", daemon=True)
+        self.thread.start()
+
+    def file_stat(self):
+        try:
+            stat = os.stat(self.engine.face_data_file)
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                with self.lock:
+                    reload = self.prepare()
+                    if reload is not None:
+                        self.engine.pending_reload = reload
+            except Exception as e:
+                print(f"Gallery watch: could not read face data: {e}")
+
+    def sync(self):
+        # Applies outside changes right away; used before this process writes
+        # face_data.enc so it never overwrites them. Must run on the thread
+        # that changes the index.
+        with self.lock:
+            if self.engine.pending_reload is not None:
+                # Prepared on an index this thread may have changed since; read again
+                self.engine.pending_reload = None
+                self.stat = None
+            reload = self.prepare()
+        if reload is not None:
+            self.engine.apply_gallery_reload(reload)
+
+    def retry(self):
+        with self.lock:
+            self.retries += 1
+            self.stat = None
+
+    def prepare(self):
+        # Called with the lock held
+        stat = self.file_stat()
+        if stat is None or stat == self.stat:
+            return None
+        engine = self.engine
+        with open(engine.face_data_file, "rb") as f:
+            data_hash = file_hash(f)
+            if data_hash == engine.face_data_hash:
+                self.stat = stat
+                return None  # Written by this process
+            start = time.perf_counter()
+            records = read_face_records(f)
+            if records is None:
+                faces, _ = read_face_file(f, engine.fernet)
+                unchanged = []
+            else:
+                # A token is never written twice (its head holds a timestamp
+                # and IV), so an equal length and head is the same token
+                known = engine.face_data_records
+                unchanged = [name for name, record in records.items()
+                             if known.get(name, (None,))[1:] == record[1:] and name in engine.face_data_version]
+                faces = {name: read_face_samples(f, engine.fernet, record)
+                         for name, record in records.items() if name not in unchanged}
+        self.stat = stat  # Only once the file could be read; a failed read is tried again
+        removed, replaced, appended, version = face_data_delta(engine.face_data_version, faces, unchanged)
+
+        base = engine.index
+        gallery = engine.gallery
+        for name in list(appended):
+            # Cold persons are not in the index; they come back hot with all samples
+            if gallery is not None and name in gallery.cold:
+                replaced[name] = faces[name]
+                del appended[name]
+        vectors = {name: normalize_faces(samples) for name, samples in replaced.items() if len(samples)}
+        vectors.update((name, normalize_faces(samples)) for name, samples in appended.items())
+        index = base.updated(removed + list(replaced), vectors)
+        if engine.rosters.sessions:
+            index = index.reordered(engine.rosters.student_order())
+        return {
+            'hash': data_hash,
+            'version': version,
+            'records': records or {},
+            'base': base,
+            'index': index,
+            'removed': removed,
+            'replaced': replaced,
+            'appended': appended,
+            'seconds': time.perf_counter() - start,
+        }
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def stats(self):
+        return {'interval': self.interval, 'reloads': self.reloads, 'retries': self.retries}
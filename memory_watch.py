@@ -0,0 +1,250 @@
+import argparse
+import gc
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+# Allocation sites of the interpreter's own machinery, not of the application
+IGNORED_FILES = ("<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>", "<unknown>",
+                 tracemalloc.__file__, __file__)
+
+
+def rss_mb():
+    # Resident set size of this process; peak RSS where /proc is not available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def type_counts(type_names):
+    # Live instances per type name among the objects the garbage collector
+    # tracks (Qt wrappers such as QPixmap and QImage are)
+    counts = dict.fromkeys(type_names, 0)
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        if name in counts:
+            counts[name] += 1
+    return counts
+
+
+def engine_sizes(engine):
+    # Sizes of the engine state that can grow while a kiosk runs for weeks
+    samples = 0
+    sample_bytes = 0
+    largest = 0
+    for samples_of in list(engine.known_faces.values()):
+        samples += len(samples_of)
+        largest = max(largest, len(samples_of))
+        if isinstance(samples_of, list):
+            sample_bytes += sum(sample.nbytes for sample in samples_of)
+        else:
+            sample_bytes += samples_of.nbytes()  # Cold person: only samples learned while cold are resident
+    sizes = {
+        'persons': len(engine.known_faces),
+        'samples': samples,
+        'largest_person_samples': largest,
+        'sample_mb': round(sample_bytes / 2**20, 2),
+        'index_mb': round(engine.index.matrix.nbytes / 2**20, 2),
+        'learning_times': len(engine.last_learning_time),
+        'marked_today': len(engine.attendance_store.marked_today),
+    }
+    if engine.event_log is not None:
+        sizes['event_log_strings'] = len(engine.event_log.strings)
+    return sizes
+
+
+class MemoryWatch:
+    # Tracks the memory of a long-running kiosk. Every interval seconds a
+    # background thread takes a tracemalloc snapshot, measures the engine's
+    # gallery and per-person state (plus whatever extra_sizes() returns)
+    # and the process RSS, and appends one JSON line to memory_trend.jsonl
+    # with the allocation sites that grew most since the first sample.
+    # Crossed limits are only recorded there: the pruning itself changes
+    # the engine and runs on the camera thread, in enforce().
+    #
+    # limits: rss_mb (prune, collect garbage and stop learning at
+    # rss_samples_per_person samples; nothing is deleted from face_data.enc,
+    # which other kiosks would take in), samples_per_person (trim persons
+    # above it in face_data.enc and stop learning at it).
+    def __init__(self, engine, output_dir, interval=60.0, limits=None, extra_sizes=None, top=10, trace_frames=1):
+        self.engine = engine
+        self.output_dir = output_dir
+        self.trend_file = os.path.join(output_dir, "memory_trend.jsonl")
+        self.interval = interval
+        self.limits = {'rss_mb': None, 'samples_per_person': None, 'rss_samples_per_person': 20}
+        self.limits.update(limits or {})
+        for key in ('samples_per_person', 'rss_samples_per_person'):
+            if self.limits[key] is not None and self.limits[key] < 1:
+                raise ValueError(f"Memory watch: {key} must be at least 1, not {self.limits[key]}")
+        self.extra_sizes = extra_sizes
+        self.top = top
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start(trace_frames)
+        self.baseline = None
+        self.samples = 0
+        self.pending = None  # What the watch thread asks for, applied by enforce()
+        self.enforcements = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="memory-watch", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Memory watch: sample failed: {e}")
+            if self.stop_event.wait(self.interval):
+                return
+
+    def sample(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, filename) for filename in IGNORED_FILES])
+        if self.baseline is None:
+            self.baseline = snapshot
+        growth = [stat for stat in snapshot.compare_to(self.baseline, 'lineno') if stat.size_diff > 0][:self.top]
+        traced, peak = tracemalloc.get_traced_memory()
+        rss = rss_mb()
+        sizes = engine_sizes(self.engine)
+        if self.extra_sizes is not None:
+            sizes.update(self.extra_sizes())
+        entry = {
+            'time': time.time(),
+            'rss_mb': round(rss, 1),
+            'traced_mb': round(traced / 2**20, 2),
+            'traced_peak_mb': round(peak / 2**20, 2),
+            'sizes': sizes,
+            'growth': [{'site': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                        'size_kb': round(stat.size / 2**10, 1),
+                        'diff_kb': round(stat.size_diff / 2**10, 1),
+                        'count_diff': stat.count_diff} for stat in growth],
+            'limits_crossed': self.check_limits(rss, sizes),
+        }
+        with open(self.trend_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+        self.samples += 1
+        return entry
+
+    def check_limits(self, rss, sizes):
+        crossed = []
+        if self.limits['rss_mb'] is not None and rss > self.limits['rss_mb']:
+            crossed.append('rss_mb')
+        samples_cap = self.limits['samples_per_person']
+        if samples_cap is not None and sizes['largest_person_samples'] > samples_cap:
+            crossed.append('samples_per_person')
+        if crossed:
+            print(f"Memory watch: limits crossed: {', '.join(crossed)} (RSS {rss:.0f} MB)")
+        with self.lock:
+            # Stale learning times are pruned on every sample, the rest only past a limit
+            pending = self.pending or {'rss': False, 'trim': False}
+            pending['rss'] = pending['rss'] or 'rss_mb' in crossed
+            pending['trim'] = pending['trim'] or 'samples_per_person' in crossed
+            self.pending = pending
+        return crossed
+
+    def enforce(self):
+        # Called on the thread that runs the engine (the frame loop); costs
+        # one attribute check while nothing is pending
+        if self.pending is None:
+            return None
+        with self.lock:
+            pending, self.pending = self.pending, None
+        engine = self.engine
+        result = {'learning_times': engine.prune_learning_times(), 'samples': 0}
+        if self.limits['samples_per_person'] is not None:
+            # Learning stops at the cap instead of growing past it again
+            engine.max_samples_per_person = min(engine.max_samples_per_person, self.limits['samples_per_person'])
+        if pending['trim']:
+            # An explicit limit: the learned samples above it leave face_data.enc
+            result['samples'] = engine.trim_face_samples(self.limits['samples_per_person'])
+            print(f"Memory watch: trimmed {result['samples']} face samples to "
+                  f"{self.limits['samples_per_person']} per person")
+        if pending['rss']:
+            # Over the RSS limit only in-memory state is pruned and learning
+            # capped; deleting samples would spread to every kiosk
+            engine.max_samples_per_person = min(engine.max_samples_per_person, self.limits['rss_samples_per_person'])
+            print(f"Memory watch: over the RSS limit, learning capped at {engine.max_samples_per_person} "
+                  f"samples per person, pruned {result['learning_times']} learning times")
+        if pending['trim'] or pending['rss']:
+            gc.collect()
+            self.enforcements += 1
+        return result
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        if self.started_tracing:
+            tracemalloc.stop()
+
+    def stats(self):
+        return {'interval': self.interval, 'samples': self.samples, 'enforcements': self.enforcements}
+
+
+def read_trend(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def trend_report(entries, top=10):
+    # Growth per hour of RSS and every tracked size between the first and the
+    # last sample, and the allocation sites that grew in most samples
+    first, last = entries[0], entries[-1]
+    hours = max((last['time'] - first['time']) / 3600, 1e-9)
+    report = {
+        'samples': len(entries),
+        'hours': round(hours, 2),
+        'rss_mb': [first['rss_mb'], last['rss_mb']],
+        'rss_mb_per_hour': round((last['rss_mb'] - first['rss_mb']) / hours, 2),
+        'sizes_per_hour': {key: round((last['sizes'][key] - value) / hours, 2)
+                           for key, value in first['sizes'].items() if key in last['sizes']},
+        'limits_crossed': sum(bool(entry['limits_crossed']) for entry in entries),
+    }
+    # A site that shows up in most samples keeps growing; a one-off spike does not
+    seen = {}
+    for entry in entries:
+        for stat in entry['growth']:
+            seen[stat['site']] = seen.get(stat['site'], 0) + 1
+    latest = {stat['site']: stat['diff_kb'] for stat in last['growth']}
+    report['growing_sites'] = [
+        {'site': site, 'samples': count, 'diff_kb': latest.get(site)}
+        for site, count in sorted(seen.items(), key=lambda item: (-item[1], -latest.get(item[0], 0)))[:top]]
+    return report
+
+
+def main():
+    default_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory", "memory_trend.jsonl")
+    parser = argparse.ArgumentParser(description="Summarize a memory trend file written by --memory-watch")
+    parser.add_argument('file', nargs='?', default=default_file)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    entries = read_trend(args.file)
+    if not entries:
+        print(f"No samples in {args.file}")
+        return
+    report = trend_report(entries, args.top)
+    start = datetime.fromtimestamp(entries[0]['time']).strftime("%Y-%m-%d %H:%M")
+    print(f"{report['samples']} samples over {report['hours']} h since {start}, "
+          f"limits crossed in {report['limits_crossed']}")
+    print(f"RSS {report['rss_mb'][0]} -> {report['rss_mb'][1]} MB ({report['rss_mb_per_hour']:+} MB/h)")
+    for key, rate in report['sizes_per_hour'].items():
+        print(f"  {key:>24}: {rate:+}/h")
+    print("Allocation sites growing since the first sample:")
+    for site in report['growing_sites']:
+        print(f"  {site['samples']:>4} samples  {site['diff_kb'] if site['diff_kb'] is not None else '-':>10} KiB  {site['site']}")
+
+
+if __name__ == '__main__':
+    main()
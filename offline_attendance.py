@@ -0,0 +1,239 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+import cv2
+
+from recognition_engine import BASE_DIR, TUNABLE_PARAMETERS, MatchIndex, RecognitionEngine, decide_identities, \
+    normalize_faces
+from rosters import RosterSchedule
+
+# One matcher per worker process, created by init_worker
+worker_matcher = None
+
+
+class SegmentMatcher:
+    # What a worker needs to recognize faces and nothing that writes: the
+    # match index read straight from face_data.enc, the parent engine's
+    # detector and matcher parameters and the rosters. Matching follows
+    # RecognitionEngine.match_faces: the session's roster first, everyone
+    # for the faces no roster student passes for.
+    def __init__(self, base_dir, parameters):
+        from tuner import load_gallery
+
+        self.parameters = parameters
+        self.rosters = RosterSchedule.load(os.path.join(base_dir, "rosters.json"))
+        self.index = MatchIndex.build(load_gallery(base_dir))
+        if self.rosters.sessions:
+            self.index = self.index.reordered(self.rosters.student_order())
+        self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        self.session = None
+        self.roster = None
+        self.pinned = False
+
+    def pin_session(self, when, session_name=None):
+        # Rosters are searched for the session running when the frame was
+        # recorded (or the one given), not the one running now
+        session = self.rosters.get(session_name) if session_name else self.rosters.active(when)
+        if not self.pinned or session is not self.session:
+            self.pinned = True
+            self.session = session
+            self.roster = self.rosters.view(self.index, session)[0] if session is not None else None
+
+    def detect_faces(self, gray):
+        return self.face_cascade.detectMultiScale(gray, self.parameters['scale_factor'],
+                                                  self.parameters['min_neighbors'])
+
+    def match_faces(self, face_rois):
+        # Recognized name per face, None for unknown faces
+        vectors = normalize_faces(face_rois)
+        thresholds = (self.parameters['match_confidence_threshold'], self.parameters['recognition_threshold'],
+                      self.parameters['min_recognition_matches'])
+        names = [None] * len(face_rois)
+        for index in (self.roster, self.index):
+            unknown = [i for i, name in enumerate(names) if name is None]
+            if index is None or not len(index) or not unknown:
+                continue
+            identities = decide_identities(index, index.score(vectors[unknown]), *thresholds)[0]
+            for i, identity in zip(unknown, identities):
+                if identity >= 0:
+                    names[i] = index.names[identity]
+        return names
+
+
+def init_worker(base_dir, parameters):
+    global worker_matcher
+    cv2.setNumThreads(1)  # Parallelism comes from the process pool
+    worker_matcher = SegmentMatcher(base_dir, parameters)
+
+
+def video_info(path):
+    capture = cv2.VideoCapture(path)
+    try:
+        if not capture.isOpened():
+            raise ValueError(f"Cannot open {path}")
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        return fps, frames
+    finally:
+        capture.release()
+
+
+def split_segments(path, fps, frames, segment_seconds):
+    # (path, first frame, end frame) per segment of about segment_seconds
+    length = max(int(fps * segment_seconds), 1)
+    return [(path, start, min(start + length, frames)) for start in range(0, frames, length)]
+
+
+def process_segment(path, start, end, sample_fps, first_frame, session=None):
+    # Decodes one segment, recognizing faces on every n-th frame. Returns
+    # {name: [first seen (seconds into the video), sightings]} and counters.
+    # first_frame is the wall-clock time of the video's first frame.
+    capture = cv2.VideoCapture(path)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    step = max(int(round(fps / sample_fps)), 1)
+    capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+    seen = {}
+    decoded = 0
+    sampled = 0
+    faces_found = 0
+    try:
+        for index in range(start, end):
+            # grab() skips colour conversion for the frames that are not sampled
+            if not capture.grab():
+                break
+            decoded += 1
+            if (index - start) % step:
+                continue
+            ret, frame = capture.retrieve()
+            if not ret:
+                continue
+            sampled += 1
+            if worker_matcher.rosters.sessions:
+                worker_matcher.pin_session(first_frame + timedelta(seconds=index / fps), session)
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            faces = worker_matcher.detect_faces(gray)
+            if len(faces) == 0:
+                continue
+            faces_found += len(faces)
+            for name in worker_matcher.match_faces([gray[y:y+h, x:x+w] for (x, y, w, h) in faces]):
+                if name is None:
+                    continue
+                entry = seen.setdefault(name, [index / fps, 0])
+                entry[1] += 1
+    finally:
+        capture.release()
+    return {'path': path, 'seen': seen, 'decoded': decoded, 'sampled': sampled, 'faces': faces_found}
+
+
+def merge_sightings(results):
+    # Earliest sighting and total sightings per (video, person)
+    merged = {}
+    for result in results:
+        video = merged.setdefault(result['path'], {})
+        for name, (first_seen, count) in result['seen'].items():
+            if name in video:
+                video[name] = [min(video[name][0], first_seen), video[name][1] + count]
+            else:
+                video[name] = [first_seen, count]
+    return merged
+
+
+def video_start(path, fps, frames, start=None):
+    # Wall-clock time of the first frame: given, or the file's modification
+    # time minus its duration (recorders usually write the file until the end)
+    if start is not None:
+        return start
+    return datetime.fromtimestamp(os.path.getmtime(path)) - timedelta(seconds=frames / fps)
+
+
+def extract(videos, base_dir=BASE_DIR, workers=None, sample_fps=2.0, segment_seconds=60.0,
+            min_sightings=2, start=None, session=None, dry_run=False):
+    # Only this process writes: it marks attendance (published like a
+    # kiosk's marks); the workers just read the gallery
+    engine = RecognitionEngine(base_dir, event_log=False, event_bus=not dry_run)
+    engine.persist_face_data = False
+    parameters = {name: getattr(engine, name) for name in TUNABLE_PARAMETERS}
+    workers = workers or os.cpu_count() or 1
+    info = {path: video_info(path) for path in videos}
+    first_frames = {path: video_start(path, *info[path], start) for path in videos}
+    segments = [segment for path in videos for segment in split_segments(path, *info[path], segment_seconds)]
+    print(f"{len(videos)} videos, {len(segments)} segments, {workers} workers, sampling {sample_fps:g} fps")
+
+    wall_start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(base_dir, parameters)) as pool:
+        jobs = [pool.submit(process_segment, path, first, end, sample_fps, first_frames[path], session)
+                for path, first, end in segments]
+        for done, job in enumerate(as_completed(jobs), 1):
+            results.append(job.result())
+            print(f"\rSegments {done}/{len(jobs)}", end='', flush=True)
+    print()
+    elapsed = time.perf_counter() - wall_start
+
+    records = []
+    for path, persons in merge_sightings(results).items():
+        first_frame = first_frames[path]
+        for name, (first_seen, count) in sorted(persons.items(), key=lambda item: item[1][0]):
+            if count < min_sightings:
+                continue  # A single sighting is too weak for attendance
+            when = first_frame + timedelta(seconds=first_seen)
+            active = engine.rosters.get(session) if session else engine.rosters.active(when)
+            session_name = active['name'] if active is not None else (session or '')
+            marked = False if dry_run else engine.mark_attendance(name, when, session_name)
+            records.append({'video': path, 'name': name, 'first_seen': when.strftime("%Y-%m-%d %H:%M:%S"),
+                            'sightings': count, 'session': session_name, 'marked': marked})
+    if not dry_run:
+        engine.compact_attendance()
+    engine.close()
+
+    sampled = sum(result['sampled'] for result in results)
+    decoded = sum(result['decoded'] for result in results)
+    return {
+        'videos': len(videos),
+        'segments': len(segments),
+        'workers': workers,
+        'seconds': round(elapsed, 2),
+        'frames_decoded': decoded,
+        'frames_sampled': sampled,
+        'decoded_fps': round(decoded / elapsed, 1) if elapsed else 0.0,
+        'sampled_fps': round(sampled / elapsed, 1) if elapsed else 0.0,
+        'faces': sum(result['faces'] for result in results),
+        'records': records,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Take attendance from recorded lecture videos")
+    parser.add_argument('videos', nargs='+')
+    parser.add_argument('--workers', type=int, help="Worker processes (default: CPU count)")
+    parser.add_argument('--sample-fps', type=float, default=2.0, help="Frames recognized per second of video")
+    parser.add_argument('--segment-seconds', type=float, default=60.0)
+    parser.add_argument('--min-sightings', type=int, default=2)
+    parser.add_argument('--start', help="Wall-clock time of the first frame, YYYY-MM-DD HH:MM:SS "
+                                        "(default: file time minus duration)")
+    parser.add_argument('--session', help="Session to record (default: from rosters.json at the time seen)")
+    parser.add_argument('--dry-run', action='store_true', help="Report without marking attendance")
+    parser.add_argument('--report', help="Write the report as JSON")
+    args = parser.parse_args()
+
+    start = datetime.strptime(args.start, "%Y-%m-%d %H:%M:%S") if args.start else None
+    report = extract(args.videos, workers=args.workers, sample_fps=args.sample_fps,
+                     segment_seconds=args.segment_seconds, min_sightings=args.min_sightings,
+                     start=start, session=args.session, dry_run=args.dry_run)
+    for record in report['records']:
+        status = "marked" if record['marked'] else ("dry run" if args.dry_run else "already marked")
+        print(f"{record['name']:<20} {record['first_seen']}  {record['sightings']:>4} sightings  "
+              f"{record['session'] or '-':<12} {status}")
+    print(f"{report['frames_sampled']} frames recognized ({report['frames_decoded']} decoded) in {report['seconds']}s: "
+          f"{report['sampled_fps']} recognized fps, {report['decoded_fps']} decoded fps with {report['workers']} workers")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+from recognition_engine import RecognitionEngine
+
+# Wire format, both directions: 4-byte header length, 4-byte payload length,
+# JSON header, raw payload. Images travel as uint8 grayscale bytes with their
+# shape in the header.
+FRAME_HEADER = struct.Struct('!II')
+
+DEFAULT_SOCKET = "/tmp/attendance_recognition.sock"
+DEFAULT_PORT = 8765
+
+
+def encode_message(header, payload=b''):
+    header_bytes = json.dumps(header).encode('utf-8')
+    return FRAME_HEADER.pack(len(header_bytes), len(payload)) + header_bytes + payload
+
+
+def decode_image(header, payload):
+    return np.frombuffer(payload, dtype=np.uint8).reshape(header['shape'])
+
+
+async def read_message(reader):
+    header_len, payload_len = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    header = json.loads(await reader.readexactly(header_len))
+    payload = await reader.readexactly(payload_len) if payload_len else b''
+    return header, payload
+
+
+class MicroBatcher:
+    # Collects crops that arrive within batch_window_ms of each other and
+    # scores them against the gallery in one vectorized pass
+    def __init__(self, engine, batch_window_ms=3.0, max_batch=64):
+        self.engine = engine
+        self.batch_window = batch_window_ms / 1000.0
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+
+        # Reporting
+        self.batches = 0
+        self.faces = 0
+        self.last_batch_size = 0
+        self.largest_batch = 0
+        self.max_queue_depth = 0
+
+    async def submit(self, face_roi, mark=False):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((face_roi, mark, future))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await loop.run_in_executor(None, self.score_batch, batch)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.faces += len(batch)
+            self.last_batch_size = len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def score_batch(self, batch):
+        start = time.perf_counter()
+        results = self.engine.match_faces([face_roi for face_roi, _, _ in batch])
+        latency_ms = (time.perf_counter() - start) * 1000
+        # One store write for all marks in the batch
+        newly_marked = set(self.engine.mark_attendance_batch([result.name for (_, mark, _), result in zip(batch, results)
+                                                              if mark]))
+        replies = []
+        for (_, mark, _), result in zip(batch, results):
+            reply = result._asdict()
+            reply['marked'] = bool(mark) and result.name in newly_marked
+            newly_marked.discard(result.name)
+            if result.name == "Unknown":
+                self.engine.log_event('unknown', result.best_name, result.score, latency_ms=latency_ms)
+            else:
+                self.engine.log_event('marked' if reply['marked'] else 'recognized', result.name,
+                                      result.score, latency_ms=latency_ms)
+            replies.append(reply)
+        return replies
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'batches': self.batches,
+            'faces': self.faces,
+            'last_batch_size': self.last_batch_size,
+            'largest_batch': self.largest_batch,
+            'average_batch_size': self.faces / self.batches if self.batches else 0.0,
+        }
+
+
+class RecognitionDaemon:
+    # Serves detection and recognition for thin-client kiosks on a Unix
+    # socket or a local TCP port
+    def __init__(self, engine, batch_window_ms=3.0, max_batch=64, report_interval=10.0):
+        self.engine = engine
+        self.batcher = MicroBatcher(engine, batch_window_ms, max_batch)
+        self.report_interval = report_interval
+        self.connections = 0
+
+    async def handle_client(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    header, payload = await read_message(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                reply = await self.dispatch(header, payload)
+                writer.write(encode_message(reply))
+                await writer.drain()
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def dispatch(self, header, payload):
+        op = header.get('op')
+        try:
+            if op == 'recognize':
+                return await self.batcher.submit(decode_image(header, payload), header.get('mark', False))
+            if op == 'detect':
+                # Whole frames are detected one by one; only the matching is batched
+                gray = decode_image(header, payload)
+                faces = await asyncio.get_running_loop().run_in_executor(None, self.engine.detect_faces, gray)
+                return {'faces': [[int(v) for v in face] for face in faces]}
+            if op == 'stats':
+                stats = self.batcher.stats()
+                stats['connections'] = self.connections
+                stats['persons'] = len(self.engine.known_faces)
+                if self.engine.gallery is not None:
+                    stats['gallery'] = self.engine.gallery.stats()
+                if self.engine.rosters.sessions:
+                    stats['roster'] = self.engine.roster_stats()
+                return stats
+            return {'error': f"Unknown op: {op}"}
+        except Exception as e:
+            return {'error': str(e)}
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            stats = self.batcher.stats()
+            print(f"Daemon: queue depth {stats['queue_depth']} (max {stats['max_queue_depth']}), "
+                  f"{stats['faces']} faces in {stats['batches']} batches, "
+                  f"last batch {stats['last_batch_size']}, average {stats['average_batch_size']:.1f}")
+            if self.engine.gallery is not None:
+                print(self.engine.gallery.summary())
+
+    async def serve(self, unix_path=None, host='127.0.0.1', port=DEFAULT_PORT):
+        if unix_path:
+            if os.path.exists(unix_path):
+                os.remove(unix_path)
+            server = await asyncio.start_unix_server(self.handle_client, path=unix_path)
+            print(f"Recognition daemon listening on {unix_path}")
+        else:
+            server = await asyncio.start_server(self.handle_client, host, port)
+            print(f"Recognition daemon listening on {host}:{port}")
+
+        tasks = [asyncio.create_task(self.batcher.run())]
+        if self.report_interval:
+            tasks.append(asyncio.create_task(self.report()))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+class RecognitionClient:
+    # Blocking client used by kiosks and by the load test
+    def __init__(self, unix_path=None, host='127.0.0.1', port=DEFAULT_PORT):
+        if unix_path:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(unix_path)
+        else:
+            self.sock = socket.create_connection((host, port))
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def request(self, header, payload=b''):
+        self.sock.sendall(encode_message(header, payload))
+        header_len, payload_len = FRAME_HEADER.unpack(self.recv_exactly(FRAME_HEADER.size))
+        reply = json.loads(self.recv_exactly(header_len))
+        if payload_len:
+            self.recv_exactly(payload_len)
+        return reply
+
+    def recv_exactly(self, size):
+        chunks = []
+        while size:
+            chunk = self.sock.recv(size)
+            if not chunk:
+                raise ConnectionError("Daemon closed the connection")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def recognize(self, face_roi, mark=False):
+        face_roi = np.ascontiguousarray(face_roi, dtype=np.uint8)
+        return self.request({'op': 'recognize', 'shape': list(face_roi.shape), 'mark': mark}, face_roi.tobytes())
+
+    def detect(self, gray):
+        gray = np.ascontiguousarray(gray, dtype=np.uint8)
+        return self.request({'op': 'detect', 'shape': list(gray.shape)}, gray.tobytes())['faces']
+
+    def stats(self):
+        return self.request({'op': 'stats'})
+
+    def close(self):
+        self.sock.close()
+
+
+def load_test(unix_path=None, host='127.0.0.1', port=DEFAULT_PORT, clients=16, requests=200, face_size=100):
+    # Stand-in kiosks: each thread sends random face-sized crops as fast as
+    # the daemon answers and records the round-trip latency
+    latencies = []
+    lock = threading.Lock()
+
+    def kiosk(seed):
+        rng = np.random.default_rng(seed)
+        client = RecognitionClient(unix_path, host, port)
+        own = []
+        try:
+            for _ in range(requests):
+                crop = rng.integers(0, 256, (face_size, face_size), dtype=np.uint8)
+                start = time.perf_counter()
+                client.recognize(crop)
+                own.append(time.perf_counter() - start)
+        finally:
+            client.close()
+        with lock:
+            latencies.extend(own)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=kiosk, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    stats_client = RecognitionClient(unix_path, host, port)
+    stats = stats_client.stats()
+    stats_client.close()
+
+    latencies_ms = np.array(latencies) * 1000
+    print(f"Load test: {len(latencies)} requests from {clients} clients in {elapsed:.2f}s "
+          f"({len(latencies) / elapsed:.0f} req/s)")
+    if len(latencies_ms):
+        print(f"Latency ms: p50 {np.percentile(latencies_ms, 50):.2f}, "
+              f"p95 {np.percentile(latencies_ms, 95):.2f}, p99 {np.percentile(latencies_ms, 99):.2f}")
+    print(f"Daemon: {stats['batches']} batches, average batch size {stats['average_batch_size']:.1f}, "
+          f"largest {stats['largest_batch']}, max queue depth {stats['max_queue_depth']}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless face recognition daemon")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    for name in ('serve', 'loadtest'):
+        command = sub.add_parser(name)
+        command.add_argument('--unix', nargs='?', const=DEFAULT_SOCKET, default=None,
+                             help=f"Unix socket path (default {DEFAULT_SOCKET})")
+        command.add_argument('--host', default='127.0.0.1')
+        command.add_argument('--port', type=int, default=DEFAULT_PORT)
+
+    serve = sub.choices['serve']
+    serve.add_argument('--batch-window-ms', type=float, default=3.0)
+    serve.add_argument('--max-batch', type=int, default=64)
+    serve.add_argument('--report-interval', type=float, default=10.0)
+    serve.add_argument('--gallery-budget-mb', type=float)
+    serve.add_argument('--sync-dir', help="Shared attendance directory for multiple kiosks")
+    serve.add_argument('--node-id')
+    serve.add_argument('--session', help="Pin a session from rosters.json instead of following the schedule")
+    serve.add_argument('--tile-size', type=int, help="Detect high-resolution frames in tiles of this size")
+    serve.add_argument('--detect-workers', type=int, help="Threads for tiled detection (default: CPU count)")
+    serve.add_argument('--gallery-poll', type=float, default=2.0, metavar='SECONDS',
+                       help="How often to check face_data.enc for changes from other processes (0 disables)")
+
+    loadtest = sub.choices['loadtest']
+    loadtest.add_argument('--clients', type=int, default=16)
+    loadtest.add_argument('--requests', type=int, default=200)
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        engine = RecognitionEngine(gallery_budget_mb=args.gallery_budget_mb, attendance_dir=args.sync_dir,
+                                   node_id=args.node_id)
+        daemon = RecognitionDaemon(engine, args.batch_window_ms, args.max_batch, args.report_interval)
+        try:
+            if args.session:
+                engine.set_session(args.session)
+            if args.tile_size:
+                engine.enable_tiled_detection(args.tile_size, args.detect_workers)
+            if args.gallery_poll:
+                engine.watch_gallery(args.gallery_poll)
+            asyncio.run(daemon.serve(args.unix, args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            engine.close()
+    else:
+        load_test(args.unix, args.host, args.port, args.clients, args.requests)
+
+
+if __name__ == '__main__':
+    main()
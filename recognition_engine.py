@@ -0,0 +1,1061 @@
+import hashlib
+import json
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import cv2
+import numpy as np
+import pandas as pd
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from attendance_store import EXPORT_FIELDS, AttendanceStore
+from event_bus import load_event_bus
+from event_log import EventLog
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Every face sample is compared at this size so a whole gallery can be scored
+# with a single matrix product instead of one matchTemplate call per sample
+FACE_SIZE = (64, 64)
+
+MatchResult = namedtuple('MatchResult', ['name', 'score', 'matches', 'best_name', 'best_score'])
+
+UNKNOWN_RESULT = MatchResult("Unknown", 0.0, 0, "Unknown", 0.0)
+
+# Bumped whenever normalization or the snapshot layout changes
+INDEX_SNAPSHOT_VERSION = 1
+
+# Engine attributes that tuner.py sweeps and tuning.json may override
+TUNABLE_PARAMETERS = {
+    'scale_factor': float,
+    'min_neighbors': int,
+    'match_confidence_threshold': float,
+    'recognition_threshold': float,
+    'min_recognition_matches': int,
+    'unique_sample_threshold': float,
+}
+
+
+def normalize_face(face):
+    # Zero-mean, unit-norm vector: the dot product of two of these is the
+    # TM_CCOEFF_NORMED score of the two crops at FACE_SIZE
+    vector = cv2.resize(face, FACE_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32).ravel()
+    vector -= vector.mean()
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+def normalize_faces(faces):
+    if len(faces) == 0:
+        return np.zeros((0, FACE_SIZE[0] * FACE_SIZE[1]), dtype=np.float32)
+    return np.vstack([normalize_face(face) for face in faces])
+
+
+class MatchIndex:
+    # Normalized samples of all persons stacked into one matrix. The rows of
+    # person i are matrix[offsets[i]:offsets[i + 1]].
+    def __init__(self, names, matrix, offsets):
+        self.names = list(names)
+        self.matrix = matrix
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def build(cls, known_faces):
+        names = []
+        blocks = []
+        offsets = [0]
+        for name, samples in known_faces.items():
+            if len(samples) == 0:
+                continue
+            block = normalize_faces(samples)
+            names.append(name)
+            blocks.append(block)
+            offsets.append(offsets[-1] + len(block))
+        if blocks:
+            matrix = np.ascontiguousarray(np.vstack(blocks))
+        else:
+            matrix = normalize_faces([])
+        return cls(names, matrix, offsets)
+
+    def __len__(self):
+        return len(self.names)
+
+    def sample_count(self, name):
+        if name not in self.names:
+            return 0
+        i = self.names.index(name)
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def person_rows(self, name):
+        i = self.names.index(name)
+        return self.matrix[self.offsets[i]:self.offsets[i + 1]]
+
+    def with_samples(self, name, vectors):
+        # Returns a new index with the given normalized vectors appended to a
+        # person, leaving every other row untouched (no re-normalization)
+        vectors = np.atleast_2d(vectors).astype(np.float32)
+        if name in self.names:
+            i = self.names.index(name)
+            end = self.offsets[i + 1]
+            matrix = np.vstack((self.matrix[:end], vectors, self.matrix[end:]))
+            offsets = self.offsets.copy()
+            offsets[i + 1:] += len(vectors)
+            return MatchIndex(self.names, np.ascontiguousarray(matrix), offsets)
+        matrix = np.vstack((self.matrix, vectors))
+        offsets = np.append(self.offsets, self.offsets[-1] + len(vectors))
+        return MatchIndex(self.names + [name], np.ascontiguousarray(matrix), offsets)
+
+    def without(self, name):
+        if name not in self.names:
+            return self
+        i = self.names.index(name)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        matrix = np.vstack((self.matrix[:start], self.matrix[end:]))
+        offsets = np.concatenate((self.offsets[:i + 1], self.offsets[i + 2:] - (end - start)))
+        return MatchIndex(self.names[:i] + self.names[i + 1:], np.ascontiguousarray(matrix), offsets)
+
+    def updated(self, removed=(), appended=None):
+        # without() and with_samples() for many persons in one copy: drops the
+        # removed persons, then appends normalized vectors ({name: rows}) to
+        # the remaining persons or as new persons at the end
+        appended = {name: np.atleast_2d(vectors).astype(np.float32) for name, vectors in (appended or {}).items()}
+        removed = set(removed)
+        names = []
+        blocks = []
+        counts = []
+        for i, name in enumerate(self.names):
+            if name in removed:
+                continue
+            rows = self.matrix[self.offsets[i]:self.offsets[i + 1]]
+            if name in appended:
+                rows = np.vstack((rows, appended.pop(name)))
+            names.append(name)
+            blocks.append(rows)
+            counts.append(len(rows))
+        for name, vectors in appended.items():
+            names.append(name)
+            blocks.append(vectors)
+            counts.append(len(vectors))
+        matrix = np.ascontiguousarray(np.vstack(blocks)) if blocks else normalize_faces([])
+        return MatchIndex(names, matrix, np.concatenate(([0], np.cumsum(counts))))
+
+    def score(self, queries):
+        # (queries x samples) correlation matrix
+        return queries @ self.matrix.T
+
+    def reordered(self, names):
+        # Same persons with the given names first, in that order (one copy of
+        # the matrix); returns self when nothing moves
+        positions = {name: i for i, name in enumerate(self.names)}
+        order = [positions[name] for name in names if name in positions]
+        placed = set(order)
+        order += [i for i in range(len(self.names)) if i not in placed]
+        if order == list(range(len(self.names))):
+            return self
+        counts = np.diff(self.offsets)[order]
+        rows = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in order])
+        return MatchIndex([self.names[i] for i in order], np.ascontiguousarray(self.matrix[rows]),
+                          np.concatenate(([0], np.cumsum(counts))))
+
+    def to_bytes(self, source_hash):
+        # JSON header, then the raw offsets and matrix
+        header = json.dumps({'version': INDEX_SNAPSHOT_VERSION, 'face_size': list(FACE_SIZE),
+                             'source_hash': source_hash, 'names': self.names}).encode('utf-8')
+        return b''.join((struct.pack('<I', len(header)), header, self.offsets.astype('<i8').tobytes(),
+                         np.ascontiguousarray(self.matrix, dtype='<f4').tobytes()))
+
+    @classmethod
+    def from_bytes(cls, data, source_hash):
+        # Returns None unless the snapshot was made from the given face data
+        # with the current normalization. The arrays are read-only views of data.
+        header_size = struct.unpack_from('<I', data)[0]
+        header = json.loads(bytes(data[4:4 + header_size]).decode('utf-8'))
+        if (header['version'] != INDEX_SNAPSHOT_VERSION or tuple(header['face_size']) != FACE_SIZE
+                or header['source_hash'] != source_hash):
+            return None
+        start = 4 + header_size
+        offsets = np.frombuffer(data, dtype='<i8', count=len(header['names']) + 1, offset=start)
+        matrix = np.frombuffer(data, dtype='<f4', offset=start + offsets.nbytes)
+        return cls(header['names'], matrix.reshape(-1, FACE_SIZE[0] * FACE_SIZE[1]), offsets)
+
+
+# face_data.enc: FACE_DATA_MAGIC, then per person a FACE_RECORD_HEADER (name
+# and token length), the UTF-8 name and a Fernet token of the pickled sample
+# list. Persons are encrypted one by one, so a save copies the tokens of
+# unchanged persons as they are and cold-tier persons are never read back.
+# Older files are one token of the whole pickled dict; they are still read
+# and get the new layout on the next save.
+FACE_DATA_MAGIC = b"FACEDATA2\n"
+FACE_RECORD_HEADER = struct.Struct('<HI')
+TOKEN_HEAD = 48  # Fernet version, timestamp and IV: differ between any two encryptions
+
+
+def sample_checksums(samples):
+    return tuple(zlib.crc32(np.ascontiguousarray(sample).tobytes()) for sample in samples)
+
+
+def face_data_version(faces):
+    # Per person: a checksum of every sample, in file order. Samples are told
+    # apart by content, so processes that append in a different order still
+    # agree on which samples are new.
+    return {name: sample_checksums(samples) for name, samples in faces.items()}
+
+
+def file_hash(f):
+    f.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(2**20), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_face_records(f):
+    # {name: (offset, length, head)} of each person's token, or None for the
+    # old single-token layout. Only the record headers are read.
+    f.seek(0)
+    if f.read(len(FACE_DATA_MAGIC)) != FACE_DATA_MAGIC:
+        return None
+    records = {}
+    while True:
+        header = f.read(FACE_RECORD_HEADER.size)
+        if len(header) < FACE_RECORD_HEADER.size:
+            return records
+        name_size, token_size = FACE_RECORD_HEADER.unpack(header)
+        name = f.read(name_size).decode('utf-8')
+        offset = f.tell()
+        records[name] = (offset, token_size, f.read(min(TOKEN_HEAD, token_size)))
+        f.seek(offset + token_size)
+
+
+def read_face_samples(f, fernet, record):
+    f.seek(record[0])
+    return pickle.loads(fernet.decrypt(f.read(record[1])))
+
+
+def read_face_file(f, fernet):
+    # (faces, records) of an open face data file; records is None for the old layout
+    records = read_face_records(f)
+    if records is None:
+        f.seek(0)
+        return pickle.loads(fernet.decrypt(f.read())), None
+    return {name: read_face_samples(f, fernet, record) for name, record in records.items()}, records
+
+
+def person_totals(index, scores, match_confidence_threshold):
+    # (queries x persons) number of samples above the threshold and their score sum
+    starts = index.offsets[:-1]
+    above = scores > match_confidence_threshold
+    counts = np.add.reduceat(above.astype(np.int32), starts, axis=1)
+    sums = np.add.reduceat(np.where(above, scores, 0.0), starts, axis=1)
+    return counts, sums
+
+
+def decide_identities(index, scores, match_confidence_threshold, recognition_threshold, min_recognition_matches):
+    # Per person: how many samples pass the match confidence threshold and
+    # the average score of those samples. The person with the most passing
+    # samples wins if they also meet the recognition thresholds.
+    # Returns per query: person index (-1 for unknown), that person's average
+    # score and match count, and the best single score with its owner.
+    counts, sums = person_totals(index, scores, match_confidence_threshold)
+    rows = np.arange(scores.shape[0])
+
+    persons = counts.argmax(axis=1)
+    most_matches = counts[rows, persons]
+    averages = np.where(most_matches > 0, sums[rows, persons] / np.maximum(most_matches, 1), 0.0)
+    recognized = (most_matches >= min_recognition_matches) & (most_matches > 0) & (averages > recognition_threshold)
+    identities = np.where(recognized, persons, -1)
+
+    best_rows = scores.argmax(axis=1)
+    best_scores = np.maximum(scores[rows, best_rows], 0.0)
+    best_owners = np.searchsorted(index.offsets, best_rows, side='right') - 1
+    return identities, averages, most_matches, best_scores, best_owners
+
+
+def assign_identities(index, scores, match_confidence_threshold, recognition_threshold, min_recognition_matches,
+                      taken=()):
+    # One-to-one version of decide_identities for the faces of one frame: no
+    # person is given to two faces, nor to a face when already in taken
+    # (person indices). When faces claim the same person, the (face, person)
+    # pairs passing the recognition thresholds are assigned greedily, most
+    # matching samples first; a face whose candidates are all taken stays
+    # unknown. Faces decide_identities leaves unknown stay unknown.
+    identities, averages, counts, best_scores, best_owners = decide_identities(
+        index, scores, match_confidence_threshold, recognition_threshold, min_recognition_matches)
+    claimed = identities[identities >= 0]
+    taken = set(int(p) for p in taken)
+    if len(np.unique(claimed)) == len(claimed) and not taken.intersection(claimed.tolist()):
+        return identities, averages, counts, best_scores, best_owners
+
+    person_counts, person_sums = person_totals(index, scores, match_confidence_threshold)
+    person_averages = person_sums / np.maximum(person_counts, 1)
+    eligible = (person_counts >= min_recognition_matches) & (person_counts > 0) & (person_averages > recognition_threshold)
+    eligible[identities < 0] = False
+    if taken:
+        eligible[:, sorted(taken)] = False
+    faces, persons = np.nonzero(eligible)
+    order = np.lexsort((-person_averages[faces, persons], -person_counts[faces, persons]))
+    identities = np.full(scores.shape[0], -1)
+    for k in order:
+        face, person = faces[k], persons[k]
+        if identities[face] < 0 and person not in taken:
+            identities[face] = person
+            taken.add(person)
+            averages[face] = person_averages[face, person]
+            counts[face] = person_counts[face, person]
+    return identities, averages, counts, best_scores, best_owners
+
+
+class RecognitionEngine:
+    # Detection, matching, smart learning and attendance logic without any Qt
+    # dependency, shared by the GUI and the headless daemon
+    def __init__(self, base_dir=BASE_DIR, attendance_file=None, gallery_budget_mb=None,
+                 attendance_dir=None, node_id=None, event_log=True, event_bus=True):
+        # attendance.xlsx is an export of the attendance store, which may live in a
+        # directory shared by several kiosks
+        self.attendance_file = attendance_file or os.path.join(base_dir, "attendance.xlsx")
+        self.attendance_dir = attendance_dir or os.path.join(base_dir, "attendance_data")
+        self.face_data_file = os.path.join(base_dir, "face_data.enc")
+        self.index_snapshot_file = os.path.join(base_dir, "face_index.enc")
+        self.key_file = os.path.join(base_dir, "encryption.key")
+        self.encryption_key = self.load_or_create_key()
+        self.fernet = Fernet(self.encryption_key)
+        # Bulk cipher for the match index snapshot, keyed from the same key file
+        self.snapshot_cipher = AESGCM(hashlib.sha256(b"match-index:" + self.encryption_key).digest())
+        self.persist_face_data = True  # Replays keep learned samples in memory only
+        # face_data.enc is written on a saver thread, one save at a time: only
+        # persons changed since the last save are encrypted, the others are
+        # copied from the current file (see face_data_records)
+        self.face_data_lock = threading.Lock()  # Held while the file and its hash, version and records change
+        self.face_data_saver = None
+        self.face_data_saving = False
+        self.dirty_persons = set()
+        self.defer_face_data_save = False  # Set while a crowd frame is processed; saved once after it
+        self.face_data_dirty = False
+
+        # Smart learning variables
+        self.smart_learning_enabled = True
+        self.learning_threshold = 0.9  # Higher threshold to trigger more learning
+        self.recognition_threshold = 0.65  # Lower threshold for better recognition
+        self.max_samples_per_person = float('inf')  # Unlimited face samples per person
+        self.last_learning_time = {}  # To prevent too frequent updates for the same person
+        self.learning_interval = 2.0  # Seconds between learned samples of one person
+        self.unique_sample_threshold = 0.85  # Samples more similar than this are not stored again
+
+        # Enhanced face recognition variables
+        self.min_recognition_matches = 2  # Minimum number of face samples that must match for recognition
+        self.match_confidence_threshold = 0.60  # Minimum confidence for a single face match
+
+        # Crowd mode: the faces of a frame are matched as one batch with
+        # one-to-one assignment and their marks are committed together
+        self.crowd_mode = False
+
+        # Face detection parameters
+        self.scale_factor = 1.3
+        self.min_neighbors = 5
+
+        # Parameters chosen with tuner.py replace the defaults above
+        self.tuning_file = os.path.join(base_dir, "tuning.json")
+        self.load_tuning(self.tuning_file)
+
+        # Attendance confirmation variables
+        self.pending_attendance = None  # Person waiting for attendance confirmation
+        self.confirmation_start_time = None  # When confirmation countdown started
+        self.confirmation_duration = 0  # No waiting time for attendance confirmation
+
+        # Attendance, smart learning and unknown face events (see events.json);
+        # off for replays and tools, whose marks must not reach the subscribers
+        self.event_bus = load_event_bus(os.path.join(base_dir, "events.json")) if event_bus else None
+        self.unknown_event_interval = 1.0  # Seconds between unknown face events
+        self.last_unknown_event = 0.0
+
+        # Face detection classifier, one per thread: a CascadeClassifier must
+        # not run on two threads at once (the daemon detects in an executor)
+        self.cascade_local = threading.local()
+        self.tiled_detector = None  # See enable_tiled_detection()
+
+        # Load existing face data
+        self.known_faces = {}  # Dictionary to store face data
+        self.index = MatchIndex.build({})
+        self.gallery = None
+        self.load_face_data()
+        self.gallery_watcher = None  # See watch_gallery()
+        self.pending_reload = None  # Prepared by the gallery watcher, applied by match_faces
+
+        # Class/session rosters (rosters.json): the active session's students are
+        # searched first. The index keeps each roster's students next to each
+        # other so a roster is a slice of it.
+        from rosters import RosterSchedule
+        self.rosters = RosterSchedule.load(os.path.join(base_dir, "rosters.json"))
+        self.session = None
+        self.session_fixed = False  # Set by set_session(); disables the schedule
+        self.session_checked = 0.0
+        self.roster = None  # (session name, index it was taken from, roster index)
+        self.roster_hits = 0
+        self.roster_fallbacks = 0
+        self.order_index_by_roster()
+
+        # Optional RAM budget: rarely matched persons move to a compressed cold tier on disk
+        if gallery_budget_mb:
+            from gallery_tiers import TieredGallery
+            self.gallery = TieredGallery(self, int(gallery_budget_mb * 2**20), os.path.join(base_dir, "gallery_cold"))
+            self.gallery.apply()
+
+        # Each node appends to its own segments; an existing attendance.xlsx is migrated once
+        self.attendance_store = AttendanceStore(self.attendance_dir, node_id, excel_file=self.attendance_file)
+        if not os.path.exists(self.attendance_store.store_file) and not os.listdir(self.attendance_store.segment_dir):
+            if os.path.exists(self.attendance_file):
+                imported = self.attendance_store.import_excel(self.attendance_file)
+                print(f"Imported {imported} attendance records from {self.attendance_file}")
+            self.attendance_store.compact()
+
+        # Structured log of every recognition decision (see event_log.py query)
+        self.event_log = EventLog(os.path.join(base_dir, "event_logs"), self.attendance_store.node_id) if event_log else None
+
+    def load_or_create_key(self):
+        if os.path.exists(self.key_file):
+            with open(self.key_file, "rb") as f:
+                return f.read()
+        else:
+            key = Fernet.generate_key()
+            with open(self.key_file, "wb") as f:
+                f.write(key)
+            return key
+
+    def load_tuning(self, tuning_file):
+        if not os.path.exists(tuning_file):
+            return
+        try:
+            with open(tuning_file, "r", encoding="utf-8") as f:
+                config = json.load(f)
+            for name, value in config.get('parameters', {}).items():
+                if name in TUNABLE_PARAMETERS:
+                    setattr(self, name, TUNABLE_PARAMETERS[name](value))
+            print(f"Loaded tuned parameters from {tuning_file}")
+        except Exception as e:
+            print(f"Error loading tuned parameters: {e}")
+
+    def load_face_data(self):
+        self.face_data_hash = None  # SHA-256 of face_data.enc, ties the index snapshot to it
+        self.face_data_records = {}  # Where each person's token is in face_data.enc
+        self.index_snapshot_stale = False
+        if os.path.exists(self.face_data_file):
+            try:
+                with open(self.face_data_file, "rb") as f:
+                    self.known_faces, records = read_face_file(f, self.fernet)
+                    self.face_data_hash = file_hash(f)
+                self.face_data_records = records or {}
+            except Exception as e:
+                print(f"Error loading face data: {e}")
+                self.known_faces = {}
+
+        # Normalizing every sample is the slow part of startup, so the prepared
+        # index is reused as long as face_data.enc has not changed
+        index = self.load_index_snapshot()
+        if index is None:
+            start = time.perf_counter()
+            index = MatchIndex.build(self.known_faces)
+            print(f"Built match index ({len(index.matrix)} samples) in {time.perf_counter() - start:.2f}s")
+            self.index_snapshot_stale = True
+        self.index = index
+        self.face_data_version = face_data_version(self.known_faces)  # What face_data.enc holds, see gallery_watch.py
+        if self.index_snapshot_stale:
+            self.save_index_snapshot()
+
+    def load_index_snapshot(self):
+        if self.face_data_hash is None or not os.path.exists(self.index_snapshot_file):
+            return None
+        start = time.perf_counter()
+        try:
+            with open(self.index_snapshot_file, "rb") as f:
+                data = f.read()
+            index = MatchIndex.from_bytes(self.snapshot_cipher.decrypt(data[:12], memoryview(data)[12:], None),
+                                          self.face_data_hash)
+        except Exception as e:
+            print(f"Error loading match index snapshot: {e}")
+            return None
+        if index is None:
+            print("Match index snapshot is out of date; rebuilding")
+            return None
+        # The snapshot must describe exactly the persons and sample counts just loaded
+        counts = {name: len(samples) for name, samples in self.known_faces.items() if len(samples)}
+        if counts != {name: index.sample_count(name) for name in index.names}:
+            print("Match index snapshot does not match the face data; rebuilding")
+            return None
+        print(f"Loaded match index snapshot ({len(index.matrix)} samples) in {(time.perf_counter() - start) * 1000:.0f} ms")
+        return index
+
+    def save_index_snapshot(self):
+        # Skipped while cold-tier persons are missing from the index; the next
+        # start rebuilds from face_data.enc instead
+        if not self.persist_face_data or self.face_data_hash is None:
+            return
+        if self.gallery is not None and self.gallery.cold:
+            return
+        try:
+            nonce = os.urandom(12)
+            encrypted_data = nonce + self.snapshot_cipher.encrypt(nonce, self.index.to_bytes(self.face_data_hash), None)
+            tmp_file = self.index_snapshot_file + ".tmp"
+            with open(tmp_file, "wb") as f:
+                f.write(encrypted_data)
+            os.replace(tmp_file, self.index_snapshot_file)
+            self.index_snapshot_stale = False
+        except Exception as e:
+            print(f"Error saving match index snapshot: {e}")
+
+    def save_face_data(self):
+        # Plans the save on the calling thread (the one that changes the
+        # gallery) and writes it on the saver thread. While a save is being
+        # written, further saves are merged into the next one (see match_faces).
+        if not self.persist_face_data:
+            return
+        if self.defer_face_data_save or self.face_data_saving:
+            self.face_data_dirty = True
+            return
+        self.face_data_dirty = False
+        try:
+            if self.gallery_watcher is not None:
+                # Take in changes from other processes first instead of overwriting them
+                self.gallery_watcher.sync()
+            dirty, self.dirty_persons = self.dirty_persons, set()
+            records = self.face_data_records
+            # Changed persons are written from memory, the rest copied still encrypted
+            faces = {name: list(samples) if name in dirty or name not in records else None
+                     for name, samples in self.known_faces.items()}
+            if self.face_data_saver is None:
+                self.face_data_saver = ThreadPoolExecutor(1, thread_name_prefix="face-data-save")
+            self.face_data_saving = True
+            self.face_data_saver.submit(self.write_face_data, faces, dirty, records, self.face_data_version)
+        except Exception as e:
+            self.face_data_saving = False
+            print(f"Error saving face data: {e}")
+
+    def write_face_data(self, faces, dirty, records, version):
+        # Runs on the saver thread. records and version describe the file the
+        # save was planned on; if it was replaced since (a reload, or another
+        # process), nothing is written and the save is planned again.
+        tmp_file = self.face_data_file + ".tmp"
+        source = None
+        written = False
+        try:
+            copying = any(samples is None for samples in faces.values())
+            if copying:
+                source = open(self.face_data_file, "rb")
+                source_stat = os.fstat(source.fileno())
+                if read_face_records(source) != records:
+                    return
+            digest = hashlib.sha256()
+            new_records = {}
+            new_version = {}
+            with open(tmp_file, "wb") as f:
+                f.write(FACE_DATA_MAGIC)
+                digest.update(FACE_DATA_MAGIC)
+                for name, samples in faces.items():
+                    if samples is None:
+                        offset, size, _ = records[name]
+                        source.seek(offset)
+                        token = source.read(size)
+                        new_version[name] = version[name]
+                    else:
+                        token = self.fernet.encrypt(pickle.dumps(samples))
+                        new_version[name] = sample_checksums(samples)
+                    header = FACE_RECORD_HEADER.pack(len(name.encode('utf-8')), len(token)) + name.encode('utf-8')
+                    f.write(header)
+                    new_records[name] = (f.tell(), len(token), token[:TOKEN_HEAD])
+                    f.write(token)
+                    digest.update(header)
+                    digest.update(token)
+            # The own watcher must not poll between the replace and the new
+            # hash: it would take this save for another process's and apply
+            # the new samples a second time
+            with self.face_data_lock:
+                if self.face_data_records is not records:
+                    return
+                if copying:
+                    stat = os.stat(self.face_data_file)
+                    if (stat.st_ino, stat.st_mtime_ns, stat.st_size) != \
+                            (source_stat.st_ino, source_stat.st_mtime_ns, source_stat.st_size):
+                        return
+                # Replaced in one step: other processes watching the file never read half of it
+                os.replace(tmp_file, self.face_data_file)
+                self.face_data_hash = digest.hexdigest()
+                self.face_data_version = new_version
+                self.face_data_records = new_records
+                # The index snapshot is rewritten on close rather than on every learned sample
+                self.index_snapshot_stale = True
+            written = True
+        except Exception as e:
+            print(f"Error saving face data: {e}")
+        finally:
+            if source is not None:
+                source.close()
+            if not written:
+                self.dirty_persons.update(dirty)
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+            self.face_data_saving = False
+            if not written and self.gallery_watcher is None and self.face_data_records is records:
+                # Nobody takes in the other process's file: overwrite it from memory as before
+                self.face_data_records = {}
+            if not written:
+                self.face_data_dirty = True
+
+    def flush_face_data(self):
+        # Waits for the save being written and writes what is still unsaved
+        for _ in range(3):
+            if self.face_data_saver is not None:
+                self.face_data_saver.submit(lambda: None).result()
+            if not self.face_data_dirty:
+                return
+            self.save_face_data()
+
+    def enable_tiled_detection(self, tile_size=640, workers=None):
+        # High-resolution frames are split into overlapping tiles detected in parallel
+        from tiled_detector import TiledDetector
+        self.tiled_detector = TiledDetector(tile_size, workers=workers)
+        print(f"Tiled detection: {tile_size}px tiles, {self.tiled_detector.workers} workers")
+
+    @property
+    def face_cascade(self):
+        if not hasattr(self.cascade_local, 'cascade'):
+            self.cascade_local.cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        return self.cascade_local.cascade
+
+    def detect_faces(self, gray, scale=1.0):
+        # A scale below 1 runs the cascade on a downsized frame and maps the
+        # boxes back to full resolution
+        if scale < 1.0:
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        if self.tiled_detector is not None:
+            faces = self.tiled_detector.detect(gray, self.scale_factor, self.min_neighbors)
+        else:
+            faces = self.face_cascade.detectMultiScale(gray, self.scale_factor, self.min_neighbors)
+        if scale >= 1.0 or len(faces) == 0:
+            return faces
+        return (np.asarray(faces) / scale).astype(np.int32)
+
+    def match_faces(self, face_rois, one_to_one=False):
+        # Score every face against every stored sample in one vectorized pass.
+        # one_to_one: the faces come from one frame, so each person is given
+        # to at most one of them (see assign_identities).
+        reload = self.pending_reload
+        if reload is not None:
+            self.pending_reload = None
+            self.apply_gallery_reload(reload)
+        if self.face_data_dirty and not self.defer_face_data_save and not self.face_data_saving:
+            # Changes made while the last save was being written
+            self.save_face_data()
+        index = self.index  # Local reference: the index may be swapped concurrently
+        if len(face_rois) == 0:
+            return []
+        vectors = normalize_faces(face_rois)
+        taken = set() if one_to_one else None
+        roster = self.roster_index(index)
+        if roster is not None:
+            # Active session first; faces no roster student passes for are matched against everyone
+            results = self.decide(roster, roster.score(vectors), taken)
+            fallback = [i for i, result in enumerate(results) if result.name == "Unknown"]
+            self.roster_hits += len(results) - len(fallback)
+            self.roster_fallbacks += len(fallback)
+            if fallback:
+                for i, result in zip(fallback, self.decide(index, index.score(vectors[fallback]), taken)):
+                    results[i] = result
+        else:
+            results = self.decide(index, index.score(vectors), taken) if len(index) else [UNKNOWN_RESULT] * len(face_rois)
+        if self.gallery is not None:
+            unknown = [i for i, result in enumerate(results) if result.name == "Unknown"]
+            # Faces the hot tier did not recognize may belong to cold persons
+            if unknown and self.gallery.promote_candidates(vectors[unknown]):
+                index = self.index
+                for i, result in zip(unknown, self.decide(index, index.score(vectors[unknown]), taken)):
+                    results[i] = result
+            for result in results:
+                if result.name != "Unknown":
+                    self.gallery.touch(result.name)
+        return results
+
+    def watch_gallery(self, interval=2.0):
+        # Picks up students enrolled or removed by other processes while running
+        from gallery_watch import GalleryWatcher
+
+        if self.persist_face_data and self.gallery_watcher is None:
+            self.gallery_watcher = GalleryWatcher(self, interval)
+
+    def apply_gallery_reload(self, reload):
+        # Swaps in the index prepared by the gallery watcher and applies the
+        # same delta to known_faces. Returns False, and has the watcher
+        # prepare it again, when the index changed in the meantime.
+        if reload['base'] is not self.index:
+            self.gallery_watcher.retry()
+            return False
+        gallery = self.gallery
+        for name in reload['removed'] + list(reload['replaced']):
+            if gallery is not None:
+                gallery.forget(name)
+            self.known_faces.pop(name, None)
+            self.last_learning_time.pop(name, None)
+        for name, samples in reload['replaced'].items():
+            self.known_faces[name] = [np.array(sample) for sample in samples]
+        for name, samples in reload['appended'].items():
+            self.known_faces[name].extend(np.array(sample) for sample in samples)
+        self.index = reload['index']
+        with self.face_data_lock:
+            self.face_data_hash = reload['hash']
+            self.face_data_version = reload['version']
+            self.face_data_records = reload['records']
+            self.index_snapshot_stale = True
+        if gallery is not None:
+            for name in list(reload['replaced']) + list(reload['appended']):
+                if name in self.index.names:
+                    gallery.changed(name)
+        self.gallery_watcher.reloads += 1
+        print(f"Gallery reloaded: {len(reload['replaced'])} added or replaced, {len(reload['appended'])} with new "
+              f"samples, {len(reload['removed'])} removed (prepared in {reload['seconds'] * 1000:.0f} ms)")
+        return True
+
+    def order_index_by_roster(self):
+        if self.rosters.sessions:
+            index = self.index.reordered(self.rosters.student_order())
+            if index is not self.index:
+                self.index = index
+                self.index_snapshot_stale = True
+
+    def roster_stats(self):
+        matched = self.roster_hits + self.roster_fallbacks
+        roster = self.roster[2] if self.session is not None and self.roster is not None else None
+        return {
+            'session': self.session['name'] if self.session is not None else None,
+            'roster_samples': len(roster.matrix) if roster is not None else 0,
+            'roster_hits': self.roster_hits,
+            'fallbacks': self.roster_fallbacks,
+            'fallback_rate': self.roster_fallbacks / matched if matched else 0.0,
+        }
+
+    def update_session(self):
+        # Follows the schedule, checked at most once a second
+        now = time.time()
+        if not self.session_fixed and now - self.session_checked >= 1.0:
+            self.session_checked = now
+            session = self.rosters.active()
+            if session is not self.session:
+                self.switch_session(session)
+        return self.session
+
+    def set_session(self, name):
+        # Pins a session by name (None follows the schedule again)
+        self.session_fixed = name is not None
+        session = self.rosters.get(name) if name is not None else self.rosters.active()
+        if name is not None and session is None:
+            raise ValueError(f"Unknown session: {name}")
+        self.switch_session(session)
+
+    def switch_session(self, session):
+        self.session = session
+        print(f"Session: {session['name'] if session else 'none'}")
+        if session is not None:
+            if self.gallery is not None:
+                for name in session['students']:
+                    self.gallery.ensure_hot(name)
+            index = self.index
+            self.roster = (session['name'], index, self.rosters.view(index, session)[0])
+
+    def roster_index(self, index):
+        # The active session's part of index, taken again only when the index changed
+        session = self.update_session()
+        if session is None:
+            return None
+        if self.roster is None or self.roster[0] != session['name'] or self.roster[1] is not index:
+            self.roster = (session['name'], index, self.rosters.view(index, session)[0])
+        return self.roster[2]
+
+    def match_face(self, face_roi):
+        return self.match_faces([face_roi])[0]
+
+    def decide(self, index, scores, taken=None):
+        # taken: names already given to other faces of the same frame, for a
+        # one-to-one assignment (updated with the names given here); None
+        # decides each face on its own
+        thresholds = (self.match_confidence_threshold, self.recognition_threshold, self.min_recognition_matches)
+        if taken is None:
+            identities, averages, counts, best_scores, best_owners = decide_identities(index, scores, *thresholds)
+        else:
+            identities, averages, counts, best_scores, best_owners = assign_identities(
+                index, scores, *thresholds, taken=[i for i, name in enumerate(index.names) if name in taken])
+            taken.update(index.names[i] for i in identities if i >= 0)
+        results = []
+        for q in range(scores.shape[0]):
+            best_score = float(best_scores[q])
+            best_name = index.names[best_owners[q]] if best_score > 0 else "Unknown"
+            if identities[q] >= 0:
+                results.append(MatchResult(index.names[identities[q]], float(averages[q]), int(counts[q]), best_name, best_score))
+            else:
+                results.append(MatchResult("Unknown", best_score, int(counts[q]), best_name, best_score))
+        return results
+
+    def process_frame(self, frame):
+        # Runs detection and recognition on one BGR frame and applies the
+        # attendance confirmation and smart learning rules
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        faces = self.detect_faces(gray)
+        return gray, faces, self.recognize_faces(gray, faces)
+
+    def recognize_faces(self, gray, faces, track_ids=None, started=None):
+        # track_ids and started (perf_counter at the start of the frame) only
+        # go into the event log
+        outcomes = []
+        current_time = time.time()
+        started = started or time.perf_counter()
+
+        # Reset pending attendance if no faces are detected
+        if len(faces) == 0 and self.pending_attendance is not None:
+            # Only reset if it's been at least 1 second since confirmation started
+            # This prevents flickering when face detection temporarily fails
+            if self.confirmation_start_time is not None and (current_time - self.confirmation_start_time) > 1.0:
+                self.log_event('confirmation_reset', self.pending_attendance)
+                self.pending_attendance = None
+                self.confirmation_start_time = None
+                outcomes.append({'status': 'reset', 'box': None, 'name': "Unknown", 'score': 0.0,
+                                 'best_name': "Unknown", 'learning': None})
+            return outcomes
+
+        rois = [gray[y:y+h, x:x+w] for (x, y, w, h) in faces]
+        crowd = self.crowd_mode
+        results = self.match_faces(rois, one_to_one=crowd)
+        latency_ms = (time.perf_counter() - started) * 1000
+        track_ids = track_ids or [-1] * len(results)
+        if crowd:
+            # The whole frame's marks go to the store in one write, and samples
+            # learned from the frame are saved once after it
+            newly_marked = set(self.mark_attendance_batch([result.name for result in results]))
+            self.defer_face_data_save = True
+        try:
+            for (x, y, w, h), face_roi, result, track in zip(faces, rois, results, track_ids):
+                outcome = {'box': (int(x), int(y), int(w), int(h)), 'name': result.name,
+                           'score': result.score, 'best_name': result.best_name, 'learning': None}
+                if result.name != "Unknown":
+                    name = result.name
+                    if crowd:
+                        outcome['status'] = 'marked' if name in newly_marked else 'already_marked'
+                    elif self.pending_attendance == name:
+                        # Already marked for this person
+                        outcome['status'] = 'already_marked'
+                    else:
+                        # Mark attendance immediately without countdown
+                        self.mark_attendance(name)
+                        self.pending_attendance = name
+                        outcome['status'] = 'marked'
+
+                    # Smart learning - update face data if recognition is successful but score is not very high
+                    if self.smart_learning_enabled and result.score < self.learning_threshold:
+                        # Check if we haven't updated this person's data recently (at least 2 seconds ago)
+                        if name not in self.last_learning_time or (current_time - self.last_learning_time[name]) > self.learning_interval:
+                            outcome['learning'] = self.update_face_data(name, face_roi)
+                            self.last_learning_time[name] = current_time
+                else:
+                    outcome['status'] = 'unknown'
+                    if current_time - self.last_unknown_event >= self.unknown_event_interval:
+                        self.last_unknown_event = current_time
+                        self.publish('unknown_face', best_name=result.best_name,
+                                     best_score=result.best_score, box=outcome['box'])
+                    # If we were in the middle of confirming attendance, reset it
+                    if self.pending_attendance is not None:
+                        self.log_event('confirmation_lost', self.pending_attendance, result.score, track, latency_ms)
+                        self.pending_attendance = None
+                        outcome['confirmation_lost'] = True
+                self.log_event(outcome['status'], result.name if result.name != "Unknown" else result.best_name,
+                               result.score, track, latency_ms)
+                if outcome['learning'] is not None:
+                    self.log_event('learning_' + outcome['learning'], result.name, result.score, track, latency_ms)
+                outcomes.append(outcome)
+        finally:
+            if crowd:
+                self.defer_face_data_save = False
+                if self.face_data_dirty:
+                    self.save_face_data()
+        return outcomes
+
+    def log_event(self, kind, candidate, score=float('nan'), track=-1, latency_ms=float('nan')):
+        if self.event_log is not None:
+            self.event_log.record(kind, candidate, score, track, latency_ms)
+
+    def confirmation_remaining(self):
+        if self.confirmation_start_time is None:
+            return 0
+        elapsed_time = time.time() - self.confirmation_start_time
+        return max(0, self.confirmation_duration - elapsed_time)
+
+    def mark_attendance(self, name, when=None, session=None):
+        return bool(self.mark_attendance_batch([name], when, session))
+
+    def mark_attendance_batch(self, names, when=None, session=None):
+        # Commits the marks of several faces with one store write; returns
+        # the names marked for the first time that day. when and session
+        # default to now and the active session (offline attendance passes
+        # the time and session a person was seen in a recording).
+        names = [name for name in names if name != "Unknown"]
+        if not names:
+            return []
+        current_time = when or datetime.now()
+        if session is None:
+            session = self.session['name'] if self.session is not None else ''
+        marked = self.attendance_store.mark_many(names, current_time, session)
+        for name in marked:
+            self.publish('attendance', name=name, date=current_time.strftime("%Y-%m-%d"),
+                         time=current_time.strftime("%H:%M:%S"), session=session)
+        return marked
+
+    def compact_attendance(self, export=True):
+        # Merges all nodes' segments into the consolidated store and refreshes attendance.xlsx
+        try:
+            return self.attendance_store.compact(export)
+        except Exception as e:
+            print(f"Error compacting attendance: {e}")
+            return None
+
+    def publish(self, event_type, **data):
+        if self.event_bus is not None:
+            self.event_bus.publish(event_type, **data)
+
+    def close(self):
+        self.flush_face_data()
+        if self.face_data_saver is not None:
+            self.face_data_saver.shutdown()
+            self.face_data_saver = None
+        if self.gallery_watcher is not None:
+            self.gallery_watcher.close()
+            self.gallery_watcher = None
+        if self.tiled_detector is not None:
+            self.tiled_detector.close()
+            self.tiled_detector = None
+        if self.gallery is not None:
+            self.gallery.close()
+        if self.index_snapshot_stale:
+            self.save_index_snapshot()
+        self.compact_attendance()
+        if self.event_bus is not None:
+            self.event_bus.stop()
+            self.event_bus = None
+        if self.event_log is not None:
+            self.event_log.close()
+            self.event_log = None
+
+    def load_attendance(self):
+        # Called from the UI thread: only the store is merged; attendance.xlsx
+        # is rewritten by the periodic background compaction
+        self.compact_attendance(export=False)
+        return pd.DataFrame([[record.get(field) or '' for field in EXPORT_FIELDS] for record in self.attendance_store.read_store()],
+                            columns=EXPORT_FIELDS)
+
+    def export_attendance(self, path, start_date=None, end_date=None, names=None, sessions=None, on_finished=None):
+        # Runs on a background thread; poll the returned export for progress or cancel it
+        from attendance_export import AttendanceExport
+
+        return AttendanceExport(self.attendance_store, path, start_date, end_date, names, sessions,
+                                on_finished=on_finished).start()
+
+    def update_face_data(self, name, new_face_sample):
+        # Returns 'added', 'skipped' or 'created'
+        if name in self.known_faces:
+            if self.gallery is not None:
+                self.gallery.ensure_hot(name)
+            # Check if this sample is sufficiently different from existing samples
+            vector = normalize_face(new_face_sample)
+            existing = self.index.person_rows(name) if name in self.index.names else normalize_faces([])
+            # If too similar to an existing sample, don't add it
+            if len(existing) and float((existing @ vector).max()) > self.unique_sample_threshold:
+                print(f"Smart learning: Skipped similar face sample for {name}")
+                self.publish('smart_learning', name=name, action='skipped')
+                return 'skipped'
+            if len(self.known_faces[name]) >= self.max_samples_per_person:
+                return 'skipped'
+
+            # Add the new face sample since it's unique (an own copy: the crop
+            # may be a view into a reused frame buffer)
+            self.known_faces[name].append(np.array(new_face_sample))
+            self.dirty_persons.add(name)
+            self.index = self.index.with_samples(name, vector)
+            if self.gallery is not None:
+                self.gallery.changed(name)
+            self.save_face_data()
+            print(f"Smart learning: Added new unique face sample for {name}")
+            self.publish('smart_learning', name=name, action='added', samples=len(self.known_faces[name]))
+            return 'added'
+        # If this is a new person, initialize with this sample
+        self.add_person(name, [new_face_sample])
+        print(f"Smart learning: Created new face profile for {name}")
+        self.publish('smart_learning', name=name, action='created', samples=1)
+        return 'created'
+
+    def add_person(self, name, samples):
+        if self.gallery is not None:
+            self.gallery.forget(name)
+        self.known_faces[name] = [np.array(sample) for sample in samples]
+        self.dirty_persons.add(name)
+        self.index = self.index.without(name).with_samples(name, normalize_faces(samples))
+        self.order_index_by_roster()
+        if self.gallery is not None:
+            self.gallery.changed(name)
+        self.save_face_data()
+
+    def remove_person(self, name):
+        if name not in self.known_faces:
+            return False
+        del self.known_faces[name]
+        self.last_learning_time.pop(name, None)
+        self.index = self.index.without(name)
+        if self.gallery is not None:
+            self.gallery.forget(name)
+        self.save_face_data()
+
+        # Remove from attendance records (applied by the next compaction on every node)
+        self.attendance_store.remove(name)
+        return True
+
+    def prune_learning_times(self, now=None):
+        # Entries older than the learning interval no longer hold anything
+        # back; entries of removed persons are never read again
+        now = now if now is not None else time.time()
+        stale = [name for name, when in self.last_learning_time.items()
+                 if now - when > self.learning_interval or name not in self.known_faces]
+        for name in stale:
+            del self.last_learning_time[name]
+        return len(stale)
+
+    def trim_face_samples(self, limit, keep_first=8):
+        # Caps every resident person at limit samples: the first keep_first
+        # (enrollment) and the most recently learned ones are kept. Cold
+        # persons are left alone, their samples are not in memory. Returns
+        # the number of samples dropped.
+        keep_first = min(keep_first, limit)
+        cold = self.gallery.cold if self.gallery is not None else {}
+        dropped = 0
+        for name, samples in list(self.known_faces.items()):
+            if name in cold or len(samples) <= limit:
+                continue
+            kept = samples[:keep_first] + samples[len(samples) - (limit - keep_first):]
+            dropped += len(samples) - len(kept)
+            self.known_faces[name] = kept
+            self.dirty_persons.add(name)
+            # A person left without samples has no rows and leaves the index
+            # (as in MatchIndex.build): matching expects at least one per person
+            self.index = self.index.without(name)
+            if not kept:
+                if self.gallery is not None:
+                    self.gallery.forget(name)
+                continue
+            self.index = self.index.with_samples(name, normalize_faces(kept))
+            if self.gallery is not None:
+                self.gallery.changed(name)
+        if dropped:
+            self.order_index_by_roster()
+            self.save_face_data()
+        return dropped
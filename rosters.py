@@ -0,0 +1,111 @@
+import argparse
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+
+from recognition_engine import BASE_DIR, MatchIndex
+
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+
+class RosterSchedule:
+    # Class/session rosters from rosters.json:
+    # {"sessions": [{"name": "CSE101-A", "days": ["mon", "wed"],
+    #                "start": "09:00", "end": "10:30", "students": [...]}]}
+    # days may be left out for a session held every day.
+    def __init__(self, sessions=()):
+        self.sessions = []
+        for session in sessions:
+            session = dict(session)
+            session['days'] = [day.lower()[:3] for day in session.get('days', DAYS)]
+            session['students'] = list(session.get('students', []))
+            session['members'] = set(session['students'])
+            self.sessions.append(session)
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return cls()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                schedule = cls(json.load(f).get('sessions', []))
+            print(f"Loaded {len(schedule.sessions)} sessions from {path}")
+            return schedule
+        except Exception as e:
+            print(f"Error loading rosters: {e}")
+            return cls()
+
+    def active(self, when=None):
+        # The first session running at the given time, or None
+        when = when or datetime.now()
+        day = DAYS[when.weekday()]
+        clock = when.strftime("%H:%M")
+        for session in self.sessions:
+            if day in session['days'] and session['start'] <= clock < session['end']:
+                return session
+        return None
+
+    def get(self, name):
+        for session in self.sessions:
+            if session['name'] == name:
+                return session
+        return None
+
+    def view(self, index, session):
+        # Sub-index of the session's students enrolled in index. When they
+        # are stored next to each other (see student_order) the result is a
+        # slice of the index's matrix, not a copy. Returns (index, is_view).
+        members = session['members']
+        positions = [i for i, name in enumerate(index.names) if name in members]
+        if not positions:
+            return None, True
+        first, last = positions[0], positions[-1]
+        if last - first + 1 == len(positions):
+            start, end = index.offsets[first], index.offsets[last + 1]
+            return MatchIndex(index.names[first:last + 1], index.matrix[start:end],
+                              index.offsets[first:last + 2] - start), True
+        counts = np.diff(index.offsets)[positions]
+        rows = np.concatenate([np.arange(index.offsets[i], index.offsets[i + 1]) for i in positions])
+        return MatchIndex([index.names[i] for i in positions], index.matrix[rows],
+                          np.concatenate(([0], np.cumsum(counts)))), False
+
+    def student_order(self):
+        # Students grouped by their first session; an index in this order
+        # keeps every session's roster contiguous unless it shares students
+        # with an earlier session
+        order = []
+        seen = set()
+        for session in self.sessions:
+            for name in session['students']:
+                if name not in seen:
+                    seen.add(name)
+                    order.append(name)
+        return order
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show class/session rosters and the active session")
+    parser.add_argument('--rosters', default=os.path.join(BASE_DIR, "rosters.json"))
+    args = parser.parse_args()
+
+    schedule = RosterSchedule.load(args.rosters)
+    # Read-only: an engine would write the attendance store and index snapshot on close
+    from tuner import load_gallery
+    known_faces = load_gallery()
+    index = MatchIndex.build(known_faces).reordered(schedule.student_order())  # As the engine orders it
+    active = schedule.active()
+    for session in schedule.sessions:
+        view, is_view = schedule.view(index, session)
+        missing = sorted(session['members'] - set(known_faces))
+        marker = "*" if session is active else " "
+        print(f"{marker} {session['name']}: {','.join(session['days'])} {session['start']}-{session['end']}, "
+              f"{len(session['students'])} students, {0 if view is None else len(view.matrix)} samples "
+              f"({'view' if is_view else 'copy'})")
+        if missing:
+            print(f"    not enrolled: {', '.join(missing)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from frame_scheduler import box_iou
+
+CASCADE_FILE = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+
+
+def non_max_suppression(boxes, iou_threshold=0.3):
+    # Greedy suppression of (x, y, w, h) boxes, larger boxes first: a face cut
+    # by a tile edge gives a smaller duplicate of the complete detection
+    if len(boxes) == 0:
+        return np.zeros((0, 4), dtype=np.int32)
+    boxes = np.asarray(boxes, dtype=np.int32)
+    x1, y1 = boxes[:, 0], boxes[:, 1]
+    x2, y2 = x1 + boxes[:, 2], y1 + boxes[:, 3]
+    areas = boxes[:, 2] * boxes[:, 3]
+    order = np.argsort(-areas)
+    keep = []
+    while len(order):
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        iw = np.maximum(0, np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]))
+        ih = np.maximum(0, np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]))
+        inter = iw * ih
+        iou = inter / (areas[i] + areas[rest] - inter)
+        # Also drops partial boxes lying mostly inside a kept one
+        contained = inter / np.maximum(areas[rest], 1)
+        order = rest[(iou <= iou_threshold) & (contained <= 0.7)]
+    return boxes[keep]
+
+
+def tile_origins(length, tile, step):
+    if length <= tile:
+        return [0]
+    origins = list(range(0, length - tile, step))
+    origins.append(length - tile)
+    return origins
+
+
+class TiledDetector:
+    # Runs the Haar cascade on overlapping tiles of a large frame in a thread
+    # pool (OpenCV releases the GIL) and merges the boxes with non-maximum
+    # suppression. Tiles find faces up to the overlap in size; larger faces,
+    # which a tile edge could cut, come from one extra pass on a downscaled
+    # copy of the frame. Each worker thread has its own classifier.
+    def __init__(self, tile_size=640, overlap=None, workers=None, cascade_file=CASCADE_FILE):
+        self.tile_size = tile_size
+        self.overlap = overlap or tile_size // 5
+        self.workers = workers or os.cpu_count() or 1
+        self.cascade_file = cascade_file
+        self.local = threading.local()
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix="detect")
+        self.last_tiles = 0
+
+    def cascade(self):
+        if not hasattr(self.local, 'cascade'):
+            self.local.cascade = cv2.CascadeClassifier(self.cascade_file)
+        return self.local.cascade
+
+    def detect_tile(self, gray, x, y, scale_factor, min_neighbors):
+        tile = gray[y:y+self.tile_size, x:x+self.tile_size]
+        faces = self.cascade().detectMultiScale(tile, scale_factor, min_neighbors,
+                                                maxSize=(self.overlap, self.overlap))
+        return [(fx + x, fy + y, fw, fh) for (fx, fy, fw, fh) in faces]
+
+    def detect_large(self, gray, scale_factor, min_neighbors):
+        # Faces bigger than the overlap, found on a copy scaled down to one tile
+        scale = self.tile_size / max(gray.shape[:2])
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        min_size = max(int(self.overlap * scale), 1)
+        faces = self.cascade().detectMultiScale(small, scale_factor, min_neighbors, minSize=(min_size, min_size))
+        return [tuple(int(v / scale) for v in face) for face in faces]
+
+    def detect(self, gray, scale_factor=1.3, min_neighbors=5):
+        height, width = gray.shape[:2]
+        if max(height, width) <= self.tile_size:
+            self.last_tiles = 1
+            return self.cascade().detectMultiScale(gray, scale_factor, min_neighbors)
+        step = self.tile_size - self.overlap
+        jobs = [self.pool.submit(self.detect_tile, gray, x, y, scale_factor, min_neighbors)
+                for y in tile_origins(height, self.tile_size, step)
+                for x in tile_origins(width, self.tile_size, step)]
+        jobs.append(self.pool.submit(self.detect_large, gray, scale_factor, min_neighbors))
+        self.last_tiles = len(jobs) - 1
+        boxes = [box for job in jobs for box in job.result()]
+        return non_max_suppression(boxes)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+def benchmark(frames, tile_size=640, workers=None, scale_factor=1.3, min_neighbors=5):
+    # Single-threaded full-frame detection versus tiled detection on the same frames
+    full = cv2.CascadeClassifier(CASCADE_FILE)
+    tiled = TiledDetector(tile_size, workers=workers)
+    threads = cv2.getNumThreads()
+    cv2.setNumThreads(1)  # The baseline is one cascade call on one thread
+    try:
+        start = time.perf_counter()
+        full_faces = [full.detectMultiScale(gray, scale_factor, min_neighbors) for gray in frames]
+        full_time = (time.perf_counter() - start) / len(frames)
+        start = time.perf_counter()
+        tiled_faces = [tiled.detect(gray, scale_factor, min_neighbors) for gray in frames]
+        tiled_time = (time.perf_counter() - start) / len(frames)
+    finally:
+        cv2.setNumThreads(threads)
+        tiled.close()
+
+    # How many full-frame faces the tiled pass found again (IoU >= 0.5)
+    found = 0
+    for reference, faces in zip(full_faces, tiled_faces):
+        for box in reference:
+            if any(box_iou(box, other) >= 0.5 for other in faces):
+                found += 1
+    total = sum(len(f) for f in full_faces)
+    return {
+        'frames': len(frames),
+        'frame_size': f"{frames[0].shape[1]}x{frames[0].shape[0]}",
+        'tiles': tiled.last_tiles,
+        'workers': tiled.workers,
+        'full_ms': round(full_time * 1000, 2),
+        'tiled_ms': round(tiled_time * 1000, 2),
+        'speedup': round(full_time / tiled_time, 2) if tiled_time else 0.0,
+        'full_faces': total,
+        'tiled_faces': sum(len(f) for f in tiled_faces),
+        'recall_vs_full': round(found / total, 3) if total else 1.0,
+    }
+
+
+def synthetic_frames(known_faces, count=10, size=(2160, 3840), faces_per_frame=12, seed=0):
+    # Enrolled face crops pasted at random sizes into large frames
+    rng = np.random.default_rng(seed)
+    samples = [sample for samples in known_faces.values() for sample in samples]
+    if not samples:
+        raise ValueError("The synthetic benchmark needs enrolled faces")
+    frames = []
+    for _ in range(count):
+        frame = cv2.GaussianBlur(rng.integers(0, 256, size, dtype=np.uint8), (0, 0), 25)
+        for _ in range(faces_per_frame):
+            side = int(rng.integers(60, 400))
+            face = cv2.resize(samples[int(rng.integers(len(samples)))], (side, side))
+            x = int(rng.integers(0, size[1] - side))
+            y = int(rng.integers(0, size[0] - side))
+            frame[y:y+side, x:x+side] = face
+        frames.append(frame)
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tiled face detection against a full-frame pass")
+    parser.add_argument('--recording', help="Recording made with frame_source.py (default: synthetic 4K frames)")
+    parser.add_argument('--frames', type=int, default=10)
+    parser.add_argument('--tile-size', type=int, default=640)
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    if args.recording:
+        from frame_source import read_recording
+        frames = []
+        for _, frame in read_recording(args.recording):
+            frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+            if len(frames) >= args.frames:
+                break
+    else:
+        # Read-only: an engine would write the attendance store and index snapshot on close
+        from tuner import load_gallery
+        frames = synthetic_frames(load_gallery(), args.frames)
+
+    report = benchmark(frames, args.tile_size, args.workers)
+    for key, value in report.items():
+        print(f"{key:>15}: {value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+import argparse
+import itertools
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+from cryptography.fernet import Fernet
+
+from frame_source import read_recording
+from recognition_engine import BASE_DIR, TUNABLE_PARAMETERS, MatchIndex, decide_identities, normalize_faces, \
+    read_face_file
+
+DEFAULT_GRID = {
+    'scale_factor': [1.1, 1.2, 1.3],
+    'min_neighbors': [3, 5, 7],
+    'match_confidence_threshold': [0.50, 0.55, 0.60, 0.65, 0.70],
+    'recognition_threshold': [0.60, 0.65, 0.70, 0.75],
+    'min_recognition_matches': [1, 2, 3],
+    'unique_sample_threshold': [0.80, 0.85, 0.90],
+}
+
+DETECTION_PARAMETERS = ('scale_factor', 'min_neighbors')
+MATCHER_PARAMETERS = ('match_confidence_threshold', 'recognition_threshold', 'min_recognition_matches')
+
+
+def load_gallery(base_dir=BASE_DIR):
+    # The enrolled samples read straight from face_data.enc; an engine would
+    # also start the event log and bus and write the attendance store and
+    # index snapshot on close
+    face_data_file = os.path.join(base_dir, "face_data.enc")
+    if not os.path.exists(face_data_file):
+        return {}
+    with open(os.path.join(base_dir, "encryption.key"), "rb") as f:
+        fernet = Fernet(f.read())
+    with open(face_data_file, "rb") as f:
+        return read_face_file(f, fernet)[0]
+
+
+def load_labelled_recording(recording, labels_file):
+    # Labels: {"segments": [{"start": 0, "end": 90, "name": "Alice"}, ...]}
+    # with inclusive frame indices. Frames outside every segment should not
+    # be recognized as anybody.
+    with open(labels_file, "r", encoding="utf-8") as f:
+        segments = json.load(f)['segments']
+    frames = []
+    labels = []
+    for i, (_, frame) in enumerate(read_recording(recording)):
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+        label = None
+        for segment in segments:
+            if segment['start'] <= i <= segment['end']:
+                label = segment['name']
+                break
+        labels.append(label)
+    return frames, labels
+
+
+def synthetic_dataset(known_faces, impostor_fraction=0.2, probes_per_person=2, seed=0):
+    # Builds labelled frames from the enrolled gallery: held-out samples of
+    # enrolled persons are genuine probes; every sample of a few persons left
+    # out of the gallery is an impostor probe. Each probe is pasted with a
+    # random size, position and brightness into a smooth background frame.
+    rng = np.random.default_rng(seed)
+    names = sorted(name for name, samples in known_faces.items() if len(samples) > probes_per_person)
+    if len(names) < 2:
+        raise ValueError("The synthetic dataset needs at least two enrolled persons with enough samples")
+    rng.shuffle(names)
+    impostors = set(names[:max(1, int(len(names) * impostor_fraction))])
+
+    gallery = {}
+    probes = []
+    for name in names:
+        samples = known_faces[name]
+        if name in impostors:
+            probes.extend((sample, None) for sample in samples)
+        else:
+            gallery[name] = samples[:-probes_per_person]
+            probes.extend((sample, name) for sample in samples[-probes_per_person:])
+
+    frames = []
+    labels = []
+    for sample, label in probes:
+        background = cv2.GaussianBlur(rng.integers(0, 256, (480, 640), dtype=np.uint8), (0, 0), 25)
+        size = int(rng.integers(100, 200))
+        face = cv2.resize(sample, (size, size))
+        face = np.clip(face.astype(np.int16) + int(rng.integers(-25, 26)), 0, 255).astype(np.uint8)
+        x = int(rng.integers(0, 640 - size))
+        y = int(rng.integers(0, 480 - size))
+        background[y:y+size, x:x+size] = face
+        frames.append(background)
+        labels.append(label)
+    return gallery, frames, labels
+
+
+def split_frames(labels, learn_fraction=0.5):
+    # Frame indices to learn from and to evaluate on. Every run of equal
+    # labels is cut in two blocks, so both parts cover every person and
+    # neighbouring frames of a recording mostly stay on one side.
+    learn = []
+    held_out = []
+    start = 0
+    for i in range(1, len(labels) + 1):
+        if i == len(labels) or labels[i] != labels[start]:
+            cut = start + int((i - start) * learn_fraction)
+            learn.extend(range(start, cut))
+            held_out.extend(range(cut, i))
+            start = i
+    return learn, held_out
+
+
+def detect_all(face_cascade, frames, scale_factor, min_neighbors):
+    # Face crops per frame and the mean detection cost
+    crops = []
+    start = time.perf_counter()
+    for gray in frames:
+        faces = face_cascade.detectMultiScale(gray, scale_factor, min_neighbors)
+        crops.append([gray[y:y+h, x:x+w] for (x, y, w, h) in faces])
+    return crops, (time.perf_counter() - start) / max(len(frames), 1)
+
+
+def simulate_learning(index, crop_vectors, parameters, unique_sample_threshold, learning_threshold):
+    # Replays smart learning over the dataset with the candidate matcher, so
+    # the uniqueness cutoff shows up as gallery growth (accuracy and cost)
+    # under the thresholds it will run with
+    for vectors in crop_vectors:
+        if len(vectors) == 0:
+            continue
+        identities, averages, _, _, _ = decide_identities(
+            index, index.score(vectors), parameters['match_confidence_threshold'],
+            parameters['recognition_threshold'], parameters['min_recognition_matches'])
+        for vector, identity, average in zip(vectors, identities, averages):
+            if identity < 0 or average >= learning_threshold:
+                continue
+            name = index.names[identity]
+            if float((index.person_rows(name) @ vector).max()) <= unique_sample_threshold:
+                index = index.with_samples(name, vector)
+    return index
+
+
+def evaluate(index, crop_vectors, labels, parameters):
+    # False accepts: recognized names that are not the frame's label.
+    # False rejects: labelled frames where the labelled person is not recognized.
+    queries = [v for v in crop_vectors if len(v)]
+    owners = np.repeat(np.arange(len(crop_vectors)), [len(v) for v in crop_vectors])
+    if queries:
+        identities = decide_identities(index, index.score(np.vstack(queries)), parameters['match_confidence_threshold'],
+                                       parameters['recognition_threshold'], parameters['min_recognition_matches'])[0]
+    else:
+        identities = np.zeros(0, dtype=np.int64)
+
+    recognized = [set() for _ in labels]
+    for frame, identity in zip(owners, identities):
+        if identity >= 0:
+            recognized[frame].add(index.names[identity])
+
+    false_accepts = 0
+    false_rejects = 0
+    genuine = 0
+    for label, names in zip(labels, recognized):
+        false_accepts += len(names - {label})
+        if label is not None:
+            genuine += 1
+            if label not in names:
+                false_rejects += 1
+    return false_accepts / max(len(labels), 1), false_rejects / max(genuine, 1)
+
+
+def time_matching(index, crop_vectors, parameters):
+    start = time.perf_counter()
+    for vectors in crop_vectors:
+        if len(vectors):
+            decide_identities(index, index.score(vectors), parameters['match_confidence_threshold'],
+                              parameters['recognition_threshold'], parameters['min_recognition_matches'])
+    return (time.perf_counter() - start) / max(len(crop_vectors), 1)
+
+
+def sweep(gallery, frames, labels, grid=DEFAULT_GRID, learning_threshold=0.9, learn_fraction=0.5):
+    # learning_threshold: the engine's smart-learning cutoff (not swept).
+    # Learning is replayed on one part of the frames and the rates and cost
+    # are measured on the rest: scoring the frames it learned from would
+    # make the false reject rate look better than it is.
+    results = []
+    base_index = MatchIndex.build(gallery)
+    learn, held_out = split_frames(labels, learn_fraction)
+    held_out_labels = [labels[i] for i in held_out]
+    print(f"Learning on {len(learn)} frames, evaluating on {len(held_out)}")
+    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    for scale_factor, min_neighbors in itertools.product(grid['scale_factor'], grid['min_neighbors']):
+        crops, detect_cost = detect_all(face_cascade, frames, scale_factor, min_neighbors)
+        crop_vectors = [normalize_faces(c) for c in crops]
+        learn_vectors = [crop_vectors[i] for i in learn]
+        held_out_vectors = [crop_vectors[i] for i in held_out]
+        print(f"Detection scale_factor={scale_factor} min_neighbors={min_neighbors}: "
+              f"{sum(len(c) for c in crops)} faces, {detect_cost * 1000:.1f} ms/frame")
+
+        for values in itertools.product(*(grid[name] for name in MATCHER_PARAMETERS)):
+            for unique_sample_threshold in grid['unique_sample_threshold']:
+                parameters = dict(zip(MATCHER_PARAMETERS, values))
+                index = simulate_learning(base_index, learn_vectors, parameters, unique_sample_threshold,
+                                          learning_threshold)
+                false_accept, false_reject = evaluate(index, held_out_vectors, held_out_labels, parameters)
+                match_cost = time_matching(index, held_out_vectors, parameters)
+                parameters.update(scale_factor=scale_factor, min_neighbors=min_neighbors,
+                                  unique_sample_threshold=unique_sample_threshold)
+                results.append({
+                    'parameters': parameters,
+                    'false_accept_rate': round(false_accept, 4),
+                    'false_reject_rate': round(false_reject, 4),
+                    'ms_per_frame': round((detect_cost + match_cost) * 1000, 3),
+                    'gallery_samples': int(len(index.matrix)),
+                })
+    return results
+
+
+def pareto_front(results):
+    # Configurations that no other configuration beats on all three of
+    # false accepts, false rejects and cost
+    points = np.array([[r['false_accept_rate'], r['false_reject_rate'], r['ms_per_frame']] for r in results])
+    front = []
+    for i, point in enumerate(points):
+        dominated = np.all(points <= point, axis=1) & np.any(points < point, axis=1)
+        if not dominated.any():
+            front.append(results[i])
+    return sorted(front, key=lambda r: (r['false_accept_rate'] + r['false_reject_rate'], r['ms_per_frame']))
+
+
+def print_front(front):
+    print(f"{'#':>3} {'FAR':>7} {'FRR':>7} {'ms/frame':>9}  parameters")
+    for i, result in enumerate(front):
+        parameters = ', '.join(f"{k}={v}" for k, v in result['parameters'].items())
+        print(f"{i:>3} {result['false_accept_rate']:>7.3f} {result['false_reject_rate']:>7.3f} "
+              f"{result['ms_per_frame']:>9.2f}  {parameters}")
+
+
+def write_tuning(tuning_file, result):
+    with open(tuning_file, "w", encoding="utf-8") as f:
+        json.dump({'parameters': result['parameters'],
+                   'false_accept_rate': result['false_accept_rate'],
+                   'false_reject_rate': result['false_reject_rate'],
+                   'ms_per_frame': result['ms_per_frame']}, f, indent=2)
+    print(f"Saved configuration to {tuning_file}; it is loaded at startup")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep detector and matcher parameters")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('sweep')
+    run.add_argument('--recording', help="Recording made with frame_source.py")
+    run.add_argument('--labels', help="JSON labels for the recording")
+    run.add_argument('--synthetic', action='store_true', help="Build a dataset from the enrolled gallery")
+    run.add_argument('--grid', help="JSON file overriding parts of the parameter grid")
+    run.add_argument('--output', default="tuning_results.json")
+
+    select = sub.add_parser('select')
+    select.add_argument('results', nargs='?', default="tuning_results.json")
+    select.add_argument('--pick', type=int, default=0, help="Row of the Pareto front to use")
+
+    args = parser.parse_args()
+
+    if args.command == 'sweep':
+        grid = dict(DEFAULT_GRID)
+        if args.grid:
+            with open(args.grid, "r", encoding="utf-8") as f:
+                grid.update((k, v) for k, v in json.load(f).items() if k in TUNABLE_PARAMETERS)
+        if args.synthetic:
+            gallery, frames, labels = synthetic_dataset(load_gallery())
+        elif args.recording and args.labels:
+            gallery = load_gallery()
+            frames, labels = load_labelled_recording(args.recording, args.labels)
+        else:
+            parser.error("sweep needs --synthetic or --recording with --labels")
+
+        results = sweep(gallery, frames, labels, grid)
+        front = pareto_front(results)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({'results': results, 'pareto_front': front}, f, indent=2)
+        print_front(front)
+        print(f"{len(results)} configurations evaluated, {len(front)} Pareto-optimal; saved to {args.output}")
+    else:
+        with open(args.results, "r", encoding="utf-8") as f:
+            front = json.load(f)['pareto_front']
+        print_front(front)
+        write_tuning(os.path.join(BASE_DIR, "tuning.json"), front[args.pick])
+
+
+if __name__ == '__main__':
+    main()